@@ -0,0 +1,224 @@
+# Columnar archive of raw vehicle traces and processed stop times, for
+# analysis and for reprocessing without the database. Call this file to
+# archive the trips starting on a range of (local) days, e.g.
+# python archive.py --start 2017-10-01 --end 2017-11-01 [--route 504 505]
+# Trips are written to Parquet files partitioned by the local day on
+# which they start and by route:
+#	<directory>/traces/service_id=<day>/route_id=<route>/part.parquet
+#	<directory>/stop_times/service_id=<day>/route_id=<route>/part.parquet
+# with the points of each trace as list columns (lons, lats, times).
+# Archiving a day and route again replaces its files. This needs pyarrow.
+
+import argparse, time, calendar
+from os import path, makedirs, listdir, rename
+import numpy as np
+from conf import conf
+import db
+
+try:
+	import pyarrow as pa
+	import pyarrow.parquet as pq
+except ImportError:
+	pa = None
+
+
+def require_pyarrow():
+	if pa is None:
+		raise ImportError('the trip archive needs pyarrow (pip install pyarrow)')
+
+
+def partition(directory,table,service_id,route_id):
+	return path.join( directory, table,
+		'service_id='+str(service_id), 'route_id='+str(route_id), 'part.parquet'
+	)
+
+
+def list_array(arrays,dtype):
+	"""a list column from a sequence of numpy arrays, built all at once"""
+	offsets = np.concatenate( ( [0], np.cumsum( [ len(a) for a in arrays ] ) ) )
+	values = np.concatenate( [ np.array([],dtype=dtype) ] + [ np.asarray(a,dtype=dtype) for a in arrays ] )
+	return pa.ListArray.from_arrays( pa.array(offsets.astype(np.int32)), pa.array(values) )
+
+
+def list_column(column):
+	"""split a list column back into a list of numpy arrays"""
+	arrays = []
+	for chunk in column.chunks:
+		values = chunk.flatten().to_numpy()
+		offsets = np.asarray(chunk.offsets)
+		arrays.extend( [ values[offsets[i]:offsets[i+1]] for i in range(len(chunk)) ] )
+	return arrays
+
+
+def write_table(table,filename):
+	# written aside and moved into place, so readers never see half a file
+	if not path.exists(path.dirname(filename)):
+		makedirs(path.dirname(filename))
+	pq.write_table( table, filename+'.tmp', compression='snappy' )
+	rename(filename+'.tmp',filename)
+
+
+def write_traces(directory,service_id,route_id,trips):
+	"""write the raw traces of a route's trips on a day, given as a
+		dictionary keyed by trip_id like that from db.get_trips"""
+	trip_ids = sorted(trips)
+	rows = [ trips[trip_id] for trip_id in trip_ids ]
+	table = pa.Table.from_arrays( [
+		pa.array( np.array(trip_ids,dtype=np.int64) ),
+		pa.array( [ r['block_id'] for r in rows ], type=pa.int64() ),
+		pa.array( [ r['direction_id'] for r in rows ], type=pa.string() ),
+		pa.array( [ r['vehicle_id'] for r in rows ], type=pa.string() ),
+		list_array( [ r['lons'] for r in rows ], float ),
+		list_array( [ r['lats'] for r in rows ], float ),
+		list_array( [ r['times'] for r in rows ], float )
+	], [ 'trip_id', 'block_id', 'direction_id', 'vehicle_id', 'lons', 'lats', 'times' ] )
+	write_table( table, partition(directory,'traces',service_id,route_id) )
+	return sum( [ len(r['times']) for r in rows ] )
+
+
+def write_stop_times(directory,service_id,route_id,stop_times):
+	"""write the stop times of a route's trips on a day, given as
+		columns like those from db.get_stop_times"""
+	# typed explicitly, as empty columns would otherwise be of null type
+	table = pa.Table.from_arrays( [
+		pa.array( stop_times['trip_id'], type=pa.int64() ),
+		pa.array( stop_times['stop_id'], type=pa.string() ),
+		pa.array( stop_times['stop_sequence'], type=pa.int32() ),
+		pa.array( stop_times['etime'], type=pa.float64() )
+	], [ 'trip_id', 'stop_id', 'stop_sequence', 'etime' ] )
+	write_table( table, partition(directory,'stop_times',service_id,route_id) )
+	return len(stop_times['etime'])
+
+
+class archive_reader(object):
+	"""Reads trips back out of an archive, only opening the partitions
+		(days and routes) asked for, and only reading every column of
+		those files holding the trips wanted."""
+
+	def __init__(self,directory):
+		require_pyarrow()
+		self.directory = directory
+
+
+	def partitions(self,table,service_ids=None,route_ids=None):
+		"""yield ( service_id, route_id, filename ) for each partition"""
+		root = path.join(self.directory,table)
+		if not path.exists(root):
+			return
+		for day in sorted(listdir(root)):
+			service_id = int( day.split('=')[1] )
+			if service_ids is not None and service_id not in service_ids:
+				continue
+			for route in sorted(listdir(path.join(root,day))):
+				route_id = route.split('=',1)[1]
+				if route_ids is not None and route_id not in route_ids:
+					continue
+				filename = path.join(root,day,route,'part.parquet')
+				if path.exists(filename):
+					yield ( service_id, route_id, filename )
+
+
+	def trip_ids(self,service_ids=None,route_ids=None):
+		"""return the ids of archived trips on the given days and routes"""
+		ids = []
+		for service_id, route_id, filename in self.partitions('traces',service_ids,route_ids):
+			ids.extend( pq.read_table(filename,columns=['trip_id']).column('trip_id').to_pylist() )
+		return sorted(ids)
+
+
+	def get_trips(self,trip_ids=None,service_ids=None,route_ids=None):
+		"""Return the archived trips as a dictionary keyed by trip_id,
+			in the same form as db.get_trips, so that trip objects can be
+			built from either. Optionally only certain trips, days, and
+			routes."""
+		wanted = set(trip_ids) if trip_ids is not None else None
+		result = {}
+		for service_id, route_id, filename in self.partitions('traces',service_ids,route_ids):
+			if wanted is not None:
+				ids = pq.read_table(filename,columns=['trip_id']).column('trip_id').to_pylist()
+				if wanted.isdisjoint(ids):
+					continue
+			table = pq.read_table(filename)
+			columns = dict( [ ( name, table.column(name) ) for name in table.schema.names ] )
+			ids = columns['trip_id'].to_pylist()
+			blocks = columns['block_id'].to_pylist()
+			directions = columns['direction_id'].to_pylist()
+			vehicles = columns['vehicle_id'].to_pylist()
+			lons = list_column(columns['lons'])
+			lats = list_column(columns['lats'])
+			times = list_column(columns['times'])
+			for i, trip_id in enumerate(ids):
+				if wanted is not None and trip_id not in wanted:
+					continue
+				result[trip_id] = {
+					'block_id':blocks[i],
+					'direction_id':directions[i],
+					'route_id':route_id,
+					'vehicle_id':vehicles[i],
+					'lons':lons[i],
+					'lats':lats[i],
+					'times':times[i]
+				}
+		return result
+
+
+	def get_stop_times(self,service_ids=None,route_ids=None):
+		"""return the archived stop times on the given days and routes,
+			in the same columns as db.get_stop_times"""
+		columns = { 'trip_id':[], 'stop_id':[], 'stop_sequence':[], 'etime':[] }
+		for service_id, route_id, filename in self.partitions('stop_times',service_ids,route_ids):
+			table = pq.read_table(filename)
+			for name in columns:
+				columns[name].extend( table.column(name).to_pylist() )
+		return {
+			'trip_id':np.array( columns['trip_id'], dtype=np.int64 ),
+			'stop_id':columns['stop_id'],
+			'stop_sequence':np.array( columns['stop_sequence'], dtype=np.int32 ),
+			'etime':np.array( columns['etime'], dtype=float )
+		}
+
+
+def parse_args():
+	parser = argparse.ArgumentParser(description='Archive trips to Parquet.')
+	parser.add_argument('--start',required=True,help='first (local) day to archive, as YYYY-MM-DD')
+	parser.add_argument('--end',required=True,help='(local) day to stop before, as YYYY-MM-DD')
+	parser.add_argument('--route',nargs='+',help='route_ids to archive')
+	parser.add_argument('--directory',default=conf['parquet_archive']['directory'],help='where to write the archive')
+	return parser.parse_args()
+
+
+def service_id(date):
+	"""the service_id (local "epoch day") of a YYYY-MM-DD date"""
+	return calendar.timegm( time.strptime(date,'%Y-%m-%d') ) // (24*3600)
+
+
+def main():
+	require_pyarrow()
+	args = parse_args()
+	start = time.time()
+	totals = { 'trips':0, 'points':0, 'stop_times':0 }
+	for day in range( service_id(args.start), service_id(args.end) ):
+		# the local day in epoch seconds
+		day_start = day*24*3600 - conf['timezone']*3600
+		trip_ids = db.get_trip_ids( start_time=day_start, end_time=day_start+24*3600 )
+		by_route = {}
+		# load the traces a few hundred trips at a time
+		for i in range(0,len(trip_ids),500):
+			for trip_id, trip in db.get_trips(trip_ids[i:i+500]).items():
+				if args.route and trip['route_id'] not in args.route:
+					continue
+				by_route.setdefault( trip['route_id'], {} )[trip_id] = trip
+		for route_id, trips in sorted(by_route.items()):
+			totals['trips'] += len(trips)
+			totals['points'] += write_traces( args.directory, day, route_id, trips )
+			totals['stop_times'] += write_stop_times(
+				args.directory, day, route_id, db.get_stop_times(trips.keys())
+			)
+		print 'day',day,':',sum( [ len(t) for t in by_route.values() ] ),'trips on',len(by_route),'routes'
+	print 'archived %d trips, %d points and %d stop times in %.1f s' % (
+		totals['trips'], totals['points'], totals['stop_times'], time.time()-start
+	)
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,273 @@
+# call this file to benchmark parts of the processing pipeline on
+# synthetic data, without any database or network access. Give the
+# name of the benchmark to run as the first argument, e.g.
+# python benchmark.py clean [number of tracks] [points per track]
+# python benchmark.py fleet [number of vehicles] [hours]
+# python benchmark.py xml [repeats] [gzipped vehicleLocations response file]
+
+import re, sys, time, random, resource, gzip
+import multiprocessing as mp
+import xml.etree.ElementTree as ET
+from cStringIO import StringIO
+import numpy as np
+from clean import cleaner
+from live import live_trip
+from nb_feed import vehicle_locations
+from shapely.geometry import Point
+
+
+class legacy_cleaner(object):
+	"""The former regex-based cleaning loop from trip.process(), kept
+		here as a reference. Vehicles are dicts with 'x','y' and 'time'"""
+
+	def __init__(self,vehicles,seed=None):
+		self.vehicles = list(vehicles)
+		self.ignored_vehicles = []
+		self.random = random.Random(seed)
+		self.segment_speeds = self.get_segment_speeds()
+
+	def run(self):
+		while self.has_errors():
+			if len(self.vehicles) < 5:
+				return
+			self.fix_error()
+			self.segment_speeds = self.get_segment_speeds()
+
+	def get_segment_speeds(self):
+		dists, times = [], []
+		for i in range(1,len(self.vehicles)):
+			v1, v2 = self.vehicles[i-1], self.vehicles[i]
+			dists.append( ((v1['x']-v2['x'])**2 + (v1['y']-v2['y'])**2)**0.5 / 1000 )
+			times.append( (v2['time']-v1['time'])/3600 )
+		return [ d/t for d,t in zip(dists,times) ]
+
+	def ignore_vehicle(self,index):
+		self.ignored_vehicles.append( self.vehicles.pop(index) )
+
+	def has_errors(self):
+		self.speed_string = ''.join([
+			'x' if seg > 120 else 'o' if seg < 0.1 else '-'
+			for seg in self.segment_speeds ])
+		return bool( re.search('oo',self.speed_string) or re.search('x',self.speed_string) )
+
+	def fix_error(self):
+		if re.search('^oo*',self.speed_string):
+			return self.ignore_vehicle(0)
+		if re.search('oo*$',self.speed_string):
+			return self.ignore_vehicle( len(self.speed_string) )
+		if re.search('^.{0,3}x',self.speed_string):
+			return self.ignore_vehicle(0)
+		if re.search('x.{0,3}$',self.speed_string):
+			return self.ignore_vehicle( len(self.speed_string) )
+		m = re.search('.ooo*.',self.speed_string)
+		if m:
+			return self.ignore_vehicle(m.span()[0]+1)
+		m = re.search('.xxx*',self.speed_string)
+		if m:
+			return self.ignore_vehicle(m.span()[0]+1)
+		m = re.search('.x.',self.speed_string)
+		if m:
+			i = m.span()[0]+1+self.random.randint(0,1)
+			return self.ignore_vehicle(i-1)
+
+
+def noisy_track(num_points,rand):
+	"""return x, y and time lists for a synthetic vehicle track with
+		stationary periods and occasional large positional errors"""
+	x, y, times = [], [], []
+	px, py, t = 0.0, 0.0, 0.0
+	for i in range(num_points):
+		t += rand.uniform(5,20)
+		# sometimes the vehicle sits still, e.g. at a layover
+		if rand.random() > 0.2:
+			px += rand.uniform(-30,120)
+			py += rand.uniform(-30,120)
+		# sometimes the reported position is way off
+		if rand.random() < 0.05:
+			x.append( px + rand.uniform(-2000,2000) )
+			y.append( py + rand.uniform(-2000,2000) )
+		else:
+			x.append(px)
+			y.append(py)
+		times.append(t)
+	return x, y, times
+
+
+def bench_clean(num_tracks=50,num_points=400):
+	"""compare the NumPy cleaner to the regex loop on noisy tracks"""
+	rand = random.Random(0)
+	tracks = [ noisy_track(num_points,rand) for i in range(num_tracks) ]
+	legacy_time, new_time, mismatches = 0, 0, 0
+	for seed, (x,y,times) in enumerate(tracks):
+		vehicles = [ {'x':a,'y':b,'time':c} for a,b,c in zip(x,y,times) ]
+		start = time.time()
+		old = legacy_cleaner(vehicles,seed)
+		old.run()
+		legacy_time += time.time() - start
+		start = time.time()
+		new = cleaner(x,y,times,seed)
+		while new.has_errors() and new.num_points() >= 5:
+			new.fix_error()
+		new_time += time.time() - start
+		# both should keep and ignore exactly the same vehicles
+		if (
+			[ v['time'] for v in old.vehicles ] != list(new.times) or
+			[ v['time'] for v in old.ignored_vehicles ] != [ times[i] for i in new.ignored ]
+		):
+			mismatches += 1
+	print num_tracks,'tracks of',num_points,'points'
+	print '\tregex loop: %.3f s' % legacy_time
+	print '\tnumpy cleaner: %.3f s (%.1fx)' % ( new_time, legacy_time / new_time )
+	print '\t',mismatches,'tracks with different results'
+
+
+class legacy_trip(object):
+	"""The former representation of an operating trip: a full trip object 
+		with a dict and a shapely Point for every vehicle report"""
+
+	def __init__(self,trip_id,block_id,direction_id,route_id,vehicle_id,last_seen):
+		self.trip_id, self.block_id = trip_id, block_id
+		self.direction_id, self.route_id = direction_id, route_id
+		self.vehicle_id, self.last_seen = vehicle_id, last_seen
+		self.seq, self.speed_string = 1, ''
+		self.match_confidence, self.length = -1, 0
+		self.stops, self.timepoints, self.segment_speeds = [], [], []
+		self.waypoints, self.vehicles, self.ignored_vehicles = [], [], []
+		self.match_geom = None
+
+	def add_point(self,lon,lat,etime):
+		self.vehicles.append({
+			'time':etime, 'geom':Point(lon,lat), 'lon':lon, 'lat':lat
+		})
+
+	def num_points(self):
+		return len(self.vehicles)
+
+
+def simulate_fleet(trip_class,num_vehicles,hours,conn):
+	"""run a fleet of vehicles reporting every 20 seconds, with trips 
+		lasting an hour on average, and send back the peak number of 
+		points held and the growth in peak memory use in kilobytes"""
+	rand = random.Random(0)
+	baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	fleet, peak_points, points = {}, 0, 0
+	next_trip_id = 1
+	for tick in range( int(hours*3600/20) ):
+		now = tick * 20.0
+		for vid in range(num_vehicles):
+			if vid not in fleet or rand.random() < 20.0/3600:
+				if vid in fleet: # the trip ends
+					points -= fleet[vid].num_points()
+				fleet[vid] = trip_class(next_trip_id,next_trip_id,'1_0','1',vid,now)
+				next_trip_id += 1
+			fleet[vid].add_point( -79.4+rand.random()/10, 43.6+rand.random()/10, now )
+			fleet[vid].last_seen = now
+			points += 1
+		peak_points = max(peak_points,points)
+	conn.send( (
+		peak_points, next_trip_id - 1,
+		resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - baseline
+	) )
+
+
+def bench_fleet(num_vehicles=2000,hours=24):
+	"""compare the peak memory of a fleet of live_trips to the former 
+		trip objects, each simulated in a separate process"""
+	print num_vehicles,'vehicles over',hours,'hours'
+	for name, trip_class in [('live_trip',live_trip),('legacy trip',legacy_trip)]:
+		parent, child = mp.Pipe()
+		start = time.time()
+		process = mp.Process(
+			target=simulate_fleet, args=(trip_class,num_vehicles,hours,child)
+		)
+		process.start()
+		peak_points, num_trips, kilobytes = parent.recv()
+		process.join()
+		print '\t%s: %.1f MB peak for %d points (%.0f bytes/point), %d trips in %.1f s' % (
+			name, kilobytes/1024.0, peak_points, kilobytes*1024.0/peak_points, 
+			num_trips, time.time()-start
+		)
+
+
+def legacy_parse(raw):
+	"""the former parsing of a vehicleLocations response, from gzipped 
+		bytes as requests would have received them"""
+	text = gzip.GzipFile(fileobj=StringIO(raw)).read().decode('utf-8')
+	XML = ET.fromstring(text)
+	last_update = int(XML.find('./lastTime').attrib['time'])
+	vehicles = []
+	for v in XML.findall('.//vehicle'):
+		if v.attrib['predictable'] == 'false': 
+			continue
+		try:
+			v.attrib['dirTag']
+		except: 
+			continue
+		vehicles.append( (
+			int(v.attrib['id']), v.attrib['routeTag'], v.attrib['dirTag'],
+			float(v.attrib['lon']), float(v.attrib['lat']), 
+			int(v.attrib['secsSinceReport'])
+		) )
+	return last_update, vehicles
+
+
+def stream_parse(raw):
+	"""parse the same gzipped bytes with the streaming parser"""
+	locations = vehicle_locations( gzip.GzipFile(fileobj=StringIO(raw)) )
+	vehicles = list(locations)
+	return locations.last_time, vehicles
+
+
+def synthetic_response(num_vehicles,rand):
+	"""return gzipped bytes of a vehicleLocations response about the 
+		size of the TTC's at peak"""
+	lines = ['<?xml version="1.0" encoding="utf-8" ?>','<body copyright="All data copyright agencies listed below and NextBus Inc 2017.">']
+	for vid in range(1000,1000+num_vehicles):
+		route = rand.randint(5,600)
+		attributes = 'id="%d" routeTag="%d" lat="%.6f" lon="%.6f" secsSinceReport="%d" predictable="%s" heading="%d" speedKmHr="0"' % (
+			vid, route, 43.6+rand.random()/5, -79.5+rand.random()/3, rand.randint(0,60),
+			'false' if rand.random() < 0.05 else 'true', rand.randint(0,359)
+		)
+		if rand.random() > 0.1:
+			attributes += ' dirTag="%d_%d_%d"' % (route, rand.randint(0,1), route*10)
+		lines.append('<vehicle '+attributes+'/>')
+	lines.append('<lastTime time="1500000000000"/>')
+	lines.append('</body>')
+	data = StringIO()
+	with gzip.GzipFile(fileobj=data,mode='wb') as f:
+		f.write( '\n'.join(lines) )
+	return data.getvalue()
+
+
+def bench_xml(repeats=50,response_file=None):
+	"""compare the streaming parser to building the whole tree"""
+	if response_file:
+		raw = open(response_file,'rb').read()
+		# accept uncompressed responses too
+		if not raw.startswith('\x1f\x8b'):
+			data = StringIO()
+			with gzip.GzipFile(fileobj=data,mode='wb') as f:
+				f.write(raw)
+			raw = data.getvalue()
+	else:
+		raw = synthetic_response(1800,random.Random(0))
+	for name, parse in [('tree',legacy_parse),('streaming',stream_parse)]:
+		start = time.time()
+		for i in range(repeats):
+			last_time, vehicles = parse(raw)
+		elapsed = (time.time() - start) / repeats
+		print '\t%s: %.1f ms per response, %d vehicles' % (name, elapsed*1000, len(vehicles))
+	print '\tsame results:',legacy_parse(raw) == stream_parse(raw)
+
+
+benchmarks = {
+	'clean':bench_clean,
+	'fleet':bench_fleet,
+	'xml':bench_xml
+}
+
+if __name__ == '__main__':
+	if len(sys.argv) < 2 or sys.argv[1] not in benchmarks:
+		print 'choose a benchmark from:',', '.join(sorted(benchmarks))
+		sys.exit(1)
+	benchmarks[sys.argv[1]]( *[ int(arg) if arg.isdigit() else arg for arg in sys.argv[2:] ] )
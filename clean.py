@@ -0,0 +1,117 @@
+# Clean a GPS track of redundant points and obvious positional errors
+# before map-matching. Coordinates, times and segment speeds are kept in
+# NumPy arrays and speeds are only recomputed around removed points.
+
+import random
+import numpy as np
+
+# segment speed thresholds in km/h
+MAX_SPEED = 120	# faster than this is an error ('x')
+MIN_SPEED = 0.1	# slower than this is stationary ('o')
+
+
+class cleaner(object):
+	"""Applies the cleaning rules to one track, one point at a time. Point
+		indices given or returned refer to positions in the original input."""
+
+	def __init__(self,x,y,times,seed=None):
+		# x and y are in a local meter-based projection, times in epoch seconds
+		self.x = np.array(x,dtype=float)
+		self.y = np.array(y,dtype=float)
+		self.times = np.array(times,dtype=float)
+		self.index = np.arange(len(self.x))	# original indices of kept points
+		self.ignored = []							# original indices of removed points
+		self.random = random.Random(seed)	# for choosing around a lone 'x'
+		self.speeds = self.segment_speeds(0,len(self.x))
+
+
+	def segment_speeds(self,start,end):
+		"""return speeds (kmph) on the segments between points start:end"""
+		dists = np.hypot(
+			np.diff(self.x[start:end]), np.diff(self.y[start:end])
+		) / 1000
+		hours = np.diff(self.times[start:end]) / 3600
+		with np.errstate(divide='ignore',invalid='ignore'):
+			return dists / hours
+
+
+	def length(self):
+		"""total length in kilometers of the kept points"""
+		return np.hypot( np.diff(self.x), np.diff(self.y) ).sum() / 1000
+
+
+	def num_points(self):
+		"""the number of points not (yet) removed"""
+		return len(self.index)
+
+
+	def has_errors(self):
+		"""are there any fast segments or consecutive stationary ones?"""
+		fast = self.speeds > MAX_SPEED
+		slow = self.speeds < MIN_SPEED
+		return bool( fast.any() or (slow[:-1] & slow[1:]).any() )
+
+
+	def find_error(self):
+		"""return the index of the point to remove to fix the first error
+			found, or None. Rules are checked in order of priority and give
+			the same results as the equivalent regular expressions over a
+			string of segment speeds, e.g. '-ooxo-' """
+		fast = self.speeds > MAX_SPEED
+		slow = self.speeds < MIN_SPEED
+		if not ( fast.any() or (slow[:-1] & slow[1:]).any() ):
+			return None
+		last = len(self.speeds)
+		# leading o's (stationary start): remove the first point
+		if slow[0]:
+			return 0
+		# trailing o's (stationary end): remove the last point
+		if slow[-1]:
+			return last
+		fast_segs = np.flatnonzero(fast)
+		# x near the beginning, in the first four segments
+		if len(fast_segs) > 0 and fast_segs[0] <= 3:
+			return 0
+		# x near the end, in the last four segments
+		if len(fast_segs) > 0 and fast_segs[-1] >= last - 4:
+			return last
+		# two or more o's in the middle: remove the point starting the first
+		slow_pairs = np.flatnonzero( slow[:-1] & slow[1:] )
+		if len(slow_pairs) > 0:
+			return int(slow_pairs[0])
+		# 'xx' in the middle: remove the point starting the first x
+		fast_pairs = np.flatnonzero( fast[:-1] & fast[1:] )
+		if len(fast_pairs) > 0:
+			return int(fast_pairs[0])
+		# lone middle x: remove a point either before or at the start of it
+		return int(fast_segs[0]) - 1 + self.random.randint(0,1)
+
+
+	def remove(self,i):
+		"""remove the point at (current) index i, updating the speeds of
+			only the segments that it touched"""
+		self.ignored.append( int(self.index[i]) )
+		self.x = np.delete(self.x,i)
+		self.y = np.delete(self.y,i)
+		self.times = np.delete(self.times,i)
+		self.index = np.delete(self.index,i)
+		if i == 0:
+			self.speeds = self.speeds[1:]
+		elif i >= len(self.speeds):
+			self.speeds = self.speeds[:-1]
+		else:
+			# the two segments around the point become one
+			self.speeds = np.delete(self.speeds,i)
+			self.speeds[i-1] = self.segment_speeds(i-1,i+1)[0]
+
+
+	def fix_error(self):
+		"""remove a point to fix the first error found, if any.
+			Returns the original index of the removed point or None"""
+		i = self.find_error()
+		if i is None:
+			return None
+		original_index = int(self.index[i])
+		self.remove(i)
+		return original_index
+
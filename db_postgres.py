@@ -0,0 +1,701 @@
+# storage backend for PostgreSQL with PostGIS. Use it through db.py.
+import psycopg2, json, math, threading
+from psycopg2.pool import ThreadedConnectionPool
+from psycopg2.extras import execute_values
+from contextlib import contextmanager
+from conf import conf
+from cStringIO import StringIO
+from shapely.wkb import loads as loadWKB
+from geom import line_coords
+from stop_cache import stop_cache
+import numpy as np
+
+# connect and establish a cursor, based on parameters in conf.py
+conn_string = (
+	"host='"+conf['db']['host']
+	+"' dbname='"+conf['db']['name']
+	+"' user='"+conf['db']['user']
+	+"' password='"+conf['db']['password']+"'"
+)
+
+# count of statements sent to the server, including commits
+round_trips = 0
+round_trip_lock = threading.Lock()
+
+def count_round_trip():
+	global round_trips
+	with round_trip_lock:
+		round_trips += 1
+
+def get_round_trips():
+	"""return the number of round trips made to the server so far"""
+	return round_trips
+
+
+class counting_cursor(psycopg2.extensions.cursor):
+	"""cursor that counts each statement it sends to the server"""
+
+	def execute(self,query,vars=None):
+		count_round_trip()
+		return super(counting_cursor,self).execute(query,vars)
+
+	def copy_expert(self,sql,file,size=8192):
+		count_round_trip()
+		return super(counting_cursor,self).copy_expert(sql,file,size)
+
+
+# connections are shared between threads by this pool, which is
+# only opened when first needed. The pool raises an error rather than
+# waiting when all its connections are in use, so threads wait their
+# turn on the semaphore instead.
+pool = None
+slots = None
+pool_lock = threading.Lock()
+
+def reconnect():
+	"""renew connections inside a process"""
+	global pool, slots
+	size = conf['db'].get('pool_size',10)
+	pool = ThreadedConnectionPool(
+		1, size, conn_string, 
+		cursor_factory=counting_cursor
+	)
+	slots = threading.BoundedSemaphore(size)
+
+def get_pool():
+	"""return the pool and the semaphore guarding its connections"""
+	with pool_lock:
+		if pool is None:
+			reconnect()
+		return ( pool, slots )
+
+@contextmanager
+def pooled_connection():
+	"""borrow a connection from the pool, waiting if all are in use"""
+	pool, slots = get_pool()
+	slots.acquire()
+	try:
+		connection = pool.getconn()
+		try:
+			yield connection
+		finally:
+			pool.putconn(connection)
+	finally:
+		slots.release()
+
+@contextmanager
+def cursor():
+	"""provide a cursor on a pooled connection, where each 
+		statement commits on its own"""
+	with pooled_connection() as connection:
+		connection.autocommit = True
+		c = connection.cursor()
+		try:
+			yield c
+		finally:
+			c.close()
+
+@contextmanager
+def transaction():
+	"""provide a cursor on a pooled connection, where all statements 
+		are committed together at the end, or rolled back on error"""
+	with pooled_connection() as connection:
+		try:
+			connection.autocommit = False
+			with connection:
+				c = connection.cursor()
+				try:
+					yield c
+				finally:
+					c.close()
+				count_round_trip() # the commit
+		finally:
+			connection.autocommit = True
+
+def get_trips(trip_ids):
+	"""Return the attributes of stored trips necessary for the 
+		construction of new trip objects, as a dictionary keyed by 
+		trip_id. All trips are fetched in one query, with the vehicle
+		lon-lat positions as binary lines and the report times as 
+		arrays, decoded into numpy arrays."""
+	with cursor() as c:
+		c.execute(
+			"""
+				SELECT
+					trip_id,
+					block_id,
+					direction_id,
+					route_id,
+					vehicle_id,
+					ST_AsBinary(ST_Transform(orig_geom,4326)),
+					times
+				FROM {trips}
+				WHERE trip_id = ANY(%(trip_ids)s)
+			""".format(**conf['db']['tables']),
+			{ 'trip_ids':list(trip_ids) }
+		)
+		result = {}
+		for (trip_id, bid, did, rid, vid, wkb, times) in c:
+			lons, lats = line_coords(wkb)
+			result[trip_id] = {
+				'block_id':bid,
+				'direction_id':did,
+				'route_id':rid,
+				'vehicle_id':vid,
+				'lons':lons,
+				'lats':lats,
+				'times':np.array(times,dtype=float)
+			}
+		return result
+
+
+def get_stop_times(trip_ids):
+	"""Return the stored stop times of the given trips as columns:
+		numpy arrays of trip_ids, stop_sequences and etimes and a list
+		of stop_ids, ordered by trip and sequence."""
+	with cursor() as c:
+		c.execute(
+			"""
+				SELECT trip_id, stop_id, stop_sequence, etime
+				FROM {stop_times}
+				WHERE trip_id = ANY(%(trip_ids)s)
+				ORDER BY trip_id, stop_sequence
+			""".format(**conf['db']['tables']),
+			{ 'trip_ids':list(trip_ids) }
+		)
+		rows = c.fetchall()
+	return {
+		'trip_id':np.array( [ r[0] for r in rows ], dtype=np.int64 ),
+		'stop_id':[ r[1] for r in rows ],
+		'stop_sequence':np.array( [ r[2] for r in rows ], dtype=np.int32 ),
+		'etime':np.array( [ r[3] for r in rows ], dtype=float )
+	}
+
+
+def reserve_ids(sequence,n):
+	"""reserve a block of n new IDs from a sequence, given as one of
+		'trip_ids' or 'block_ids', in a single round trip. IDs are never
+		given out twice, so any number of processes may reserve them."""
+	with cursor() as c:
+		c.execute(
+			"""
+				SELECT nextval('{sequence}') FROM generate_series(1,%(n)s);
+			""".format( sequence=conf['db']['tables'][sequence] ),
+			{ 'n':n }
+		)
+		return [ id for (id,) in c ]
+
+
+def empty_tables():
+	"""clear the tables of any processing results
+		but NOT of original data from the API"""
+	with cursor() as c:
+		c.execute(
+			"""
+				TRUNCATE {stop_times};
+				UPDATE {trips} SET 
+					service_id = NULL,
+					match_confidence = NULL,
+					ignore = TRUE,
+					clean_geom = NULL,
+					problem = NULL,
+					active = NULL,
+					match_geom = NULL,
+					updated = EXTRACT(EPOCH FROM NOW());
+			""".format(**conf['db']['tables'])
+		)
+
+
+def ignore_trip(trip_id,reason=None):
+	"""mark a trip to be ignored"""
+	with cursor() as c:
+		c.execute(
+			"""
+				UPDATE {trips} SET ignore = TRUE, updated = EXTRACT(EPOCH FROM NOW()) 
+				WHERE trip_id = %(trip_id)s;
+				DELETE FROM {stop_times} WHERE trip_id = %(trip_id)s;
+			""".format(**conf['db']['tables']),
+			{ 'trip_id': trip_id } 
+		)
+	if reason:
+		flag_trip(trip_id,reason)
+	return
+
+
+def flag_trip(trip_id,problem_description_string):
+	"""Populate the 'problem' field of trip table: something must 
+		have gone wrong and this tells us what."""
+	with cursor() as c:
+		c.execute(
+			"""
+				UPDATE {trips} SET problem = problem || %(description)s 
+				WHERE trip_id = %(trip_id)s;
+			""".format(**conf['db']['tables']),
+			{
+				'description':problem_description_string,
+				'trip_id':trip_id
+			}
+		)
+
+
+def add_trip_match(trip_id,confidence,wkb_geometry_match):
+	"""update the trip record with it's matched geometry"""
+	with cursor() as c:
+		# store the given values
+		c.execute(
+			"""
+				UPDATE {trips}
+				SET  
+					match_confidence = %(confidence)s,
+					match_geom = ST_SetSRID(%(match)s::geometry,%(localEPSG)s)
+				WHERE trip_id  = %(trip_id)s;
+			""".format(**conf['db']['tables']),
+			{
+				'localEPSG':conf['localEPSG'],
+				'confidence':confidence, 
+				'match':wkb_geometry_match, 
+				'trip_id':trip_id
+			}
+		)
+
+
+def insert_trip(trip_id,block_id,route_id,direction_id,vehicle_id,times,orig_geom):
+	"""Store the basics of the trip in the database."""
+	with cursor() as c:
+		# store the given values
+		c.execute(
+			"""
+				INSERT INTO {trips} 
+					( 
+						trip_id, 
+						block_id, 
+						route_id, 
+						direction_id, 
+						vehicle_id, 
+						times,
+						orig_geom
+				) 
+				VALUES 
+					( 
+						%(trip_id)s,
+						%(block_id)s,
+						%(route_id)s,
+						%(direction_id)s,
+						%(vehicle_id)s, 
+						%(times)s,
+						ST_SetSRID( %(orig_geom)s::geometry, %(localEPSG)s )
+					);
+			""".format(**conf['db']['tables']),
+			{
+				'trip_id':trip_id, 
+				'block_id':block_id, 
+				'route_id':route_id, 
+				'direction_id':direction_id, 
+				'vehicle_id':vehicle_id,
+				'times':times,
+				'orig_geom':orig_geom,
+				'localEPSG':conf['localEPSG']
+			}
+		)
+
+
+def copy_value(value):
+	"""format a value for COPY's text format"""
+	if value is None:
+		return '\\N'
+	if isinstance(value,(list,tuple)):
+		return '{' + ','.join( [ repr(float(v)) for v in value ] ) + '}'
+	if isinstance(value,unicode):
+		value = value.encode('utf-8')
+	return str(value).replace('\\','\\\\').replace('\t','\\t').replace('\n','\\n').replace('\r','\\r')
+
+
+def copy_trips(records):
+	"""Store the basics of many trips at once using COPY. Records are 
+		tuples of ( trip_id, block_id, route_id, direction_id, vehicle_id, 
+		times, orig_geom ) where orig_geom is hex EWKB with an SRID."""
+	data = StringIO()
+	for record in records:
+		data.write( '\t'.join( [ copy_value(value) for value in record ] ) + '\n' )
+	data.seek(0)
+	with cursor() as c:
+		c.copy_expert(
+			"""
+				COPY {trips} ( 
+					trip_id, block_id, route_id, direction_id, 
+					vehicle_id, times, orig_geom
+				) FROM STDIN
+			""".format(**conf['db']['tables']),
+			data
+		)
+
+
+# stops are cached separately in each process
+stops_cache = stop_cache(
+	conf['stop_cache']['size'],
+	conf['stop_cache']['ttl']
+)
+
+
+def get_stops(direction_id,trip_time):
+	"""given the direction id, and the time of the trip, get a list of stops and 
+		their attributes from the schedule data, returning as a list of 
+		dictionaries with the stop_id and a (parsed) geometry, in the order
+		they are served. Need to make temporally relevant choices. 
+		trip_time is an epoch value. The list is shared between calls, so 
+		must not be modified."""
+	stops = stops_cache.get(direction_id,trip_time)
+	if stops is not None:
+		return stops
+	with cursor() as c:
+		# get the last reported version of the direction (from the 
+		# perspective of this trip) and the last reported version of each
+		# of its stops, along with the time each version was superseded
+		c.execute(
+			"""
+				WITH d AS (
+					SELECT 
+						stops, report_time,
+						LEAD(report_time) OVER (ORDER BY report_time) AS next_time
+					FROM {directions} 
+					WHERE direction_id = %(direction_id)s
+				), v AS (
+					SELECT * FROM d
+					WHERE report_time <= %(trip_time)s
+					ORDER BY report_time DESC
+					LIMIT 1
+				), o AS (
+					SELECT stop_id, min(position) AS position
+					FROM v, unnest(v.stops) WITH ORDINALITY AS u(stop_id,position)
+					GROUP BY stop_id
+				), s AS (
+					SELECT 
+						stop_id, the_geom, report_time,
+						LEAD(report_time) OVER (PARTITION BY stop_id ORDER BY report_time) AS next_time,
+						MIN(report_time) OVER (PARTITION BY stop_id) AS first_time
+					FROM {stops}
+					WHERE stop_id IN (SELECT stop_id FROM o)
+				)
+				SELECT 
+					v.report_time, v.next_time,
+					s.stop_id, s.the_geom, s.report_time, s.next_time
+				FROM v 
+					LEFT JOIN o ON TRUE
+					LEFT JOIN s ON s.stop_id = o.stop_id AND (
+						-- the version of the stop at the time of the trip
+						( 
+							s.report_time <= %(trip_time)s AND 
+							( s.next_time IS NULL OR s.next_time > %(trip_time)s )
+						) OR
+						-- or its first, if it was only reported later
+						( s.report_time > %(trip_time)s AND s.report_time = s.first_time )
+					)
+				ORDER BY o.position
+			""".format(**conf['db']['tables']),
+			{ 'direction_id':direction_id, 'trip_time':trip_time }
+		)
+		rows = c.fetchall()
+	stops = []
+	# the stops are valid from the latest of the versions used
+	# until the earliest time any of them was superseded
+	valid_from, valid_until = float('-inf'), None
+	for (d_time, d_next, stop_id, geom, s_time, s_next) in rows:
+		if s_time is not None and s_time > trip_time:
+			# this stop is not reported until later
+			s_next, s_time = s_time, None
+		for start in (d_time, s_time):
+			if start is not None:
+				valid_from = max(valid_from,start)
+		for end in (d_next, s_next):
+			if end is not None:
+				valid_until = end if valid_until is None else min(valid_until,end)
+		if s_time is None: # no version of the stop at this time
+			continue
+		stops.append({
+			'id':stop_id,
+			'geom':loadWKB(geom,hex=True)
+		})
+	# with no version of the direction yet, there is nothing to cache
+	if len(rows) > 0:
+		stops_cache.put(direction_id,valid_from,valid_until,stops)
+	return stops
+
+
+def get_stop_cache_stats():
+	"""return the hits and misses of this process's stop cache"""
+	return stops_cache.get_stats()
+
+
+def set_trip_clean_geom(trip_id,localWKBgeom):
+	"""Store a geometry of the input to the matching process"""
+	with cursor() as c:
+		c.execute(
+			"""
+				UPDATE {trips} 
+				SET clean_geom = ST_SetSRID( %(geom)s::geometry, %(EPSG)s )
+				WHERE trip_id = %(trip_id)s;
+			""".format(**conf['db']['tables']),
+			{
+				'trip_id':trip_id,
+				'geom':localWKBgeom,
+				'EPSG':conf['localEPSG']
+			}
+		)
+
+
+def store_timepoints(trip_id,timepoints):
+	"""store the estimated stop times for a trip"""
+	with cursor() as c:
+		insert_timepoints(c,trip_id,timepoints)
+
+
+def insert_timepoints(c,trip_id,timepoints):
+	"""insert the stop times for a trip using the given cursor"""
+	# list of tuples
+	records = [ 
+		(trip_id,timepoint['stop_id'],timepoint['time'],seq) 
+		for seq, timepoint in enumerate(timepoints,1) 
+	]
+	execute_values(
+		c,
+		"INSERT INTO {stop_times} (trip_id, stop_id, etime, stop_sequence) VALUES %s".format(**conf['db']['tables']),
+		records,
+		page_size=1000
+	)
+
+
+def store_trip_result(trip_id,clean_geom=None,confidence=None,match_geom=None,
+	service_id=None,timepoints=(),ignore=False,problem=""):
+	"""Store everything that came of processing a trip in one transaction: 
+		a single update of the trip record, replacing any stop times. 
+		Geometries are WKB strings in the local projection. A problem 
+		description is appended to any already recorded."""
+	with transaction() as c:
+		c.execute(
+			"""
+				UPDATE {trips} SET 
+					clean_geom = ST_SetSRID( %(clean_geom)s::geometry, %(localEPSG)s ),
+					match_confidence = %(confidence)s,
+					match_geom = ST_SetSRID( %(match_geom)s::geometry, %(localEPSG)s ),
+					service_id = %(service_id)s,
+					ignore = ignore OR %(ignore)s,
+					problem = problem || %(problem)s,
+					updated = EXTRACT(EPOCH FROM NOW())
+				WHERE trip_id = %(trip_id)s;
+				DELETE FROM {stop_times} WHERE trip_id = %(trip_id)s;
+			""".format(**conf['db']['tables']),
+			{
+				'trip_id':trip_id,
+				'clean_geom':clean_geom,
+				'confidence':confidence,
+				'match_geom':match_geom,
+				'service_id':service_id,
+				'ignore':ignore,
+				'problem':problem,
+				'localEPSG':conf['localEPSG']
+			}
+		)
+		if len(timepoints) > 0 and not ignore:
+			insert_timepoints(c,trip_id,timepoints)
+
+
+def set_service_id(trip_id,service_id):
+	"""set the service_id of a trip"""
+	with cursor() as c:
+		c.execute(
+			"""
+				UPDATE {trips} 
+				SET service_id = %(service_id)s, updated = EXTRACT(EPOCH FROM NOW())
+				WHERE trip_id = %(trip_id)s;
+			""".format(**conf['db']['tables']),
+			{
+				'service_id':service_id,
+				'trip_id':trip_id
+			}
+		)
+
+
+# route records (stops and directions) known to be stored already
+known_route_records = set()
+known_route_records_lock = threading.Lock()
+
+def store_route_config(stops,directions):
+	"""we have received a report of a route's stops and directions from 
+		the routeConfig data. Store any records that are new, with the 
+		current time, ignoring those where absolutely nothing has changed.
+		stops are tuples of ( stop_id, stop_name, stop_code, lon, lat ) 
+		and directions are tuples of ( route_id, direction_id, title, 
+		name, branch, useforui, stops ). Records are staged in bulk and
+		compared to those stored in a single query. Returns the numbers 
+		of new stops and directions stored."""
+	# skip anything we have stored or seen stored already
+	with known_route_records_lock:
+		stops = [ s for s in set(stops) if ('stop',)+s not in known_route_records ]
+		directions = [ 
+			d for d in set( [ d[:6]+(tuple(d[6]),) for d in directions ] )
+			if ('direction',)+d not in known_route_records
+		]
+	if len(stops) == 0 and len(directions) == 0:
+		return ( 0, 0 )
+	with transaction() as c:
+		c.execute(
+			"""
+				CREATE TEMP TABLE IF NOT EXISTS staged_stops (
+					stop_id varchar, stop_name varchar, stop_code integer,
+					lon numeric, lat numeric
+				) ON COMMIT DELETE ROWS;
+				CREATE TEMP TABLE IF NOT EXISTS staged_directions (
+					route_id varchar, direction_id varchar, title varchar,
+					name varchar, branch varchar, useforui boolean, stops text[]
+				) ON COMMIT DELETE ROWS;
+			"""
+		)
+		if len(stops) > 0:
+			execute_values( c, "INSERT INTO staged_stops VALUES %s", stops, page_size=1000 )
+		if len(directions) > 0:
+			execute_values( 
+				c, "INSERT INTO staged_directions VALUES %s", 
+				[ d[:6]+(list(d[6]),) for d in directions ], page_size=1000 
+			)
+		c.execute(
+			"""
+				-- routes sharing stops may be stored at once, in any process
+				SELECT pg_advisory_xact_lock( hashtext('{stops}') );
+				WITH new_stops AS (
+					INSERT INTO {stops} ( 
+						stop_id, stop_name, stop_code, 
+						the_geom, 
+						lon, lat, 
+						report_time 
+					) 
+					SELECT 
+						s.stop_id, s.stop_name, s.stop_code, 
+						ST_Transform( ST_SetSRID( ST_MakePoint(s.lon, s.lat),4326),%(localEPSG)s ),
+						s.lon, s.lat, 
+						EXTRACT(EPOCH FROM NOW())
+					FROM staged_stops AS s
+					WHERE NOT EXISTS (
+						SELECT 1 FROM {stops} AS t
+						WHERE 
+							t.stop_id = s.stop_id AND
+							t.stop_name = s.stop_name AND
+							t.stop_code = s.stop_code AND
+							ABS(t.lon - s.lon) <= 0.0001 AND
+							ABS(t.lat - s.lat) <= 0.0001
+					)
+					RETURNING 1
+				), new_directions AS (
+					INSERT INTO {directions} ( 
+						route_id, direction_id, title, 
+						name, branch, useforui, 
+						stops, report_time
+					) 
+					SELECT 
+						d.route_id, d.direction_id, d.title,
+						d.name, d.branch, d.useforui,
+						d.stops, EXTRACT(EPOCH FROM NOW())
+					FROM staged_directions AS d
+					WHERE NOT EXISTS (
+						SELECT 1 FROM {directions} AS t
+						WHERE
+							t.route_id = d.route_id AND
+							t.direction_id = d.direction_id AND
+							t.title = d.title AND
+							t.name = d.name AND
+							t.branch = d.branch AND
+							t.useforui = d.useforui AND
+							t.stops = d.stops
+					)
+					RETURNING 1
+				)
+				SELECT 
+					( SELECT COUNT(*) FROM new_stops ),
+					( SELECT COUNT(*) FROM new_directions );
+			""".format(**conf['db']['tables']),
+			{ 'localEPSG':conf['localEPSG'] }
+		)
+		( new_stops, new_directions ) = c.fetchone()
+	# everything given is now stored
+	with known_route_records_lock:
+		known_route_records.update( [ ('stop',)+s for s in stops ] )
+		known_route_records.update( [ ('direction',)+d for d in directions ] )
+	return ( new_stops, new_directions )
+
+
+def scrub_trips(trip_ids):
+	"""Un-mark any flag fields and leave the DB records 
+		as though newly collected and unprocessed"""
+	with cursor() as c:
+		c.execute(
+			"""
+				UPDATE {trips} SET 
+					match_confidence = NULL,
+					match_geom = NULL,
+					clean_geom = NULL,
+					problem = '',
+					ignore = FALSE,
+					service_id = NULL,
+					updated = EXTRACT(EPOCH FROM NOW())
+				WHERE trip_id = ANY(%(trip_ids)s);
+
+				DELETE FROM {stop_times} 
+				WHERE trip_id = ANY(%(trip_ids)s);
+			""".format(**conf['db']['tables']),
+			{ 'trip_ids':list(trip_ids) }
+		)
+
+
+def get_trip_ids(min_id=None,max_id=None,route_id=None,start_time=None,end_time=None,status=None):
+	"""return a list of the ids of trips meeting all the given criteria:
+		a range of trip_ids, a route, a range of (epoch) start times, and
+		a processing status, one of 'unprocessed', 'processed' or 
+		'problem'."""
+	conditions = [ 'TRUE' ]
+	if min_id is not None:
+		conditions.append( 'trip_id >= %(min_id)s' )
+	if max_id is not None:
+		conditions.append( 'trip_id <= %(max_id)s' )
+	if route_id is not None:
+		conditions.append( 'route_id = %(route_id)s' )
+	if start_time is not None:
+		conditions.append( 'times[1] >= %(start_time)s' )
+	if end_time is not None:
+		conditions.append( 'times[1] < %(end_time)s' )
+	if status == 'unprocessed':
+		conditions.append( "service_id IS NULL AND COALESCE(problem,'') = ''" )
+	elif status == 'processed':
+		conditions.append( 'service_id IS NOT NULL' )
+	elif status == 'problem':
+		conditions.append( "COALESCE(problem,'') != ''" )
+	with cursor() as c:
+		c.execute(
+			"""
+				SELECT trip_id 
+				FROM {trips}
+				WHERE {conditions}
+				ORDER BY trip_id ASC
+			""".format( conditions=' AND '.join(conditions), **conf['db']['tables'] ),
+			{
+				'min_id':min_id,
+				'max_id':max_id,
+				'route_id':route_id,
+				'start_time':start_time,
+				'end_time':end_time
+			}
+		)
+		return [ result for (result,) in c.fetchall() ]
+
+
+def trip_exists(trip_id):
+	"""Check whether a trip exists in the database, 
+		returning boolean."""
+	with cursor() as c:
+		c.execute(
+			"""
+				SELECT EXISTS (SELECT * FROM {trips} WHERE trip_id = %(trip_id)s)
+			""".format(**conf['db']['tables']),
+			{ 'trip_id':trip_id }
+		)
+		(existence,) = c.fetchone()
+		return existence
+
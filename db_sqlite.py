@@ -0,0 +1,562 @@
+# storage backend keeping everything in a single SQLite file, for small
+# agencies, tests and benchmarks, with no database server. Use it
+# through db.py. Geometries are stored as WKB in the local projection,
+# as they are in PostGIS, but all spatial work is done here in Python.
+# Time arrays are stored as binary float64.
+
+import sqlite3, json, threading, time
+from contextlib import contextmanager
+from os import getpid, path, makedirs
+import numpy as np
+from shapely.geometry import Point
+from shapely.wkb import loads as loadWKB
+from conf import conf
+from geom import line_coords, project, unproject
+from stop_cache import stop_cache
+
+# one connection per process, shared by its threads
+connection = None
+pid = None		# process that opened the connection
+lock = threading.RLock()
+
+
+def reconnect():
+	"""renew the connection inside a process"""
+	global connection, pid
+	with lock:
+		filename = conf['db']['file']
+		directory = path.dirname(filename)
+		if directory and not path.exists(directory):
+			makedirs(directory)
+		# transactions are begun explicitly
+		connection = sqlite3.connect(
+			filename, timeout=30, check_same_thread=False, isolation_level=None
+		)
+		pid = getpid()
+		connection.execute('PRAGMA journal_mode=WAL')
+		connection.executescript(
+			"""
+				CREATE TABLE IF NOT EXISTS {trips} (
+					trip_id integer PRIMARY KEY,
+					orig_geom blob,
+					times blob,
+					start_time real, -- the first of the times
+					route_id text,
+					direction_id text,
+					service_id integer,
+					vehicle_id text,
+					block_id integer,
+					match_confidence real,
+					ignore integer DEFAULT 1,
+					match_geom blob,
+					clean_geom blob,
+					problem text DEFAULT '',
+					active integer DEFAULT 1,
+					updated real DEFAULT (strftime('%s','now'))
+				);
+				CREATE INDEX IF NOT EXISTS {trips}_start_time ON {trips} (start_time);
+				CREATE INDEX IF NOT EXISTS {trips}_service_id ON {trips} (service_id);
+				CREATE TABLE IF NOT EXISTS {stop_times} (
+					trip_id integer,
+					stop_id text,
+					stop_sequence integer,
+					etime real
+				);
+				CREATE INDEX IF NOT EXISTS {stop_times}_trip_id ON {stop_times} (trip_id);
+				CREATE TABLE IF NOT EXISTS {stops} (
+					stop_id text,
+					stop_name text,
+					stop_code integer,
+					the_geom blob,
+					lon real,
+					lat real,
+					report_time real
+				);
+				CREATE INDEX IF NOT EXISTS {stops}_stop_id ON {stops} (stop_id);
+				CREATE TABLE IF NOT EXISTS {directions} (
+					route_id text,
+					direction_id text,
+					title text,
+					name text,
+					branch text,
+					useforui integer,
+					stops text, -- JSON list of stop_ids
+					report_time real
+				);
+				CREATE INDEX IF NOT EXISTS {directions}_direction_id ON {directions} (direction_id);
+				-- the counters standing in for sequences
+				CREATE TABLE IF NOT EXISTS sequences (
+					name text PRIMARY KEY,
+					value integer
+				);
+			""".format(**conf['db']['tables'])
+		)
+
+
+@contextmanager
+def locked_cursor(write=True):
+	"""provide a cursor, with the statements made through it committed
+		together at the end or rolled back on error. Writes take the
+		file's write lock at once, so they never wait on each other
+		partway through."""
+	with lock:
+		if connection is None or pid != getpid():
+			reconnect()
+		c = connection.cursor()
+		c.execute( 'BEGIN IMMEDIATE' if write else 'BEGIN' )
+		try:
+			yield c
+		except:
+			connection.rollback()
+			raise
+		connection.commit()
+
+
+def geometry(value):
+	"""binary WKB from the hex (E)WKB strings made by trip objects"""
+	if value is None:
+		return None
+	return sqlite3.Binary( loadWKB(value,hex=True).wkb )
+
+
+def times_blob(times):
+	return sqlite3.Binary( np.asarray(times,dtype='<f8').tobytes() )
+
+
+def chunks(ids,size=500):
+	"""split ids into lists small enough to be query parameters"""
+	ids = list(ids)
+	return [ ids[i:i+size] for i in range(0,len(ids),size) ]
+
+
+def placeholders(values):
+	return ','.join( ['?']*len(values) )
+
+
+def get_trips(trip_ids):
+	"""Return the attributes of stored trips necessary for the
+		construction of new trip objects, as a dictionary keyed by
+		trip_id, with the vehicle positions and report times as numpy
+		arrays."""
+	result = {}
+	with locked_cursor(write=False) as c:
+		for ids in chunks(trip_ids):
+			c.execute(
+				"""
+					SELECT trip_id, block_id, direction_id, route_id, vehicle_id, orig_geom, times
+					FROM {trips} WHERE trip_id IN ({ids})
+				""".format( ids=placeholders(ids), **conf['db']['tables'] ),
+				ids
+			)
+			for (trip_id, bid, did, rid, vid, wkb, times) in c.fetchall():
+				lons, lats = unproject( *line_coords(wkb), epsg=conf['localEPSG'] )
+				result[trip_id] = {
+					'block_id':bid,
+					'direction_id':did,
+					'route_id':rid,
+					'vehicle_id':vid,
+					'lons':lons,
+					'lats':lats,
+					'times':np.frombuffer( bytes(times), dtype='<f8' ).astype(float)
+				}
+	return result
+
+
+def get_stop_times(trip_ids):
+	"""Return the stored stop times of the given trips as columns:
+		numpy arrays of trip_ids, stop_sequences and etimes and a list
+		of stop_ids, ordered by trip and sequence."""
+	rows = []
+	with locked_cursor(write=False) as c:
+		for ids in chunks(trip_ids):
+			c.execute(
+				"""
+					SELECT trip_id, stop_id, stop_sequence, etime
+					FROM {stop_times} WHERE trip_id IN ({ids})
+				""".format( ids=placeholders(ids), **conf['db']['tables'] ),
+				ids
+			)
+			rows.extend( c.fetchall() )
+	rows.sort( key=lambda r: (r[0],r[2]) )
+	return {
+		'trip_id':np.array( [ r[0] for r in rows ], dtype=np.int64 ),
+		'stop_id':[ r[1] for r in rows ],
+		'stop_sequence':np.array( [ r[2] for r in rows ], dtype=np.int32 ),
+		'etime':np.array( [ r[3] for r in rows ], dtype=float )
+	}
+
+
+def reserve_ids(sequence,n):
+	"""reserve n new ids from a sequence, returning them as a list"""
+	name = conf['db']['tables'][sequence]
+	with locked_cursor() as c:
+		c.execute( 'INSERT OR IGNORE INTO sequences VALUES (?,0)', (name,) )
+		( last, ) = c.execute( 'SELECT value FROM sequences WHERE name = ?', (name,) ).fetchone()
+		c.execute( 'UPDATE sequences SET value = ? WHERE name = ?', (last+n,name) )
+	return range( last+1, last+n+1 )
+
+
+def empty_tables():
+	"""clear the tables of any processing results
+		but NOT of original data from the API"""
+	with locked_cursor() as c:
+		c.execute( 'DELETE FROM {stop_times}'.format(**conf['db']['tables']) )
+		c.execute(
+			"""
+				UPDATE {trips} SET
+					service_id = NULL,
+					match_confidence = NULL,
+					ignore = 1,
+					clean_geom = NULL,
+					problem = NULL,
+					active = NULL,
+					match_geom = NULL,
+					updated = ?
+			""".format(**conf['db']['tables']),
+			(time.time(),)
+		)
+
+
+def ignore_trip(trip_id,reason=None):
+	"""mark a trip to be ignored"""
+	with locked_cursor() as c:
+		c.execute(
+			'UPDATE {trips} SET ignore = 1, updated = ? WHERE trip_id = ?'.format(**conf['db']['tables']),
+			(time.time(),trip_id)
+		)
+		c.execute( 'DELETE FROM {stop_times} WHERE trip_id = ?'.format(**conf['db']['tables']), (trip_id,) )
+	if reason:
+		flag_trip(trip_id,reason)
+
+
+def flag_trip(trip_id,problem_description_string):
+	"""Populate the 'problem' field of trip table: something must
+		have gone wrong and this tells us what."""
+	with locked_cursor() as c:
+		c.execute(
+			'UPDATE {trips} SET problem = problem || ? WHERE trip_id = ?'.format(**conf['db']['tables']),
+			(problem_description_string,trip_id)
+		)
+
+
+def add_trip_match(trip_id,confidence,wkb_geometry_match):
+	"""update the trip record with it's matched geometry"""
+	with locked_cursor() as c:
+		c.execute(
+			'UPDATE {trips} SET match_confidence = ?, match_geom = ? WHERE trip_id = ?'.format(**conf['db']['tables']),
+			(confidence,geometry(wkb_geometry_match),trip_id)
+		)
+
+
+def trip_row(trip_id,block_id,route_id,direction_id,vehicle_id,times,orig_geom):
+	return (
+		trip_id, block_id, route_id, direction_id, vehicle_id,
+		times_blob(times), times[0] if len(times) > 0 else None, geometry(orig_geom)
+	)
+
+
+def insert_rows(c,rows):
+	c.executemany(
+		"""
+			INSERT INTO {trips} (
+				trip_id, block_id, route_id, direction_id,
+				vehicle_id, times, start_time, orig_geom
+			) VALUES (?,?,?,?,?,?,?,?)
+		""".format(**conf['db']['tables']),
+		rows
+	)
+
+
+def insert_trip(trip_id,block_id,route_id,direction_id,vehicle_id,times,orig_geom):
+	"""Store the basics of the trip in the database."""
+	with locked_cursor() as c:
+		insert_rows( c, [ trip_row(trip_id,block_id,route_id,direction_id,vehicle_id,times,orig_geom) ] )
+
+
+def copy_trips(records):
+	"""Store the basics of many trips at once. Records are tuples of
+		( trip_id, block_id, route_id, direction_id, vehicle_id, times,
+		orig_geom ) where orig_geom is hex EWKB."""
+	rows = [ trip_row(*record) for record in records ]
+	with locked_cursor() as c:
+		insert_rows(c,rows)
+
+
+# stops are cached separately in each process
+stops_cache = stop_cache(
+	conf['stop_cache']['size'],
+	conf['stop_cache']['ttl']
+)
+
+
+def get_stops(direction_id,trip_time):
+	"""given the direction id, and the time of the trip, get a list of stops and
+		their attributes from the schedule data, returning as a list of
+		dictionaries with the stop_id and a (parsed) geometry, in the order
+		they are served. The versions of the direction and stops are
+		chosen as in db_postgres.get_stops. The list is shared between
+		calls, so must not be modified."""
+	stops = stops_cache.get(direction_id,trip_time)
+	if stops is not None:
+		return stops
+	with locked_cursor(write=False) as c:
+		versions = c.execute(
+			"""
+				SELECT stops, report_time FROM {directions}
+				WHERE direction_id = ? ORDER BY report_time
+			""".format(**conf['db']['tables']),
+			(direction_id,)
+		).fetchall()
+		# the last reported version of the direction, from the
+		# perspective of this trip, and when it was superseded
+		current = [ i for i, (s, t) in enumerate(versions) if t <= trip_time ]
+		if len(current) == 0:
+			# with no version of the direction yet, there is nothing to cache
+			return []
+		i = current[-1]
+		d_time = versions[i][1]
+		d_next = versions[i+1][1] if i+1 < len(versions) else None
+		stop_ids = []
+		for stop_id in json.loads(versions[i][0]):
+			if stop_id not in stop_ids:
+				stop_ids.append(stop_id)
+		# every version of each of its stops
+		stop_versions = {}
+		for ids in chunks(stop_ids):
+			c.execute(
+				"""
+					SELECT stop_id, the_geom, report_time FROM {stops}
+					WHERE stop_id IN ({ids}) ORDER BY report_time
+				""".format( ids=placeholders(ids), **conf['db']['tables'] ),
+				ids
+			)
+			for stop_id, geom, report_time in c.fetchall():
+				stop_versions.setdefault(stop_id,[]).append( (geom,report_time) )
+	stops = []
+	# the stops are valid from the latest of the versions used
+	# until the earliest time any of them was superseded
+	valid_from, valid_until = d_time, d_next
+	for stop_id in stop_ids:
+		versions = stop_versions.get(stop_id,[])
+		if len(versions) == 0:
+			continue
+		current = [ j for j, (g, t) in enumerate(versions) if t <= trip_time ]
+		if len(current) == 0:
+			# this stop is not reported until later
+			s_next = versions[0][1]
+			valid_until = s_next if valid_until is None else min(valid_until,s_next)
+			continue
+		j = current[-1]
+		valid_from = max( valid_from, versions[j][1] )
+		if j+1 < len(versions):
+			s_next = versions[j+1][1]
+			valid_until = s_next if valid_until is None else min(valid_until,s_next)
+		stops.append({
+			'id':stop_id,
+			'geom':loadWKB( bytes(versions[j][0]) )
+		})
+	stops_cache.put(direction_id,valid_from,valid_until,stops)
+	return stops
+
+
+def get_stop_cache_stats():
+	"""return the hits and misses of this process's stop cache"""
+	return stops_cache.get_stats()
+
+
+def set_trip_clean_geom(trip_id,localWKBgeom):
+	"""Store a geometry of the input to the matching process"""
+	with locked_cursor() as c:
+		c.execute(
+			'UPDATE {trips} SET clean_geom = ? WHERE trip_id = ?'.format(**conf['db']['tables']),
+			(geometry(localWKBgeom),trip_id)
+		)
+
+
+def store_timepoints(trip_id,timepoints):
+	"""store the estimated stop times for a trip"""
+	with locked_cursor() as c:
+		insert_timepoints(c,trip_id,timepoints)
+
+
+def insert_timepoints(c,trip_id,timepoints):
+	"""insert the stop times for a trip using the given cursor"""
+	c.executemany(
+		'INSERT INTO {stop_times} (trip_id, stop_id, etime, stop_sequence) VALUES (?,?,?,?)'.format(**conf['db']['tables']),
+		[
+			(trip_id,timepoint['stop_id'],timepoint['time'],seq)
+			for seq, timepoint in enumerate(timepoints,1)
+		]
+	)
+
+
+def store_trip_result(trip_id,clean_geom=None,confidence=None,match_geom=None,
+	service_id=None,timepoints=(),ignore=False,problem=""):
+	"""Store everything that came of processing a trip in one transaction:
+		a single update of the trip record, replacing any stop times.
+		Geometries are WKB strings in the local projection. A problem
+		description is appended to any already recorded."""
+	with locked_cursor() as c:
+		c.execute(
+			"""
+				UPDATE {trips} SET
+					clean_geom = ?,
+					match_confidence = ?,
+					match_geom = ?,
+					service_id = ?,
+					ignore = ignore OR ?,
+					problem = problem || ?,
+					updated = ?
+				WHERE trip_id = ?
+			""".format(**conf['db']['tables']),
+			(
+				geometry(clean_geom), confidence, geometry(match_geom),
+				service_id, ignore, problem, time.time(), trip_id
+			)
+		)
+		c.execute( 'DELETE FROM {stop_times} WHERE trip_id = ?'.format(**conf['db']['tables']), (trip_id,) )
+		if len(timepoints) > 0 and not ignore:
+			insert_timepoints(c,trip_id,timepoints)
+
+
+def set_service_id(trip_id,service_id):
+	"""set the service_id of a trip"""
+	with locked_cursor() as c:
+		c.execute(
+			'UPDATE {trips} SET service_id = ?, updated = ? WHERE trip_id = ?'.format(**conf['db']['tables']),
+			(service_id,time.time(),trip_id)
+		)
+
+
+# route records (stops and directions) known to be stored already
+known_route_records = set()
+known_route_records_lock = threading.Lock()
+
+def store_route_config(stops,directions):
+	"""we have received a report of a route's stops and directions from
+		the routeConfig data. Store any records that are new, with the
+		current time, ignoring those where absolutely nothing has changed.
+		stops are tuples of ( stop_id, stop_name, stop_code, lon, lat )
+		and directions are tuples of ( route_id, direction_id, title,
+		name, branch, useforui, stops ). Returns the numbers of new stops
+		and directions stored."""
+	# skip anything we have stored or seen stored already
+	with known_route_records_lock:
+		stops = [ s for s in set(stops) if ('stop',)+s not in known_route_records ]
+		directions = [
+			d for d in set( [ d[:6]+(tuple(d[6]),) for d in directions ] )
+			if ('direction',)+d not in known_route_records
+		]
+	if len(stops) == 0 and len(directions) == 0:
+		return ( 0, 0 )
+	report_time = time.time()
+	# the stop geometries, projected all at once
+	xs, ys = project(
+		[ float(s[3]) for s in stops ], [ float(s[4]) for s in stops ], conf['localEPSG']
+	) if len(stops) > 0 else ( [], [] )
+	new_stops, new_directions = 0, 0
+	with locked_cursor() as c:
+		for (stop_id, name, code, lon, lat), x, y in zip(stops,xs,ys):
+			c.execute(
+				"""
+					SELECT 1 FROM {stops}
+					WHERE stop_id = ? AND stop_name IS ? AND stop_code IS ? AND
+						ABS(lon - ?) <= 0.0001 AND ABS(lat - ?) <= 0.0001
+				""".format(**conf['db']['tables']),
+				(stop_id,name,code,float(lon),float(lat))
+			)
+			if c.fetchone() is None:
+				c.execute(
+					'INSERT INTO {stops} VALUES (?,?,?,?,?,?,?)'.format(**conf['db']['tables']),
+					(
+						stop_id, name, code, sqlite3.Binary( Point(x,y).wkb ),
+						float(lon), float(lat), report_time
+					)
+				)
+				new_stops += 1
+		for (route_id, direction_id, title, name, branch, useforui, stop_ids) in directions:
+			values = ( route_id, direction_id, title, name, branch, useforui, json.dumps(list(stop_ids)) )
+			c.execute(
+				"""
+					SELECT 1 FROM {directions}
+					WHERE route_id IS ? AND direction_id IS ? AND title IS ? AND
+						name IS ? AND branch IS ? AND useforui IS ? AND stops IS ?
+				""".format(**conf['db']['tables']),
+				values
+			)
+			if c.fetchone() is None:
+				c.execute(
+					'INSERT INTO {directions} VALUES (?,?,?,?,?,?,?,?)'.format(**conf['db']['tables']),
+					values + (report_time,)
+				)
+				new_directions += 1
+	# everything given is now stored
+	with known_route_records_lock:
+		known_route_records.update( [ ('stop',)+s for s in stops ] )
+		known_route_records.update( [ ('direction',)+d for d in directions ] )
+	return ( new_stops, new_directions )
+
+
+def scrub_trips(trip_ids):
+	"""Un-mark any flag fields and leave the DB records
+		as though newly collected and unprocessed"""
+	with locked_cursor() as c:
+		for ids in chunks(trip_ids):
+			c.execute(
+				"""
+					UPDATE {trips} SET
+						match_confidence = NULL,
+						match_geom = NULL,
+						clean_geom = NULL,
+						problem = '',
+						ignore = 0,
+						service_id = NULL,
+						updated = ?
+					WHERE trip_id IN ({ids})
+				""".format( ids=placeholders(ids), **conf['db']['tables'] ),
+				[ time.time() ] + ids
+			)
+			c.execute(
+				'DELETE FROM {stop_times} WHERE trip_id IN ({ids})'.format( ids=placeholders(ids), **conf['db']['tables'] ),
+				ids
+			)
+
+
+def get_trip_ids(min_id=None,max_id=None,route_id=None,start_time=None,end_time=None,status=None):
+	"""return a list of the ids of trips meeting all the given criteria:
+		a range of trip_ids, a route, a range of (epoch) start times, and
+		a processing status, one of 'unprocessed', 'processed' or
+		'problem'."""
+	conditions, values = [ '1' ], []
+	for condition, value in (
+		( 'trip_id >= ?', min_id ),
+		( 'trip_id <= ?', max_id ),
+		( 'route_id = ?', route_id ),
+		( 'start_time >= ?', start_time ),
+		( 'start_time < ?', end_time )
+	):
+		if value is not None:
+			conditions.append(condition)
+			values.append(value)
+	if status == 'unprocessed':
+		conditions.append( "service_id IS NULL AND COALESCE(problem,'') = ''" )
+	elif status == 'processed':
+		conditions.append( 'service_id IS NOT NULL' )
+	elif status == 'problem':
+		conditions.append( "COALESCE(problem,'') != ''" )
+	with locked_cursor(write=False) as c:
+		c.execute(
+			'SELECT trip_id FROM {trips} WHERE {conditions} ORDER BY trip_id ASC'.format(
+				conditions=' AND '.join(conditions), **conf['db']['tables']
+			),
+			values
+		)
+		return [ result for (result,) in c.fetchall() ]
+
+
+def trip_exists(trip_id):
+	"""Check whether a trip exists in the database,
+		returning boolean."""
+	with locked_cursor(write=False) as c:
+		c.execute( 'SELECT 1 FROM {trips} WHERE trip_id = ?'.format(**conf['db']['tables']), (trip_id,) )
+		return c.fetchone() is not None
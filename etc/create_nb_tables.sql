@@ -62,9 +62,15 @@ CREATE TABLE ttc_trips (
 	match_geom geometry(MULTILINESTRING,26917), -- map-matched route geometry
 	clean_geom geometry(LINESTRING,26917), -- geometry of points used in map matching
 	problem varchar DEFAULT '', -- description of any problems that arise
-	active boolean DEFAULT TRUE -- debugging flag
+	active boolean DEFAULT TRUE, -- debugging flag
+	-- epoch time of the last change to the trip's processing results, 
+	-- so that export.py can tell which service days have changed. 
+	-- To add it to an existing table: 
+	-- ALTER TABLE ttc_trips ADD COLUMN updated double precision DEFAULT EXTRACT(EPOCH FROM NOW());
+	updated double precision DEFAULT EXTRACT(EPOCH FROM NOW())
 );
 CREATE INDEX ON ttc_trips (trip_id);
+CREATE INDEX ON ttc_trips (service_id);
 
 /*
 	Where interpolated stop times are stored for each trip. 
@@ -77,3 +83,15 @@ CREATE TABLE ttc_stop_times(
 	etime double precision -- non-localized epoch time in seconds
 );
 CREATE INDEX ON ttc_stop_times (trip_id);
+
+/*
+	New trip and block IDs are drawn from these sequences, so that 
+	any number of collectors can assign them at once. To add them to 
+	existing tables, create them and then continue from the highest IDs:
+	SELECT setval('ttc_trip_ids', (SELECT MAX(trip_id) FROM ttc_trips));
+	SELECT setval('ttc_block_ids', (SELECT MAX(block_id) FROM ttc_trips));
+*/
+DROP SEQUENCE IF EXISTS ttc_trip_ids;
+CREATE SEQUENCE ttc_trip_ids;
+DROP SEQUENCE IF EXISTS ttc_block_ids;
+CREATE SEQUENCE ttc_block_ids;
@@ -0,0 +1,441 @@
+# call this file to export processed trips as a zipped GTFS feed, e.g.
+# python export.py output/ttc.zip [--start 2017-10-01] [--end 2017-11-01] [--route 504 505]
+# Dates are local service days, the end being exclusive. Each file is
+# streamed from the database with COPY, so no table is ever held in
+# memory. Files are built one service day at a time and these fragments
+# are kept (in conf['export']['cache']) along with a manifest of the
+# state of each day's trips. Only days whose trips have changed since
+# the last export are rebuilt; the feed is then assembled from the
+# fragments. Trips following the same path share a shape (see shapes.py).
+# This needs the PostgreSQL storage backend (conf['db']['backend']).
+
+import argparse, time, calendar, zipfile, tempfile, hashlib, json, shutil, csv, sys
+from os import path, makedirs, remove, close, rename
+from conf import conf
+
+# (checked before psycopg2 is imported, as it needn't be installed)
+if conf['db'].get('backend','postgres') != 'postgres':
+	sys.exit(
+		'export.py needs the PostgreSQL storage backend, but the '+
+		str(conf['db']['backend'])+' backend is configured'
+	)
+
+from psycopg2.extras import execute_values
+import db
+from geom import line_coords
+from shapes import shape_registry
+
+
+class fragment_writer(object):
+	"""file-like wrapper counting and hashing what is written through it"""
+
+	def __init__(self,target):
+		self.target = target
+		self.lines = 0
+		self.hash = hashlib.sha1()
+
+	def write(self,data):
+		self.lines += data.count('\n')
+		self.hash.update(data)
+		self.target.write(data)
+
+
+# The GTFS files, built for a service day at a time as queries over
+# the exported trips (export_trips). Each fragment has a header line.
+day_queries = [
+	( 'calendar_dates.txt',
+		"""
+			SELECT
+				%(service_id)s AS service_id,
+				to_char(TIMESTAMP 'EPOCH' + (%(service_id)s * INTERVAL '1 day'),'YYYYMMDD') AS date,
+				1 AS exception_type
+		"""
+	),
+	( 'routes.txt',
+		"""
+			SELECT
+				DISTINCT
+					route_id,
+					1 AS agency_id, -- all the same agency
+					route_id::varchar AS route_short_name,
+					'' AS route_long_name,
+					3 AS route_type -- they are all bus for now
+			FROM export_trips
+			WHERE service_id = %(service_id)s
+			ORDER BY route_id
+		"""
+	),
+	( 'trips.txt',
+		"""
+			SELECT
+				t.route_id::varchar,
+				t.service_id,
+				t.trip_id,
+				t.block_id,
+				s.shape_id
+			FROM export_trips AS t LEFT JOIN export_shapes AS s ON s.trip_id = t.trip_id
+			WHERE t.service_id = %(service_id)s
+			ORDER BY t.trip_id
+		"""
+	),
+	( 'stop_times.txt',
+		"""
+			SELECT
+				t.trip_id,
+				-- seconds since the start of the (local) service day
+				to_char( local_seconds / 3600, 'fm00' ) ||':'||
+				to_char( local_seconds %% 3600 / 60, 'fm00' ) ||':'||
+				to_char( local_seconds %% 60, 'fm00' ) AS arrival_time,
+				to_char( local_seconds / 3600, 'fm00' ) ||':'||
+				to_char( local_seconds %% 3600 / 60, 'fm00' ) ||':'||
+				to_char( local_seconds %% 60, 'fm00' ) AS departure_time,
+				stop_id,
+				stop_sequence
+			FROM (
+				SELECT
+					st.trip_id, st.stop_id, st.stop_sequence,
+					(st.etime + %(offset)s - t.service_id*86400)::int AS local_seconds
+				FROM {stop_times} AS st JOIN export_trips AS t ON st.trip_id = t.trip_id
+				WHERE t.service_id = %(service_id)s
+			) AS t
+			ORDER BY trip_id, stop_sequence ASC
+		"""
+	),
+	# not a GTFS file; the shapes followed that day, and by how many trips
+	( 'shape_ids',
+		"""
+			SELECT s.shape_id, COUNT(*) AS trips
+			FROM export_shapes AS s JOIN export_trips AS t ON s.trip_id = t.trip_id
+			WHERE t.service_id = %(service_id)s AND s.shape_id IS NOT NULL
+			GROUP BY s.shape_id
+		"""
+	),
+	# not a GTFS file; the stops served that day
+	( 'stop_ids',
+		"""
+			SELECT DISTINCT st.stop_id
+			FROM {stop_times} AS st JOIN export_trips AS t ON st.trip_id = t.trip_id
+			WHERE t.service_id = %(service_id)s
+		"""
+	)
+]
+
+# files with rows repeated from day to day, which appear once in the feed
+distinct_files = [ 'routes.txt' ]
+
+# stops are few, so are always exported afresh, the latest version of each
+stops_query = """
+	SELECT DISTINCT ON (stop_id)
+		stop_id,
+		stop_code::varchar,
+		stop_name,
+		lat AS stop_lat,
+		lon AS stop_lon
+	FROM {stops}
+	WHERE stop_id = ANY(%(stop_ids)s)
+	ORDER BY stop_id, report_time DESC
+"""
+
+
+def parse_args():
+	parser = argparse.ArgumentParser(description='Export processed trips as GTFS.')
+	parser.add_argument('feed',help='zip file to write')
+	parser.add_argument('--start',help='first (local) service day to export, as YYYY-MM-DD')
+	parser.add_argument('--end',help='(local) service day to stop before, as YYYY-MM-DD')
+	parser.add_argument('--route',nargs='+',help='route_ids to export')
+	parser.add_argument('--rebuild',action='store_true',help='rebuild every service day')
+	return parser.parse_args()
+
+
+def service_id(date):
+	"""the service_id (local "epoch day") of a YYYY-MM-DD date"""
+	return calendar.timegm( time.strptime(date,'%Y-%m-%d') ) // (24*3600)
+
+
+def in_range(sid,args):
+	"""is the service day in the range being exported?"""
+	if args.start and sid < service_id(args.start):
+		return False
+	if args.end and sid >= service_id(args.end):
+		return False
+	return True
+
+
+def cache_directory(args):
+	"""fragments of different selections of routes are kept apart"""
+	selection = 'routes-'+'_'.join(sorted(args.route)) if args.route else 'all'
+	return path.join( conf['export']['cache'], conf['agency'], selection )
+
+
+def fragment(directory,sid,filename):
+	return path.join( directory, str(sid), filename+'.csv' )
+
+
+def read_manifest(directory):
+	"""return the manifest of cached days, keyed by service_id"""
+	filename = path.join(directory,'manifest.json')
+	if not path.exists(filename):
+		return {}
+	with open(filename) as f:
+		return dict( (int(sid),day) for sid,day in json.load(f).items() )
+
+
+def write_manifest(directory,manifest):
+	# replaced all at once, so it never describes half-written fragments
+	filename = path.join(directory,'manifest.json')
+	with open(filename+'.tmp','w') as f:
+		json.dump( manifest, f, indent=1, sort_keys=True )
+	rename(filename+'.tmp',filename)
+
+
+def is_cached(directory,sid,day,state):
+	"""is the cached day still current, and are its fragments intact?"""
+	if day['state'] != state:
+		return False
+	for filename, query in day_queries:
+		name = fragment(directory,sid,filename)
+		if filename not in day['files'] or not path.exists(name):
+			return False
+		if path.getsize(name) != day['files'][filename]['bytes']:
+			return False
+	return True
+
+
+def select_trips(c,args,service_ids=None):
+	"""make a temporary table of the trips to export, optionally only
+		from certain service days"""
+	conditions = [ 'NOT ignore', 'service_id IS NOT NULL' ]
+	if args.start:
+		conditions.append( 'service_id >= %(start)s' )
+	if args.end:
+		conditions.append( 'service_id < %(end)s' )
+	if args.route:
+		conditions.append( 'route_id IN %(routes)s' )
+	if service_ids is not None:
+		conditions.append( 'service_id = ANY(%(service_ids)s)' )
+	c.execute(
+		"""
+			DROP TABLE IF EXISTS export_trips;
+			CREATE TEMP TABLE export_trips ON COMMIT DROP AS
+			SELECT trip_id, route_id, service_id, block_id, updated
+			FROM {trips}
+			WHERE {conditions};
+			CREATE INDEX ON export_trips (service_id);
+			CREATE INDEX ON export_trips (trip_id);
+			ANALYZE export_trips;
+		""".format( conditions=' AND '.join(conditions), **conf['db']['tables'] ),
+		{
+			'start':service_id(args.start) if args.start else None,
+			'end':service_id(args.end) if args.end else None,
+			'routes':tuple(args.route) if args.route else None,
+			'service_ids':service_ids
+		}
+	)
+
+
+def day_states(c,args):
+	"""return the state of the trips of each service day: how many
+		there are, the sum of their ids and when the last was changed"""
+	select_trips(c,args)
+	c.execute(
+		"""
+			SELECT service_id, COUNT(*), SUM(trip_id), MAX(updated)
+			FROM export_trips
+			GROUP BY service_id
+		"""
+	)
+	return dict(
+		( sid, [ count, int(id_sum), float(updated or 0) ] )
+		for (sid, count, id_sum, updated) in c.fetchall()
+	)
+
+
+def copy(c,query,params,target):
+	"""stream the result of a query as CSV, with a header, into a file"""
+	sql = c.mogrify( query.format(**conf['db']['tables']), params )
+	c.copy_expert( 'COPY ('+sql+') TO STDOUT WITH CSV HEADER', target )
+
+
+def assign_shapes(c,registry,sid):
+	"""record the shared shape followed by each trip of a service day
+		in export_shapes"""
+	c.execute(
+		"""
+			SELECT
+				t.trip_id,
+				t.route_id,
+				t.direction_id,
+				-- this simply fills in the gaps in multilines
+				ST_AsBinary( ST_MakeLine( ARRAY(
+					SELECT d.geom
+					FROM ST_DumpPoints(ST_Simplify(t.match_geom,10)) AS d
+					ORDER BY d.path
+				) ) )
+			FROM {trips} AS t JOIN export_trips AS e ON t.trip_id = e.trip_id
+			WHERE e.service_id = %(service_id)s AND t.match_geom IS NOT NULL
+		""".format(**conf['db']['tables']),
+		{ 'service_id':sid }
+	)
+	assigned = []
+	for trip_id, route_id, direction_id, wkb in c.fetchall():
+		shape_id = registry.assign( route_id, direction_id, *line_coords(wkb) ) if wkb else None
+		assigned.append( (trip_id, shape_id) )
+	execute_values( c, 'INSERT INTO export_shapes (trip_id, shape_id) VALUES %s', assigned )
+
+
+def read_fragments(directory,service_ids,name):
+	"""yield the rows, less headers, of a file's fragments"""
+	for sid in service_ids:
+		with open(fragment(directory,sid,name),'rb') as f:
+			rows = csv.reader(f)
+			rows.next() # the header
+			for row in rows:
+				yield row
+
+
+def build_day(c,directory,sid):
+	"""write the fragments of one service day, returning their manifest"""
+	day_directory = path.join(directory,str(sid))
+	if path.exists(day_directory):
+		shutil.rmtree(day_directory)
+	makedirs(day_directory)
+	files = {}
+	for filename, query in day_queries:
+		name = fragment(directory,sid,filename)
+		with open(name,'wb') as f:
+			target = fragment_writer(f)
+			copy( c, query, { 'service_id':sid, 'offset':conf['timezone']*3600 }, target )
+		files[filename] = {
+			'rows':target.lines - 1, # not the header
+			'bytes':path.getsize(name),
+			'sha1':target.hash.hexdigest()
+		}
+	return files
+
+
+def add_to_feed(feed,filename,write):
+	"""add a file to the feed, written by a function given a file object"""
+	handle, temp_name = tempfile.mkstemp(suffix='_'+filename)
+	close(handle)
+	try:
+		with open(temp_name,'wb') as f:
+			result = write(f)
+		feed.write(temp_name,filename)
+	finally:
+		remove(temp_name)
+	return result
+
+
+def assemble(out,directory,service_ids,filename):
+	"""write a file from the fragments of each day, with the header of
+		the first. Returns the number of rows written."""
+	rows = 0
+	seen = set()
+	for i, sid in enumerate(service_ids):
+		with open(fragment(directory,sid,filename),'rb') as f:
+			header = f.readline()
+			if i == 0:
+				out.write(header)
+			for line in f:
+				if filename in distinct_files:
+					if line in seen:
+						continue
+					seen.add(line)
+				out.write(line)
+				rows += 1
+	return rows
+
+
+def main():
+	args = parse_args()
+	start = time.time()
+	directory = cache_directory(args)
+	if not path.exists(directory):
+		makedirs(directory)
+	manifest = {} if args.rebuild else read_manifest(directory)
+	registry = shape_registry(
+		path.join(directory,'shapes.json'), conf['export']['shape_tolerance']
+	)
+	if not registry.load():
+		# cached days refer to shapes that are gone
+		manifest = {}
+	if path.dirname(args.feed) and not path.exists(path.dirname(args.feed)):
+		makedirs(path.dirname(args.feed))
+	feed = zipfile.ZipFile(args.feed,'w',zipfile.ZIP_DEFLATED,allowZip64=True)
+	# one snapshot, so that all files agree with each other
+	with db.transaction() as c:
+		c.execute('SET TRANSACTION ISOLATION LEVEL REPEATABLE READ')
+		states = day_states(c,args)
+		service_ids = sorted(states)
+		changed = [
+			sid for sid in service_ids
+			if sid not in manifest or not is_cached(directory,sid,manifest[sid],states[sid])
+		]
+		print len(service_ids),'service days to export,',len(changed),'of them changed'
+		if len(changed) > 0:
+			select_trips(c,args,changed)
+			c.execute(
+				"""
+					CREATE TEMP TABLE export_shapes (
+						trip_id integer PRIMARY KEY,
+						shape_id varchar
+					) ON COMMIT DROP
+				"""
+			)
+			build_start = time.time()
+			for sid in changed:
+				assign_shapes(c,registry,sid)
+				files = build_day(c,directory,sid)
+				# keep what has been built so far, in case we stop
+				registry.save()
+				manifest[sid] = { 'state':states[sid], 'files':files }
+				write_manifest(directory,manifest)
+			seconds = max( time.time() - build_start, 0.001 )
+			print '\trebuilt %d days in %.1f s' % ( len(changed), seconds )
+			for filename, query in day_queries:
+				rows = sum( [ manifest[sid]['files'][filename]['rows'] for sid in changed ] )
+				print '\t\t%s: %d rows (%.0f rows/s)' % ( filename, rows, rows/seconds )
+			stats = registry.get_stats()
+			print '\t%d trips given shapes: %d by hash, %d by search, %d new shapes (%d comparisons)' % (
+				stats['trips'], stats['hashed'], stats['searched'], stats['new'], stats['comparisons']
+			)
+		# the stops served on any of the days
+		stop_ids = set( [ row[0] for row in read_fragments(directory,service_ids,'stop_ids') ] )
+		rows = add_to_feed( feed, 'stops.txt', lambda f:
+			copy( c, stops_query, { 'stop_ids':sorted(stop_ids) }, fragment_writer(f) )
+		)
+		print '\tstops.txt:',len(stop_ids),'stops'
+	# the shapes followed on any of the days, and by how many trips
+	shape_trips = {}
+	for shape_id, trips in read_fragments(directory,service_ids,'shape_ids'):
+		shape_trips[shape_id] = shape_trips.get(shape_id,0) + int(trips)
+	points = add_to_feed( feed, 'shapes.txt', lambda f:
+		registry.write( f, shape_trips.keys(), conf['localEPSG'] )
+	)
+	# the points there would be with one shape per trip
+	unshared = sum( [ trips * len(registry.shapes[shape_id][0]) for shape_id, trips in shape_trips.items() ] )
+	print '\tshapes.txt: %d shapes for %d trips, %d points rather than %d (%.1fx smaller)' % (
+		len(shape_trips), sum(shape_trips.values()), points, unshared, float(unshared)/max(points,1)
+	)
+	# the rest of the feed is put together from the cached days
+	for filename, query in day_queries:
+		if not filename.endswith('.txt'):
+			continue
+		file_start = time.time()
+		rows = add_to_feed( feed, filename, lambda f:
+			assemble( f, directory, service_ids, filename )
+		)
+		seconds = max( time.time() - file_start, 0.001 )
+		print '\t%s: %d rows assembled in %.1f s (%.0f rows/s)' % ( filename, rows, seconds, rows/seconds )
+	feed.close()
+	# forget days in the range that no longer have any trips
+	for sid in set(manifest) - set(states):
+		if in_range(sid,args):
+			shutil.rmtree( path.join(directory,str(sid)), ignore_errors=True )
+			del manifest[sid]
+	write_manifest(directory,manifest)
+	print 'exported',args.feed,'in %.1f s' % (time.time()-start)
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,70 @@
+# Recording of raw responses from the nextbus API so that they can be
+# replayed later (see replay.py). Each archive file holds the responses
+# of one (UTC) day. Every record is a header line giving the request
+# time, the response time and the length of the zlib-compressed body
+# which follows it.
+
+import zlib, time, threading
+from os import path, makedirs
+
+
+class tee(object):
+	"""file-like wrapper keeping a copy of everything read from a source"""
+
+	def __init__(self,source):
+		self.source = source
+		self.chunks = []
+
+	def read(self,size=-1):
+		data = self.source.read(size)
+		self.chunks.append(data)
+		return data
+
+	def getvalue(self):
+		return ''.join(self.chunks)
+
+
+class recorder(object):
+	"""Appends responses to daily archive files in a directory"""
+
+	def __init__(self,directory,prefix='vehicleLocations'):
+		self.directory = directory
+		self.prefix = prefix
+		self.lock = threading.Lock()
+		if not path.exists(directory):
+			makedirs(directory)
+
+
+	def filename(self,request_time):
+		"""the archive file for responses to requests made at this time"""
+		return path.join(
+			self.directory,
+			self.prefix + time.strftime('-%Y%m%d.rec',time.gmtime(request_time))
+		)
+
+
+	def record(self,request_time,response_time,body):
+		"""store the raw (decompressed) body of a response"""
+		compressed = zlib.compress(body)
+		header = '%.6f %.6f %d\n' % (request_time,response_time,len(compressed))
+		with self.lock:
+			with open(self.filename(request_time),'ab') as f:
+				f.write(header)
+				f.write(compressed)
+
+
+def read_archive(filename):
+	"""yield ( request_time, response_time, body ) for each response
+		recorded in an archive file, in the order they were recorded"""
+	with open(filename,'rb') as f:
+		while True:
+			header = f.readline()
+			if header == '':
+				return
+			request_time, response_time, length = header.split()
+			compressed = f.read( int(length) )
+			# a partly written record at the end of the file
+			if len(compressed) < int(length):
+				return
+			yield ( float(request_time), float(response_time), zlib.decompress(compressed) )
+
@@ -1,6 +1,58 @@
 # custom shapely geometry functions
 from shapely.geometry import Point, LineString, MultiLineString
-from math import sqrt
+from shapely.ops import transform
+from math import sqrt, floor
+import numpy as np
+import pyproj
+
+# pyproj Transformers from lon-lat, by EPSG code of the target projection
+transformers = {}
+
+def transformer(epsg):
+	"""return a (cached) Transformer from lon-lat to the given projection"""
+	if epsg not in transformers:
+		transformers[epsg] = pyproj.Transformer.from_crs(4326, epsg, always_xy=True)
+	return transformers[epsg]
+
+
+def project(lons, lats, epsg):
+	"""project arrays of lon-lat coordinates into the given projection 
+		all at once, returning arrays of x and y"""
+	x, y = transformer(epsg).transform(
+		np.asarray(lons,dtype=float), np.asarray(lats,dtype=float)
+	)
+	return ( np.asarray(x), np.asarray(y) )
+
+
+# pyproj Transformers back to lon-lat, by EPSG code of the projection
+unprojectors = {}
+
+def unproject(x, y, epsg):
+	"""transform arrays of coordinates in the given projection back to
+		lon-lat all at once, returning arrays of lons and lats"""
+	if epsg not in unprojectors:
+		unprojectors[epsg] = pyproj.Transformer.from_crs(epsg, 4326, always_xy=True)
+	lons, lats = unprojectors[epsg].transform(
+		np.asarray(x,dtype=float), np.asarray(y,dtype=float)
+	)
+	return ( np.asarray(lons), np.asarray(lats) )
+
+
+def line_coords(wkb):
+	"""decode the (2D, binary) WKB of a linestring straight into
+		arrays of x and y, without building a geometry"""
+	wkb = bytes(wkb)
+	# first byte gives the byte order: 1 for little-endian
+	endian = '<' if ord(wkb[0]) == 1 else '>'
+	# then a 4-byte geometry type and point count before the coordinates
+	coords = np.frombuffer( wkb, dtype=endian+'f8', offset=9 ).reshape(-1,2)
+	return ( coords[:,0].copy(), coords[:,1].copy() )
+
+
+def reproject(geom, epsg):
+	"""project a lon-lat shapely geometry into the given projection"""
+	return transform( transformer(epsg).transform, geom )
+
 
 def cut(lines, distance):
 	"""Cuts a MultiLineString into two MultiLineStrings at a distance from 
@@ -43,6 +95,71 @@ def cut(lines, distance):
 				assert abs((distance + tail_end.length) - lines.length ) < 0.001
 				return (head_end,tail_end)
 	
+def match_stops(lines, stops, max_dist, piece_length=750):
+	"""Find stops within max_dist of a MultiLineString and their measures along 
+		it. This gives the same results as cutting the line into pieces of 
+		piece_length and testing every stop against every piece, but stops are 
+		indexed on a grid so that only those near a segment get tested. Returns 
+		a list of (stop_id, measure, distance) tuples, ordered by piece and then 
+		by stop, and the number of distance tests that were skipped."""
+	if len(stops) == 0 or lines.length <= 0:
+		return ( [], 0 )
+	# index the stops on a grid of square cells
+	cell_size = 4 * max(max_dist, 1)
+	grid = {}
+	for si, stop in enumerate(stops):
+		key = ( int(floor(stop['geom'].x/cell_size)), int(floor(stop['geom'].y/cell_size)) )
+		grid.setdefault(key,[]).append(si)
+	# nearest ( distance, measure ) of each tested stop in each piece
+	nearest = {}
+	cum_dist = 0
+	for line in lines:
+		coords = list(line.coords)
+		for ci in range(1,len(coords)):
+			x1,y1 = coords[ci-1]
+			x2,y2 = coords[ci]
+			seg_length = sqrt( (x1-x2)**2 + (y1-y2)**2 )
+			m1, cum_dist = cum_dist, cum_dist + seg_length
+			# find stops in cells within max_dist of the segment's bounding box
+			candidates = []
+			for gx in range( int(floor((min(x1,x2)-max_dist)/cell_size)), int(floor((max(x1,x2)+max_dist)/cell_size))+1 ):
+				for gy in range( int(floor((min(y1,y2)-max_dist)/cell_size)), int(floor((max(y1,y2)+max_dist)/cell_size))+1 ):
+					candidates.extend( grid.get((gx,gy),[]) )
+			if len(candidates) == 0:
+				continue
+			# test each candidate against the part of this segment in each piece
+			piece = int(m1 // piece_length)
+			while piece * piece_length <= cum_dist:
+				# the fraction of the segment falling within this piece
+				if seg_length > 0:
+					t_min = max( 0.0, (piece*piece_length - m1) / seg_length )
+					t_max = min( 1.0, ((piece+1)*piece_length - m1) / seg_length )
+				else:
+					t_min, t_max = 0.0, 0.0
+				for si in candidates:
+					px, py = stops[si]['geom'].x, stops[si]['geom'].y
+					# project the stop onto the segment
+					if seg_length > 0:
+						t = ( (px-x1)*(x2-x1) + (py-y1)*(y2-y1) ) / seg_length**2
+						t = min( max(t,t_min), t_max )
+					else:
+						t = 0.0
+					dist = sqrt( (px-x1-t*(x2-x1))**2 + (py-y1-t*(y2-y1))**2 )
+					# keep the first nearest position within the piece
+					if (piece,si) not in nearest or dist < nearest[(piece,si)][0]:
+						nearest[(piece,si)] = ( dist, m1 + t*seg_length )
+				piece += 1
+				if piece * piece_length >= cum_dist:
+					break
+	# order results as though the pieces had been tested one at a time
+	matches = [
+		( stops[si]['id'], measure, dist )
+		for (piece,si), (dist,measure) in sorted(nearest.items())
+		if dist <= max_dist
+	]
+	num_pieces = int( lines.length // piece_length ) + ( 1 if lines.length % piece_length > 0 else 0 )
+	return ( matches, num_pieces*len(stops) - len(nearest) )
+
 #def cut2(line,distance1,distance2):
 #	"""cut a line in two places, returning the middle segment"""
 #	if distance1 < distance2:
@@ -0,0 +1,135 @@
+# A slim record of a trip that is still being observed. The fleet holds
+# one of these for every operating vehicle; it becomes a full trip
+# object (see trip.fromLive) only once the trip has ended. Segmenting
+# vehicle reports into trips needs no database or network access, so
+# that recorded responses can be replayed through exactly the same logic.
+
+import threading
+from array import array
+from collections import deque
+
+
+class live_trip(object):
+	"""Identifiers and the growing point arrays of an operating trip"""
+
+	__slots__ = (
+		'trip_id','block_id','direction_id','route_id','vehicle_id',
+		'last_seen','seq','lons','lats','times'
+	)
+
+	def __init__(self,trip_id,block_id,direction_id,route_id,vehicle_id,last_seen):
+		self.trip_id = trip_id				# int
+		self.block_id = block_id			# int
+		self.direction_id = direction_id	# str
+		self.route_id = route_id			# str
+		self.vehicle_id = vehicle_id		# int
+		self.last_seen = last_seen			# last vehicle report (epoch time)
+		self.seq = 1							# sequence which increments at each report
+		self.lons = array('d')				# vehicle longitudes,
+		self.lats = array('d')				# latitudes
+		self.times = array('d')				# and report times (epoch)
+
+
+	def add_point(self,lon,lat,etime):
+		"""add a vehicle location (which has just been observed) to the end
+			of this trip"""
+		self.lons.append(lon)
+		self.lats.append(lat)
+		self.times.append(etime)
+
+
+	def num_points(self):
+		"""the number of vehicle locations observed so far"""
+		return len(self.times)
+
+
+class id_allocator(object):
+	"""Hands out IDs one at a time from blocks reserved in bulk. Given
+		a reserve function, taking the number of IDs wanted (e.g. from a
+		database sequence), blocks come from that; otherwise IDs simply
+		count up from first."""
+
+	def __init__(self,reserve=None,block_size=100,first=1):
+		self.reserve = reserve
+		self.block_size = block_size
+		self.next_id = first			# next ID, when counting locally
+		self.ids = deque()			# reserved IDs not yet handed out
+
+
+	def next(self):
+		"""return a new ID"""
+		if len(self.ids) == 0:
+			if self.reserve:
+				self.ids.extend( self.reserve(self.block_size) )
+			else:
+				self.ids.extend( xrange(self.next_id,self.next_id+self.block_size) )
+				self.next_id += self.block_size
+		return self.ids.popleft()
+
+
+class fleet_tracker(object):
+	"""Operating vehicles and their current trips. Each update with newly 
+		reported vehicles adds them to trips and returns those that ended.
+		Given routes, vehicles on any other route are ignored."""
+
+	def __init__(self,trip_ids=None,block_ids=None,routes=None):
+		self.fleet = {}						# operating vehicles ( vid -> live_trip )
+		self.trip_ids = trip_ids or id_allocator()	# source of new trip_ids
+		self.block_ids = block_ids or id_allocator()	# and block_ids
+		self.routes = set(routes) if routes else None	# route_ids tracked, if not all
+		self.reported = 0					# vehicles on those routes in the last update
+		self.lock = threading.Lock()
+
+
+	def __len__(self):
+		return len(self.fleet)
+
+
+	def update(self,vehicles,server_time):
+		"""Associate each reported vehicle with a trip, given tuples of 
+			( vid, rid, did, lon, lat, secs_since_report ) and the estimated 
+			time the server generated its report. Returns the live_trips 
+			that have ended, and counts the vehicles kept in reported."""
+		ending_trips = []
+		fleet = self.fleet
+		# ignore vehicles on routes that are tracked elsewhere
+		if self.routes:
+			vehicles = [ v for v in vehicles if v[1] in self.routes ]
+		self.reported = len(vehicles)
+		# prevent simulataneous editing
+		with self.lock:
+			# check to see if there's anything we just haven't heard from at all lately
+			for vid in fleet.keys():
+				# if it's been more than 3 minutes
+				if server_time - fleet[vid].last_seen > 180:
+					# it has ended
+					ending_trips.append( fleet[vid] )
+					del fleet[vid]
+			# Now, for each reported vehicle
+			for (vid, rid, did, lon, lat, secs_since_report) in vehicles:
+				report_time = server_time - secs_since_report
+				try: # have we seen this vehicle recently?
+					fleet[vid]
+				except: # haven't seen it! create a new trip
+					fleet[vid] = live_trip(self.trip_ids.next(),self.block_ids.next(),did,rid,vid,report_time)
+					# add this vehicle to the trip
+					fleet[vid].add_point(lon,lat,report_time)
+					# done with this vehicle
+					continue
+				# we have a record for this vehicle, and it's been heard from recently
+				# see if anything else has changed that makes this a new trip
+				if ( fleet[vid].route_id != rid or fleet[vid].direction_id != did ):
+					# get the block_id from the previous trip
+					last_bid = fleet[vid].block_id
+					# this trip is ending
+					ending_trips.append( fleet[vid] )
+					# create the new trip in it's place
+					fleet[vid] = live_trip(self.trip_ids.next(),last_bid,did,rid,vid,report_time)
+					# add this vehicle to it
+					fleet[vid].add_point(lon,lat,report_time)
+				else: # not a new trip, just add the vehicle
+					fleet[vid].add_point(lon,lat,report_time)
+					# then update the time and sequence
+					fleet[vid].last_seen = report_time
+					fleet[vid].seq += 1
+		return ending_trips
@@ -1,18 +1,118 @@
 # Map match the GPS track to the street/rail network using OSRM. 
 # Try altering some parameters if the match is poor. 
 
-import requests, json
+import requests, json, threading, time
 from conf import conf
 from numpy import mean
 from shapely.geometry import MultiLineString, asShape
+from match_cache import response_cache
+
+
+class client(object):
+	"""Sends requests to the OSRM server over kept-alive connections. 
+		Only max_requests may be in flight at once; the rest wait their 
+		turn. Failed connections and server errors are retried."""
+
+	def __init__(self,url,timeout,max_requests=4,retries=2):
+		self.url = url
+		self.timeout = timeout
+		self.retries = retries
+		self.session = requests.Session()
+		adapter = requests.adapters.HTTPAdapter(pool_maxsize=max_requests)
+		self.session.mount('http://',adapter)
+		self.session.mount('https://',adapter)
+		self.slots = threading.BoundedSemaphore(max_requests)
+		self.stats_lock = threading.Lock()
+		self.stats = {
+			'requests':0,			# successful requests
+			'retries':0,			# requests sent again after an error
+			'failures':0,			# requests that failed after all retries
+			'waiting':0,			# requests currently queued for a slot
+			'max_waiting':0,		# most requests ever queued at once
+			'in_flight':0,			# requests currently being sent
+			'latency_total':0.0,	# seconds, over all successful requests
+			'latency_max':0.0
+		}
+
+
+	def count(self,stat,change=1):
+		with self.stats_lock:
+			self.stats[stat] += change
+			self.stats['max_waiting'] = max( self.stats['max_waiting'], self.stats['waiting'] )
+
+
+	def get(self,path,params):
+		"""send a GET request once a slot is free, returning the response"""
+		self.count('waiting')
+		self.slots.acquire()
+		self.count('waiting',-1)
+		self.count('in_flight')
+		try:
+			attempt = 0
+			while True:
+				start = time.time()
+				try:
+					response = self.session.get(
+						self.url+path, params=params, timeout=self.timeout
+					)
+					if response.status_code < 500:
+						latency = time.time() - start
+						with self.stats_lock:
+							self.stats['requests'] += 1
+							self.stats['latency_total'] += latency
+							self.stats['latency_max'] = max( self.stats['latency_max'], latency )
+						return response
+					error = requests.HTTPError( 'server error '+str(response.status_code) )
+				except (requests.ConnectionError,requests.Timeout) as e:
+					error = e
+				if attempt >= self.retries:
+					self.count('failures')
+					raise error
+				# back off a little before trying again
+				attempt += 1
+				self.count('retries')
+				time.sleep( 0.5 * 2**(attempt-1) )
+		finally:
+			self.count('in_flight',-1)
+			self.slots.release()
+
+
+	def get_stats(self):
+		"""return a copy of the client's metrics, with the mean latency"""
+		with self.stats_lock:
+			stats = dict(self.stats)
+		stats['latency_mean'] = stats['latency_total'] / max(stats['requests'],1)
+		return stats
+
+
+# all map matching shares this client and its connections
+osrm = client(
+	conf['OSRMserver']['url'],
+	conf['OSRMserver']['timeout'],
+	conf['OSRMserver']['max_requests'],
+	conf['OSRMserver']['retries']
+)
+
+# responses are kept on disk, if configured, for reprocessing
+cache = response_cache(
+	conf['match_cache']['file'],
+	conf['match_cache']['max_mb'] * 2**20,
+	conf['match_cache']['bypass']
+) if conf['match_cache']['file'] else None
+
+def get_cache_stats():
+	"""return the metrics of the response cache, if there is one"""
+	return cache.get_stats() if cache else {}
 
 
 class match(object):
 	"""map match result object"""
 
-	def __init__(self,vehicles):
+	def __init__(self,lons,lats,times):
 		# initialize some variables
-		self.vehicles = vehicles
+		self.lons = lons							# vehicle coordinates and
+		self.lats = lats							# report times as equal-length
+		self.times = times						# sequences
 		self.confidence = None					# average match confidence
 		self.geom = MultiLineString()			# multiline shapely geom
 		self.error_radius = conf['error_radius']
@@ -33,14 +133,9 @@ class match(object):
 	def send(self):
 		"""construct the query and send it to OSRM"""
 		# structure it as API requires
-		lons, lats, times, radii = [], [], [], []
-		for v in self.vehicles:
-			lons.append(v['lon'])
-			lats.append(v['lat'])
-			times.append( int( round( v['time'] ) ) )
-		coords = ';'.join( [str(lon)+','+str(lat) for (lon,lat) in zip(lons,lats)] )
-		times = ';'.join( [str(time) for time in times] )
-		radii = ';'.join( [str(int(round(self.error_radius)))]*len(lons) )
+		coords = ';'.join( [str(lon)+','+str(lat) for (lon,lat) in zip(self.lons,self.lats)] )
+		times = ';'.join( [str(int(round(time))) for time in self.times] )
+		radii = ';'.join( [str(int(round(self.error_radius)))]*len(self.lons) )
 		# construct and send the request
 		options = {
 			'radiuses':radii,
@@ -55,14 +150,16 @@ class match(object):
 		# optionally include timestamps
 		if self.use_times:
 			options['timestamps'] = times 
-		# make the request 
-		raw_response = requests.get(
-			conf['OSRMserver']['url']+'/match/v1/transit/'+coords,
-			params=options,
-			timeout=conf['OSRMserver']['timeout']
-		)
+		# make the request, unless the same one has been made before
+		request_path = '/match/v1/transit/'+coords
+		text = cache.get( osrm.url+request_path, options ) if cache else None
+		if text is None:
+			raw_response = osrm.get( request_path, options )
+			text = raw_response.text
+			if cache and raw_response.status_code == 200:
+				cache.put( osrm.url+request_path, options, text.encode('utf-8') )
 		# parse the result to a python object
-		self.response = json.loads(raw_response.text)
+		self.response = json.loads(text)
 		# note the attempt
 		self.num_attempts += 1
 
@@ -0,0 +1,140 @@
+# Persistent cache of responses from the OSRM server, so that trips
+# reprocessed with unchanged vehicle traces and matching parameters need
+# not be matched again. Responses are kept in an SQLite file, shared by
+# all processes, keyed by a hash of the full request. The least recently
+# used are evicted once the file holds more than max_bytes of them.
+# Clear (delete) the cache whenever the OSRM network data changes.
+
+import sqlite3, hashlib, zlib, urllib, threading, time
+from os import getpid, path, makedirs
+
+
+class response_cache(object):
+	"""Stores response bodies by request. With bypass, nothing is read
+		from the cache but fresh responses are still stored."""
+
+	def __init__(self,filename,max_bytes,bypass=False):
+		self.filename = filename
+		self.max_bytes = max_bytes
+		self.bypass = bypass
+		self.connection = None
+		self.pid = None		# process that opened the connection
+		self.size = 0			# estimated bytes of stored responses
+		self.puts_since_sized = 0
+		self.lock = threading.Lock()
+		self.stats = {
+			'hits':0,
+			'misses':0,
+			'stored':0,
+			'evicted':0
+		}
+
+
+	def connect(self):
+		"""return this process's connection, opening it if need be.
+			Call while holding the lock."""
+		if self.connection is None or self.pid != getpid():
+			directory = path.dirname(self.filename)
+			if directory and not path.exists(directory):
+				makedirs(directory)
+			self.connection = sqlite3.connect(
+				self.filename, timeout=30, check_same_thread=False
+			)
+			self.pid = getpid()
+			self.connection.execute('PRAGMA journal_mode=WAL')
+			self.connection.execute(
+				"""
+					CREATE TABLE IF NOT EXISTS responses (
+						key text PRIMARY KEY,
+						body blob,
+						size integer,
+						used real
+					)
+				"""
+			)
+			self.connection.execute('CREATE INDEX IF NOT EXISTS responses_used ON responses (used)')
+			self.connection.commit()
+			self.measure()
+		return self.connection
+
+
+	def measure(self):
+		# call while holding the lock
+		( size, ) = self.connection.execute('SELECT COALESCE(SUM(size),0) FROM responses').fetchone()
+		self.size = size
+		self.puts_since_sized = 0
+
+
+	def key(self,request_path,params):
+		"""fingerprint of a request: the path and all its parameters"""
+		query = urllib.urlencode( sorted(params.items()) )
+		return hashlib.sha1( request_path+'?'+query ).hexdigest()
+
+
+	def get(self,request_path,params):
+		"""return the stored response body for this request, or None"""
+		if self.bypass:
+			return None
+		key = self.key(request_path,params)
+		with self.lock:
+			connection = self.connect()
+			row = connection.execute(
+				'SELECT body FROM responses WHERE key = ?', (key,)
+			).fetchone()
+			if row is None:
+				self.stats['misses'] += 1
+				return None
+			connection.execute(
+				'UPDATE responses SET used = ? WHERE key = ?', (time.time(),key)
+			)
+			connection.commit()
+			self.stats['hits'] += 1
+		return zlib.decompress(row[0])
+
+
+	def put(self,request_path,params,body):
+		"""store the response body for this request"""
+		key = self.key(request_path,params)
+		compressed = zlib.compress(body)
+		with self.lock:
+			connection = self.connect()
+			connection.execute(
+				'INSERT OR REPLACE INTO responses VALUES (?,?,?,?)',
+				( key, sqlite3.Binary(compressed), len(compressed), time.time() )
+			)
+			connection.commit()
+			self.stats['stored'] += 1
+			self.size += len(compressed)
+			self.puts_since_sized += 1
+			# other processes add to the cache too
+			if self.puts_since_sized >= 100:
+				self.measure()
+			if self.size > self.max_bytes:
+				self.evict()
+
+
+	def evict(self):
+		"""remove the least recently used responses until the cache is
+			back down to 90% of its maximum size. Call while holding
+			the lock."""
+		excess = self.size - 0.9 * self.max_bytes
+		removed, freed = [], 0
+		for key, size in self.connection.execute(
+			'SELECT key, size FROM responses ORDER BY used ASC'
+		):
+			if freed >= excess:
+				break
+			removed.append( (key,) )
+			freed += size
+		self.connection.executemany('DELETE FROM responses WHERE key = ?', removed)
+		self.connection.commit()
+		self.stats['evicted'] += len(removed)
+		self.measure()
+
+
+	def get_stats(self):
+		"""return a copy of the cache's metrics"""
+		with self.lock:
+			stats = dict(self.stats)
+			stats['bytes'] = self.size
+		return stats
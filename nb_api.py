@@ -1,10 +1,17 @@
 # functions involving requests to the nextbus APIs
 
-import requests, time, db, random, sys
+import requests, time, db, sys
 import threading, multiprocessing
 import xml.etree.ElementTree as ET
 from trip import trip
+from live import fleet_tracker, id_allocator
+from writer import trip_writer
+from work_queue import processing_queue
 from os import remove, path
+from nb_feed import vehicle_locations
+from feed_archive import tee
+from refresher import route_refresher
+import feed_archive
 from conf import conf # configuration
 
 # should we process trips (or simply store the vehicles)? default False
@@ -12,120 +19,123 @@ doMatching = True if 'doMatching' in sys.argv else False
 getRoutes = True if 'getRoutes' in sys.argv else False
 
 # GLOBALS
-fleet = {} 			# operating vehicles in the ( fleet vid -> trip_obj )
-next_trip_id = db.new_trip_id()	# next trip_id to be assigned 
-next_bid = db.new_block_id()		# next block_id to be assigned
+# operating vehicles and their trips
+# new trip and block IDs are reserved from database sequences in blocks
+# the routes this collector is responsible for, if not all of them
+routes = set(conf['routes']) if conf.get('routes') else None
+fleet = fleet_tracker(
+	id_allocator( lambda n: db.reserve_ids('trip_ids',n), conf['id_block'] ),
+	id_allocator( lambda n: db.reserve_ids('block_ids',n), conf['id_block'] ),
+	routes
+)
 last_update = 0	# last update from server, removed results already reported
+# should raw responses be recorded for replay? default False
+recorder = feed_archive.recorder(conf['archive']) if 'record' in sys.argv else None
 
-fleet_lock = threading.Lock()
 print_lock = threading.Lock()
-record_check_lock = threading.Lock()
 
 def get_new_vehicles():
 	"""hit the vehicleLocations API and get all vehicles that have updated 
 		since the last check. Associate each vehicle with a trip_id (tid)
 		and send the trips for processing when it is determined that they 
-		have ended"""
-	global fleet
-	global next_trip_id
-	global next_bid
+		have ended. Returns the seconds spent in each step and the
+		numbers of vehicles and trips seen."""
 	global last_update
 	# time the request was sent
 	request_time = time.time()
+	timings = {}
 	try: 
 		response = requests.get(
 			'http://webservices.nextbus.com/service/publicXMLFeed',
 			params={'command':'vehicleLocations','a':conf['agency'],'t':last_update},
 			headers={'Accept-Encoding':'gzip, deflate'},
-			timeout=3
+			timeout=3,
+			stream=True
 		)
+		timings['fetch'] = time.time() - request_time
+		# parse the vehicles as the (decompressed) response arrives
+		response.raw.decode_content = True
+		if recorder: # keeping a copy of the raw response
+			response.raw = tee(response.raw)
+		locations = vehicle_locations(response.raw)
+		vehicles = list(locations)
 	except:
 		print 'connection problem at',time.strftime("%b %d %Y %H:%M:%S")
-		return
+		timings['error'] = True
+		return timings
 	# time the response was received
 	response_time = time.time()
+	timings['parse'] = response_time - request_time - timings['fetch']
 	# estimated time the server generated it's report
 	# halfway between send and reply
 	server_time = (request_time + response_time) / 2
-	# list of trips to send for processing
-	ending_trips = []
-	# this is the whole big ol' parsed XML document
-	XML = ET.fromstring(response.text)
+	# record the response for later replay?
+	if recorder:
+		recorder.record( request_time, response_time, response.raw.getvalue() )
 	# get values from the XML
-	last_update = int(XML.find('./lastTime').attrib['time'])
-	vehicles = XML.findall('.//vehicle')
-	# prevent simulataneous editing
-	with fleet_lock:
-		# check to see if there's anything we just haven't heard from at all lately
-		for vid in fleet.keys():
-			# if it's been more than 3 minutes
-			if server_time - fleet[vid].last_seen > 180:
-				# it has ended
-				ending_trips.append(fleet[vid])
-				del fleet[vid]
-		# Now, for each reported vehicle
-		for v in vehicles:
-			# if it's not predictable, it's not operating a route
-			if v.attrib['predictable'] == 'false': 
-				continue
-			try: # if it has no direction, it's invalid
-				v.attrib['dirTag']
-			except: 
-				continue
-			# get values from XML
-			vid, rid, did = int(v.attrib['id']),v.attrib['routeTag'],v.attrib['dirTag']
-			lon, lat = float(v.attrib['lon']), float(v.attrib['lat'])
-			report_time = server_time - int(v.attrib['secsSinceReport'])
-			try: # have we seen this vehicle recently?
-				fleet[vid]
-			except: # haven't seen it! create a new trip
-				fleet[vid] = trip.new(next_trip_id,next_bid,did,rid,vid,report_time)
-				# add this vehicle to the trip
-				fleet[vid].add_point(lon,lat,report_time)
-				# increment the trip and block counters
-				next_trip_id += 1
-				next_bid += 1
-				# done with this vehicle
-				continue
-			# we have a record for this vehicle, and it's been heard from recently
-			# see if anything else has changed that makes this a new trip
-			if ( fleet[vid].route_id != rid or fleet[vid].direction_id != did ):
-				# get the block_id from the previous trip
-				last_bid = fleet[vid].block_id
-				# this trip is ending
-				ending_trips.append( fleet[vid] )
-				# create the new trip in it's place
-				fleet[vid] = trip.new(next_trip_id,last_bid,did,rid,vid,report_time)
-				# add this vehicle to it
-				fleet[vid].add_point(lon,lat,report_time)
-				# increment the trip counter
-				next_trip_id += 1
-			else: # not a new trip, just add the vehicle
-				fleet[vid].add_point(lon,lat,report_time)
-				# then update the time and sequence
-				fleet[vid].last_seen = report_time
-				fleet[vid].seq += 1
-	# release the fleet lock
-	print len(fleet),'in fleet,',len(ending_trips),'ending trips at',time.strftime("%b %d %Y %H:%M:%S")
-	# store the trips which are ending
-	for some_trip in ending_trips:
-		if len(some_trip.vehicles) > 1:
-			some_trip.save()
-			# look for new route information with 10% probability
-			if getRoutes and random.random() < 0.1: 
-				fetch_route(some_trip.route_id)
+	if locations.last_time is not None:
+		last_update = locations.last_time
+	# assign vehicles (on this collector's routes) to trips, and find 
+	# those that are ending
+	start = time.time()
+	ending_trips = fleet.update(vehicles,server_time)
+	store_ending_trips(ending_trips)
+	timings['update'] = time.time() - start
+	# (only those on the routes this collector tracks)
+	timings['vehicles'] = fleet.reported
+	timings['fleet'] = len(fleet)
+	timings['ending'] = len(ending_trips)
+	timings['waiting'] = writer.get_stats()['depth']
+	if getRoutes:
+		route_stats = refresher.get_stats()
+		timings['routes_checked'] = route_stats['checks']
+		timings['routes_changed'] = route_stats['changed']
+		timings['route_seconds'] = route_stats['mean_seconds']
+	print len(fleet),'in fleet,',len(ending_trips),'ending trips,',writer.get_stats()['depth'],'waiting to be stored at',time.strftime("%b %d %Y %H:%M:%S")
+	return timings
+
+def store_ending_trips(ending_trips):
+	"""send live_trips that have just ended to be stored, and 
+		processed once they have been"""
+	for live in ending_trips:
+		some_trip = trip.fromLive(live)
+		if len(some_trip.times) > 1:
+			writer.put(some_trip)
+			# look for new route information, if not done lately
+			if getRoutes:
+				refresher.request(some_trip.route_id)
+
+def process_trips(stored_trips):
+	"""called by the writer with trips that have just been stored"""
 	# process the trips that are ending?
 	if doMatching:
-		for some_trip in ending_trips:
-			# start each in it's own process
-			thread = threading.Thread(target=some_trip.process)
-			thread.start()
+		# queue them for a pool of worker processes
+		processor.put( [ some_trip.trip_id for some_trip in stored_trips ] )
 
-def fetch_route(route_id):
-	"""function for requesting and storing all relevant information 
-		about a given route. Hits the routeConfig command, parses the
-		results, and checks them against available information."""
-	# request routeConfig for this route
+# stored trips are processed by a pool of workers, if at all
+if doMatching:
+	processor = processing_queue(
+		conf['processing']['workers'],
+		conf['processing']['max_queue'],
+		conf['processing']['backlog'],
+		conf['processing']['batch_size'],
+		conf['processing']['retries'],
+		conf['processing']['retry_delay'],
+		conf['processing']['max_backlog'],
+		conf['processing']['batch_timeout']
+	)
+
+# ending trips are stored in bulk on a separate thread
+writer = trip_writer(
+	conf['writer']['max_trips'],
+	conf['writer']['max_wait'],
+	conf['writer']['max_queue'],
+	after_flush = process_trips
+)
+
+def request_route_config(route_id):
+	"""request the routeConfig for a given route, returning the raw
+		response or None if there was a problem"""
 	try: 
 		response = requests.get(
 			'http://webservices.nextbus.com/service/publicXMLFeed', 
@@ -135,53 +145,61 @@ def fetch_route(route_id):
 		)
 	except:
 		print 'connection error fetching route at',time.strftime("%b %d %Y %H:%M:%S")
-		return
+		return None
+	return response.content
+
+def store_route(route_id,payload):
+	"""parse a routeConfig response and check its stops and directions
+		against available information, storing any that are new. 
+		Returns the numbers of new stops and directions."""
 	# this is the whole big ol' parsed XML document
-	XML = ET.fromstring(response.text)
-	# get a list of all stops with locations and iterate over them
-	stops = XML.find('.//route').findall('./stop')
-	for stop in stops:
+	XML = ET.fromstring(payload)
+	# get a list of all stops with locations
+	stops = []
+	for stop in XML.find('.//route').findall('./stop'):
 		try:	# some stops don't have a stop_Id / stop_code
 			stop_code = int(stop.attrib['stopId'])
 		except:
 			stop_code = -1
-		# store the stop, (or ignore it if there is nothing new)
-		with record_check_lock:
-			db.try_storing_stop(
-				stop.attrib['tag'],		# stop_id
-				stop.attrib['title'],	# stop_name
-				stop_code,					# stop_code # sometimes is missing!
-				stop.attrib['lon'], 
-				stop.attrib['lat']
-			)
-	# get a list of "direction"s and iterate over them
-	directions = XML.find('.//route').findall('./direction')
-	for d in directions:
-		# get the ordered stops from this direction and store them
-		stops = d.findall('./stop')
-		ordered_stop_tags = []
-		for stop in stops:
-			 ordered_stop_tags.append( stop.attrib['tag'] )
-		# attempt to store the direction data
+		stops.append((
+			stop.attrib['tag'],		# stop_id
+			stop.attrib['title'],	# stop_name
+			stop_code,					# stop_code # sometimes is missing!
+			stop.attrib['lon'], 
+			stop.attrib['lat']
+		))
+	# get a list of "direction"s with their ordered stops
+	directions = []
+	for d in XML.find('.//route').findall('./direction'):
+		ordered_stop_tags = [ stop.attrib['tag'] for stop in d.findall('./stop') ]
 		try: # may have missing tag
 			branch = d.attrib['branch']
 		except:
 			branch = ''
-		with record_check_lock:
-			db.try_storing_direction(
-				route_id,					# route_id
-				d.attrib['tag'],			# direction_id
-				d.attrib['title'],		# title
-				d.attrib['name'],			# name
-				branch,						# branch
-				d.attrib['useForUI'],	# useforui
-				ordered_stop_tags			# stops
-			)
-	with print_lock:
-		print 'fetched route',route_id
+		directions.append((
+			route_id,					# route_id
+			d.attrib['tag'],			# direction_id
+			d.attrib['title'],		# title
+			d.attrib['name'],			# name
+			branch,						# branch
+			d.attrib['useForUI'],	# useforui
+			ordered_stop_tags			# stops
+		))
+	# store any that are new, (ignoring those where nothing has changed)
+	return db.store_route_config(stops,directions)
+
+def fetch_route(route_id):
+	"""function for requesting and storing all relevant information 
+		about a given route right away"""
+	payload = request_route_config(route_id)
+	if payload is not None:
+		new_stops, new_directions = store_route(route_id,payload)
+		with print_lock:
+			print 'fetched route',route_id,'with',new_stops,'new stops and',new_directions,'new directions'
 
 def all_routes():
-	"""return a list of all available route tags"""
+	"""return a list of all available route tags, or only those this
+		collector is responsible for"""
 	try:
 		response = requests.get(
 			'http://webservices.nextbus.com/service/publicXMLFeed', 
@@ -194,14 +212,20 @@ def all_routes():
 		return []
 	# this is the whole big ol' parsed XML document
 	XML = ET.fromstring(response.text)
-	routes = XML.findall('.//route')
 	# initialize list
 	routelist = []
 	# populate list
-	for route in routes:
+	for route in XML.findall('.//route'):
+		if routes and route.attrib['tag'] not in routes:
+			continue
 		routelist.append(route.attrib['tag'])
 	# returns a list of strings
 	return routelist
 
-
-
+# routes are checked for new stops and directions in the background
+if getRoutes:
+	refresher = route_refresher(
+		all_routes, request_route_config, store_route,
+		conf['route_refresh']['period'],
+		conf['route_refresh']['max_rate']
+	)
@@ -0,0 +1,44 @@
+# parsing of responses from the nextbus XML feed
+# http://www.nextbus.com/xmlFeedDocs/NextBusXMLFeed.pdf
+
+import xml.etree.cElementTree as ET
+
+
+class vehicle_locations(object):
+	"""Streams the vehicles from a vehicleLocations response, given as a
+		file-like object of raw (decompressed) bytes, without building
+		the whole document tree. Iterating yields a tuple of
+		( vehicle_id, route_id, direction_id, lon, lat, secsSinceReport )
+		for each vehicle operating a route. The lastTime of the response
+		is available once iteration is finished."""
+
+	def __init__(self,source):
+		self.source = source
+		self.last_time = None	# from the lastTime element, if any
+
+
+	def __iter__(self):
+		root = None
+		for event, element in ET.iterparse(self.source,events=('start','end')):
+			if root is None:
+				root = element
+			if event == 'start':
+				continue
+			if element.tag == 'vehicle':
+				attrib = element.attrib
+				# if it's not predictable, or has no direction,
+				# it's not operating a route
+				if attrib.get('predictable') != 'false' and 'dirTag' in attrib:
+					yield (
+						int(attrib['id']),
+						attrib['routeTag'],
+						attrib['dirTag'],
+						float(attrib['lon']),
+						float(attrib['lat']),
+						int(attrib['secsSinceReport'])
+					)
+				# drop what we've seen so the tree never grows
+				root.clear()
+			elif element.tag == 'lastTime':
+				self.last_time = int(element.attrib['time'])
+
@@ -1,75 +1,194 @@
-# call this file to begin processing a set of trips from 
-# stored vehicle locations. It will ask which trips from 
-# the db to process. You can either process individual 
-# trips or a range of trips given sequential trip_ids 
+# call this file to process a set of trips from stored vehicle
+# locations. Trips are selected by any combination of:
+# python process.py --range 1:5000 --route 504 --start 2017-10-01 \
+#	--end 2017-11-01 --status unprocessed --workers 8
+# or given individually with --trips 12 13 14
+# Each trip processed is recorded in a checkpoint file, so a run that
+# stops partway can be resumed by running the same command again.
+# With --archive DIR, the raw traces are read from a Parquet archive 
+# written by archive.py instead of the database, though stops and the 
+# results are still stored in the database (the sqlite backend will do).
 
 import multiprocessing as mp
-from time import sleep
-from trip import trip
-import db
-
-# let mode be one of ('single','range?')
-mode = raw_input('Processing mode (single, range, or route) --> ')
-
-def process_trip(valid_trip_id):
-	"""worker process called when using multiprocessing"""
-	print 'starting trip:',valid_trip_id
-	db.reconnect()
-	t = trip.fromDB(valid_trip_id)
-	t.process()
-
-# single mode enters one trip at a time and stops when 
-# a non-integer is entered
-if mode in ['single','s']:
-	trip_id = raw_input('trip_id to process--> ')
-	while trip_id.isdigit():
-		if db.trip_exists(trip_id):
-			# create a trip object
-			this_trip = trip.fromDB(trip_id)
-			# process
-			this_trip.process()
-		else:
-			print 'no such trip'
-		# ask for another trip and continue
-		trip_id = raw_input('trip_id to process --> ')
-
-# 'range' mode does all valid ids in the given range
-elif mode == 'range':
-	id_range = raw_input('trip_id range as start:end --> ')
-	id_range = id_range.split(':')
-	# get a list of block id's in the range
-	trip_ids = db.get_trip_ids_by_range(id_range[0],id_range[1])
-	print len(trip_ids),'trips in that range'
-	# how many parallel processes to use?
-	max_procs = int(raw_input('max processes --> '))
-	# create a pool of workers and pass them the data
-	p = mp.Pool(max_procs)
-	p.map(process_trip,trip_ids,chunksize=1)
-	print 'COMPLETED!'
-
-# process only a certain route, then a subset of that route's trips
-elif mode == 'route':
-	route_id = raw_input('route_id --> ')
-	trip_ids = db.get_trip_ids_by_route(route_id)
-	print len(trip_ids),'trips on that route'
-	i_range = raw_input('of these, index range as start:end --> ')
-	i_range = i_range.split(':')
-	# subset to the given range
-	trip_ids = trip_ids[int(i_range[0]):int(i_range[1])]
-	# start dispatching
-	# how many parallel processes to use?
-	max_procs = int(raw_input('max processes --> '))
-	# create a pool of workers and pass them the data
-	p = mp.Pool(max_procs)
-	p.map(process_trip,trip_ids,chunksize=1)
-	print 'COMPLETED!'
-
-else:
-	print 'invalid entry mode given' 
+import argparse, time, calendar, re
+from os import path, makedirs
+from work_queue import process_trips, use_archive
+from conf import conf
+import db, map_api, archive
 
 
+def parse_args():
+	parser = argparse.ArgumentParser(description='Process stored trips.')
+	parser.add_argument('--trips',type=int,nargs='+',help='trip_ids to process')
+	parser.add_argument('--range',help='trip_id range as start:end (inclusive)')
+	parser.add_argument('--route',help='only trips on this route_id')
+	parser.add_argument('--start',help='only trips starting on or after this (local) date, as YYYY-MM-DD')
+	parser.add_argument('--end',help='only trips starting before this (local) date, as YYYY-MM-DD')
+	parser.add_argument('--status',choices=('unprocessed','processed','problem'),
+		help='only trips with this processing status')
+	parser.add_argument('--workers',type=int,default=mp.cpu_count(),help='number of worker processes')
+	parser.add_argument('--checkpoint',help='file recording processed trips (default from the selection)')
+	parser.add_argument('--restart',action='store_true',help='ignore any existing checkpoint')
+	parser.add_argument('--rematch',action='store_true',
+		help='match every trip again, rather than using cached OSRM responses')
+	parser.add_argument('--archive',metavar='DIR',
+		help='read the raw traces from this Parquet archive rather than the database')
+	args = parser.parse_args()
+	if args.archive and args.status:
+		parser.error('--status needs the trips table, so it can\'t be used with --archive')
+	return args
 
 
+def local_date_epoch(date):
+	"""epoch time of midnight on a local YYYY-MM-DD date"""
+	utc_midnight = calendar.timegm( time.strptime(date,'%Y-%m-%d') )
+	return utc_midnight - conf['timezone']*3600
 
 
+def select_trips(args):
+	"""return the ids of all trips matching the selection"""
+	if args.trips:
+		return sorted(args.trips)
+	min_id, max_id = None, None
+	if args.range:
+		min_id, max_id = [ int(i) for i in args.range.split(':') ]
+	return db.get_trip_ids(
+		min_id, max_id, args.route,
+		local_date_epoch(args.start) if args.start else None,
+		local_date_epoch(args.end) if args.end else None,
+		args.status
+	)
 
+
+def select_archived_trips(args,reader):
+	"""return the ids of all archived trips matching the selection"""
+	if args.trips:
+		return sorted(args.trips)
+	route_ids = [ args.route ] if args.route else None
+	service_ids = None
+	if args.start or args.end:
+		first = archive.service_id(args.start) if args.start else None
+		last = archive.service_id(args.end) if args.end else None
+		service_ids = set( [
+			service_id for service_id, route_id, filename 
+			in reader.partitions('traces',None,route_ids)
+			if ( first is None or service_id >= first ) and ( last is None or service_id < last )
+		] )
+	trip_ids = reader.trip_ids(service_ids,route_ids)
+	if args.range:
+		min_id, max_id = [ int(i) for i in args.range.split(':') ]
+		trip_ids = [ trip_id for trip_id in trip_ids if min_id <= trip_id <= max_id ]
+	return trip_ids
+
+
+def checkpoint_file(args):
+	"""default name of the checkpoint for this selection of trips"""
+	if args.checkpoint:
+		return args.checkpoint
+	parts = []
+	for key in ('range','route','start','end','status'):
+		value = getattr(args,key)
+		if value:
+			parts.append( key+'-'+re.sub('[^0-9A-Za-z]+','_',str(value)) )
+	if args.trips:
+		parts.append( 'trips-'+str(min(args.trips))+'-'+str(max(args.trips)) )
+	return path.join( 'checkpoints', '_'.join(parts or ['all'])+'.txt' )
+
+
+def read_checkpoint(filename):
+	"""return the set of trip_ids already processed"""
+	if not path.exists(filename):
+		return set()
+	with open(filename) as f:
+		return set( [ int(line) for line in f if line.strip().isdigit() ] )
+
+
+def batch_size(num_trips,workers):
+	"""hand each worker about ten batches, so work stays evenly spread
+		as the run ends, but keep batches small enough to checkpoint often.
+		Each batch of trips is loaded from the database at once."""
+	return max( 1, min( 50, num_trips // (workers*10) ) )
+
+
+def duration(seconds):
+	minutes, seconds = divmod( int(seconds), 60 )
+	hours, minutes = divmod( minutes, 60 )
+	return '%dh%02dm%02ds' % (hours,minutes,seconds)
+
+
+def main():
+	args = parse_args()
+	if args.archive:
+		reader = archive.archive_reader(args.archive)
+		trip_ids = select_archived_trips(args,reader)
+		# (set before the workers are started, so they all inherit it)
+		use_archive(reader)
+	else:
+		trip_ids = select_trips(args)
+	checkpoint = checkpoint_file(args)
+	if args.restart and path.exists(checkpoint):
+		open(checkpoint,'w').close()
+	done = read_checkpoint(checkpoint)
+	remaining = [ trip_id for trip_id in trip_ids if trip_id not in done ]
+	print len(trip_ids),'trips selected,',len(trip_ids)-len(remaining),'already processed according to',checkpoint
+	if len(remaining) == 0:
+		print 'COMPLETED!'
+		return
+	if path.dirname(checkpoint) and not path.exists(path.dirname(checkpoint)):
+		makedirs(path.dirname(checkpoint))
+	if args.rematch and map_api.cache:
+		# (set before the workers are started, so they all inherit it)
+		map_api.cache.bypass = True
+	# each worker opens its own database connections, once
+	pool = mp.Pool(args.workers,initializer=db.reconnect)
+	size = batch_size(len(remaining),args.workers)
+	batches = [ remaining[i:i+size] for i in range(0,len(remaining),size) ]
+	results = ( 
+		result for batch in pool.imap_unordered(process_trips,batches)
+		for result in batch
+	)
+	processed, failed = 0, 0
+	caches = {}
+	start = time.time()
+	last_report = start
+	try:
+		with open(checkpoint,'a') as journal:
+			for trip_id, timings, error, (pid, cache_stats) in results:
+				if cache_stats is not None:
+					caches[pid] = cache_stats
+				if error:
+					# not checkpointed, so tried again on resuming
+					failed += 1
+					print 'failed to process trip',trip_id
+					print error
+				else:
+					processed += 1
+					journal.write(str(trip_id)+'\n')
+					journal.flush()
+				now = time.time()
+				if now - last_report >= 5:
+					last_report = now
+					finished = processed + failed
+					rate = finished / (now - start)
+					print '%d/%d trips (%.1f%%), %d failed, %.1f trips/s, ETA %s' % (
+						finished, len(remaining), 100.0*finished/len(remaining), failed, rate,
+						duration( (len(remaining)-finished) / rate )
+					)
+					for name in ('stop_cache','match_cache'):
+						print '\t%s: %d hits, %d misses' % ( name,
+							sum( [ c[name].get('hits',0) for c in caches.values() ] ),
+							sum( [ c[name].get('misses',0) for c in caches.values() ] )
+						)
+		pool.close()
+	except KeyboardInterrupt:
+		pool.terminate()
+		print 'stopped after',processed,'trips; run again to resume'
+		return
+	pool.join()
+	print processed,'trips processed,',failed,'failed, in',duration(time.time()-start)
+	if failed == 0:
+		print 'COMPLETED!'
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,147 @@
+# Background refreshing of route data (stops and directions). Every route
+# is checked once per period, with the checks spread evenly over it, on a
+# thread of its own so that vehicle polling never waits. Routes that
+# have never been checked, or that are asked for, go first.
+
+import threading, time, hashlib, traceback
+
+
+class route_refresher(object):
+	"""Checks each route for new data at most once per period. fetch
+		takes a route_id and returns the raw payload describing the route
+		(or None on failure), and store takes the route_id and a payload
+		and returns the numbers of new stops and directions stored.
+		Payloads identical to the last one seen for a route are not
+		stored again. list_routes returns all the route_ids to check."""
+
+	def __init__(self,list_routes,fetch,store,period=3600,max_rate=1.0):
+		self.list_routes = list_routes
+		self.fetch = fetch
+		self.store = store
+		self.period = period				# seconds between checks of a route
+		self.min_interval = 1.0 / max_rate	# seconds between any two checks
+		self.last_checked = {}			# route_id -> time last checked
+		self.hashes = {}					# route_id -> hash of its last payload
+		self.requested = []				# route_ids to check before any others
+		self.routes_listed = None		# time the route list was last fetched
+		self.last_check = 0				# time the last check started
+		self.lock = threading.Lock()
+		self.wake = threading.Event()
+		self.stats = {
+			'checks':0,				# routes checked
+			'unchanged':0,			# payloads the same as last time
+			'changed':0,			# routes with new stops or directions stored
+			'failed':0,				# checks that failed
+			'new_stops':0,			# stop versions stored
+			'new_directions':0,	# direction versions stored
+			'seconds':0.0,			# total time spent checking routes
+			'max_seconds':0.0		# longest time spent checking a route
+		}
+		self.thread = threading.Thread(target=self.run)
+		self.thread.daemon = True
+		self.thread.start()
+
+
+	def request(self,route_id):
+		"""ask for a route to be checked soon, unless it was checked
+			recently. This never blocks."""
+		with self.lock:
+			if route_id in self.requested:
+				return
+			last = self.last_checked.get(route_id)
+			if last is not None and time.time() - last < self.period:
+				return
+			self.requested.append(route_id)
+		self.wake.set()
+
+
+	def next_route(self):
+		"""return the route most in need of checking, and the time at
+			which it will be due"""
+		with self.lock:
+			if len(self.requested) > 0:
+				return ( self.requested.pop(0), 0 )
+			if len(self.last_checked) == 0:
+				return ( None, time.time() + self.min_interval )
+			route_id = min( self.last_checked, key=lambda r: self.last_checked[r] )
+			if self.last_checked[route_id] == 0: # never checked
+				return ( route_id, 0 )
+			# spread the checks evenly over the period
+			due = self.last_checked[route_id] + self.period
+			interval = max( self.min_interval, float(self.period) / len(self.last_checked) )
+			return ( route_id, max( due, self.last_check + interval ) )
+
+
+	def refresh_route_list(self):
+		"""add any routes not yet known, to be checked first"""
+		route_ids = self.list_routes()
+		# an empty list is a failure; try again soon
+		if len(route_ids) > 0:
+			self.routes_listed = time.time()
+		with self.lock:
+			for route_id in route_ids:
+				if route_id not in self.last_checked:
+					# never checked, so due immediately
+					self.last_checked[route_id] = 0
+
+
+	def run(self):
+		while True:
+			self.wake.clear()
+			if self.routes_listed is None or time.time() - self.routes_listed > self.period:
+				try:
+					self.refresh_route_list()
+				except:
+					print 'failed to list routes'
+					print traceback.format_exc()
+					self.routes_listed = time.time()
+			route_id, due = self.next_route()
+			# never check more often than the rate limit allows
+			due = max( due, self.last_check + self.min_interval )
+			if route_id is None or due > time.time():
+				self.wake.wait( due - time.time() )
+				continue
+			self.check(route_id)
+
+
+	def check(self,route_id):
+		"""fetch a route and store it, if its payload has changed"""
+		start = time.time()
+		self.last_check = start
+		with self.lock:
+			self.last_checked[route_id] = start
+		outcome = 'failed'
+		new_stops, new_directions = 0, 0
+		try:
+			payload = self.fetch(route_id)
+			if payload is not None:
+				digest = hashlib.sha1(payload).hexdigest()
+				if self.hashes.get(route_id) == digest:
+					outcome = 'unchanged'
+				else:
+					new_stops, new_directions = self.store(route_id,payload)
+					self.hashes[route_id] = digest
+					outcome = 'changed' if new_stops + new_directions > 0 else 'unchanged'
+		except:
+			print 'failed to refresh route',route_id
+			print traceback.format_exc()
+		seconds = time.time() - start
+		with self.lock:
+			self.stats['checks'] += 1
+			self.stats[outcome] += 1
+			self.stats['new_stops'] += new_stops
+			self.stats['new_directions'] += new_directions
+			self.stats['seconds'] += seconds
+			self.stats['max_seconds'] = max( self.stats['max_seconds'], seconds )
+		if outcome == 'changed':
+			print 'route',route_id,'changed:',new_stops,'new stops,',new_directions,'new directions'
+
+
+	def get_stats(self):
+		"""return a copy of the refresher's metrics"""
+		with self.lock:
+			stats = dict(self.stats)
+			stats['routes'] = len(self.last_checked)
+			stats['requested'] = len(self.requested)
+			stats['mean_seconds'] = self.stats['seconds'] / max(1,self.stats['checks'])
+		return stats
@@ -0,0 +1,55 @@
+# call this file to replay recorded vehicleLocations responses (made
+# by running store.py with 'record') through the same segmentation of
+# vehicles into trips as the live collector, as fast as possible.
+# Give the archive files to replay, in order, e.g.
+# python replay.py archive/vehicleLocations-20171001.rec [store] [doMatching]
+# With 'store', ending trips are stored (and optionally processed) just
+# as in the live path; otherwise they are only counted.
+
+import sys, time
+from cStringIO import StringIO
+from live import fleet_tracker
+from nb_feed import vehicle_locations
+from feed_archive import read_archive
+from conf import conf
+
+# should ending trips be stored in the database? default False
+store = True if 'store' in sys.argv else False
+archives = [ arg for arg in sys.argv[1:] if arg not in ('store','doMatching') ]
+
+if store:
+	# storage goes through the collector's own writer and processing
+	import nb_api
+	fleet = nb_api.fleet
+else:
+	# only the collector's routes, as in the live path
+	fleet = fleet_tracker( routes=conf.get('routes') )
+
+polls, vehicles_seen, trips_ended, points_ended = 0, 0, 0, 0
+parse_seconds, update_seconds = 0.0, 0.0
+start = time.time()
+for archive in archives:
+	for (request_time, response_time, body) in read_archive(archive):
+		# estimated time the server generated it's report
+		# halfway between send and reply
+		server_time = (request_time + response_time) / 2
+		t0 = time.time()
+		vehicles = list( vehicle_locations( StringIO(body) ) )
+		t1 = time.time()
+		ending_trips = fleet.update(vehicles,server_time)
+		t2 = time.time()
+		if store:
+			nb_api.store_ending_trips(ending_trips)
+		parse_seconds += t1 - t0
+		update_seconds += t2 - t1
+		polls += 1
+		vehicles_seen += len(vehicles)
+		trips_ended += len(ending_trips)
+		points_ended += sum( [ live.num_points() for live in ending_trips ] )
+	print 'replayed',archive
+
+elapsed = max( time.time() - start, 0.001 )
+print polls,'polls,',vehicles_seen,'vehicles,',trips_ended,'trips ended with',points_ended,'points in %.1f s' % elapsed
+print '\t%.1f polls/s, %.0f vehicles/s' % ( polls/elapsed, vehicles_seen/elapsed )
+print '\tparsing %.1f s, trip segmentation %.1f s' % ( parse_seconds, update_seconds )
+print '\t',len(fleet),'trips still in progress'
@@ -2,10 +2,6 @@
 # set the parameters unique to your setup below
 # then rename this file to "conf.py"
 
-# for handling projections
-from functools import partial
-import pyproj
-
 conf = {
 	# PostgreSQL database connnection
 	'db':
@@ -14,29 +10,130 @@ conf = {
 			'name':'',
 			'user':'',
 			'password':'',
+			# maximum number of pooled connections shared between threads
+			'pool_size':10,
+			# where everything is stored: 'postgres' (PostGIS, using the 
+			# settings above) or 'sqlite' (the file below, with no server)
+			'backend':'postgres',
+			'file':'data/retro.sqlite',
 			'tables':{
 				# these are SQL-safe table names used directly in queries
 				'trips':'prefix_trips',
 				'stops':'prefix_stops',
 				'stop_times':'prefix_stop_times',
-				'directions':'prefix_directions'
+				'directions':'prefix_directions',
+				# sequences from which new trip and block IDs are drawn
+				'trip_ids':'prefix_trip_ids',
+				'block_ids':'prefix_block_ids'
 			}
 		},
 	# agency tag for the Nextbus API
 	'agency':'ttc',
+	# route tags to collect, or None for all routes of the agency
+	'routes':None,
+	# new IDs are reserved from the database this many at a time
+	'id_block':100,
+	# stops of this many direction versions are kept in memory by each 
+	# process. Versions still current are refetched after ttl seconds.
+	'stop_cache':{
+		'size':1000,
+		'ttl':600
+	},
+	# collectors run by supervisor.py, one process per shard. Each shard
+	# overrides the settings above with any it gives; dictionaries are
+	# merged. A large agency can be split into route groups, which may
+	# share tables (and so ID sequences).
+	'shards':[
+		{
+			'name':'ttc',
+			'agency':'ttc'
+		},
+		{
+			'name':'york',
+			'agency':'york-region',
+			'db':{
+				'tables':{
+					'trips':'york_trips',
+					'stops':'york_stops',
+					'stop_times':'york_stop_times',
+					'directions':'york_directions',
+					'trip_ids':'york_trip_ids',
+					'block_ids':'york_block_ids'
+				}
+			}
+		}
+	],
+	# ending trips are stored in bulk when this many are waiting, 
+	# or the first has waited this many seconds. The polling thread 
+	# waits if more than max_queue trips are waiting to be stored.
+	'writer':{
+		'max_trips':500,
+		'max_wait':30,
+		'max_queue':5000
+	},
+	# with getRoutes, every route is checked for new stops and directions
+	# once per period (seconds), spread evenly, and no more than max_rate
+	# routes are checked per second
+	'route_refresh':{
+		'period':3600,
+		'max_rate':1.0
+	},
+	# directory where raw API responses are recorded when running 
+	# with 'record', for later replay with replay.py
+	'archive':'archive/',
+	# with doMatching, stored trips are processed by this many worker 
+	# processes, with up to max_queue trips handed to them at once, 
+	# loaded in batches of up to batch_size. Trips waiting to be 
+	# processed are journaled to the backlog file and picked up again
+	# if the collector restarts. Trips that fail are tried again after 
+	# retry_delay seconds, up to retries times, and again on restart.
+	# The writer waits if more than max_backlog trips are waiting to be 
+	# processed. A batch of trips not processed within batch_timeout 
+	# seconds (e.g. because its worker died) is counted as failed.
+	'processing':{
+		'workers':4,
+		'max_queue':100,
+		'batch_size':20,
+		'backlog':'processing_backlog.txt',
+		'retries':3,
+		'retry_delay':60,
+		'max_backlog':10000,
+		'batch_timeout':600
+	},
 	# Where is the ORSM server? Give the root url
 	'OSRMserver':{
 		'url':'http://201.167.182.17:5002',
-		'timeout':10 # seconds
-	},
-	# function for projecting from lat-lon for shapely
-	# http://toblerity.org/shapely/manual.html#other-transformations
-	# http://all-geo.org/volcan01010/2012/11/change-coordinates-with-pyproj/
-	'projection':partial(
-		 pyproj.transform,
-		 pyproj.Proj('+init=EPSG:4326'),
-		 pyproj.Proj('+init=EPSG:32723')
-	),
+		'timeout':10, # seconds
+		# most requests to have in flight at once; others wait their turn
+		'max_requests':4,
+		# times to retry a request after a connection or server error
+		'retries':2
+	},
+	# OSRM responses are kept in this SQLite file (None for no cache) 
+	# so that reprocessing trips with the same vehicle traces doesn't
+	# match them again. The least recently used are dropped beyond 
+	# max_mb. With bypass, the cache is refreshed but never read. 
+	# Delete the file whenever the OSRM network changes.
+	'match_cache':{
+		'file':'cache/osrm_responses.sqlite',
+		'max_mb':2048,
+		'bypass':False
+	},
+	# export.py keeps the GTFS files of each service day here, and only
+	# rebuilds the days whose trips have changed since the last export
+	'export':{
+		'cache':'export_cache/',
+		# trips on a route and direction whose matched paths are all
+		# within this many meters of each other share one shape
+		'shape_tolerance':20
+	},
+	# archive.py writes raw traces and stop times here as Parquet files,
+	# partitioned by day and route (this needs pyarrow)
+	'parquet_archive':{
+		'directory':'parquet/'
+	},
+	# local meter-based projection; lat-lon points are projected into 
+	# this all at once when a trip is saved or processed
 	'localEPSG':32723,
 	'timezone':-4,
 	# distance threshold for stop matching in meters
@@ -0,0 +1,169 @@
+# Shared GTFS shapes. Trips on the same route and direction mostly follow
+# the same path, so rather than one shape per trip, each matched geometry
+# is compared with the shapes already known for its route and direction
+# and reuses the first that lies within a tolerance of it. Shapes are
+# found quickly by a hash of the line snapped to a coarse grid, and only
+# compared one by one when that fails. Shapes and their ids are kept in
+# a registry file, so that ids stay the same from one export to the next.
+
+import json
+from os import rename
+import numpy as np
+from shapely.geometry import LineString
+from geom import unproject
+
+
+class shape_registry(object):
+	"""Assigns trips to shared shapes. Two lines share a shape when
+		their ends are within the tolerance (meters) of each other and
+		no point on either is further than that from the other (i.e. the
+		Hausdorff distance). Coordinates are in the local projection."""
+
+	def __init__(self,filename,tolerance=20):
+		self.filename = filename
+		self.tolerance = tolerance
+		self.next_id = 1
+		self.shapes = {}		# shape_id -> ( x, y ) arrays
+		self.groups = {}		# (route_id, direction_id) -> [ shape, ... ]
+		self.hashes = {}		# (route_id, direction_id, fingerprint) -> [ shape, ... ]
+		self.changed = False	# are there shapes not yet saved?
+		self.stats = {
+			'trips':0,			# trips assigned a shape
+			'new':0,			# shapes created
+			'hashed':0,		# trips matched to a shape by its hash
+			'searched':0,		# trips matched to a shape by comparison
+			'comparisons':0	# Hausdorff distances calculated
+		}
+
+
+	def load(self):
+		"""read the saved shapes, returning False if there are none"""
+		try:
+			with open(self.filename) as f:
+				saved = json.load(f)
+		except IOError:
+			return False
+		self.next_id = saved['next_id']
+		for shape in saved['shapes']:
+			self.add(
+				shape['shape_id'], shape['route_id'], shape['direction_id'],
+				np.array(shape['x']), np.array(shape['y'])
+			)
+		self.changed = False
+		return True
+
+
+	def save(self):
+		"""write the shapes out, if any are new"""
+		if not self.changed:
+			return
+		shapes = [
+			{
+				'shape_id':shape['shape_id'],
+				'route_id':shape['route_id'],
+				'direction_id':shape['direction_id'],
+				'x':[ round(v,1) for v in shape['x'] ],
+				'y':[ round(v,1) for v in shape['y'] ]
+			} for group in self.groups.values() for shape in group
+		]
+		# replaced all at once, so it is never left half-written
+		with open(self.filename+'.tmp','w') as f:
+			json.dump( { 'next_id':self.next_id, 'shapes':shapes }, f )
+		rename(self.filename+'.tmp',self.filename)
+		self.changed = False
+
+
+	def fingerprint(self,x,y):
+		"""the ends and middle of the line, snapped to a coarse grid.
+			Close lines usually share this."""
+		distances = np.concatenate( ( [0], np.cumsum( np.hypot( np.diff(x), np.diff(y) ) ) ) )
+		samples = np.linspace( 0, distances[-1], 3 )
+		cell = 5.0 * self.tolerance
+		xs = np.floor( np.interp(samples,distances,x) / cell ).astype(int)
+		ys = np.floor( np.interp(samples,distances,y) / cell ).astype(int)
+		return tuple(xs) + tuple(ys)
+
+
+	def add(self,shape_id,route_id,direction_id,x,y):
+		shape = {
+			'shape_id':shape_id,
+			'route_id':route_id,
+			'direction_id':direction_id,
+			'x':x,
+			'y':y,
+			'line':LineString( np.column_stack((x,y)) ),
+			'ends':np.array( [ x[0], y[0], x[-1], y[-1] ] )
+		}
+		self.shapes[shape_id] = (x,y)
+		self.groups.setdefault( (route_id,direction_id), [] ).append(shape)
+		key = (route_id,direction_id,self.fingerprint(x,y))
+		self.hashes.setdefault( key, [] ).append(shape)
+		self.changed = True
+		return shape
+
+
+	def matches(self,shape,line):
+		self.stats['comparisons'] += 1
+		return shape['line'].hausdorff_distance(line) <= self.tolerance
+
+
+	def assign(self,route_id,direction_id,x,y):
+		"""return the shape_id of the shape followed by a trip with the
+			given coordinates, creating a new shape if need be"""
+		if len(x) < 2:
+			return None
+		self.stats['trips'] += 1
+		line = LineString( np.column_stack((x,y)) )
+		key = (route_id,direction_id,self.fingerprint(x,y))
+		for shape in self.hashes.get(key,[]):
+			if self.matches(shape,line):
+				self.stats['hashed'] += 1
+				return shape['shape_id']
+		# lines near a grid boundary may hash differently, so compare
+		# against every shape with ends close enough to match
+		group = self.groups.get( (route_id,direction_id), [] )
+		if len(group) > 0:
+			ends = np.array( [ x[0], y[0], x[-1], y[-1] ] )
+			gaps = np.array( [ shape['ends'] for shape in group ] ) - ends
+			close = np.maximum(
+				np.hypot( gaps[:,0], gaps[:,1] ), np.hypot( gaps[:,2], gaps[:,3] )
+			) <= self.tolerance
+			for i in np.flatnonzero(close):
+				if self.matches(group[i],line):
+					self.stats['searched'] += 1
+					return group[i]['shape_id']
+		shape_id = 'shp_'+str(self.next_id)
+		self.next_id += 1
+		self.stats['new'] += 1
+		self.add( shape_id, route_id, direction_id, np.asarray(x,dtype=float), np.asarray(y,dtype=float) )
+		return shape_id
+
+
+	def write(self,target,shape_ids,epsg):
+		"""write shapes.txt for the given shapes, transforming all their
+			points back to lon-lat at once. Returns the number of points."""
+		target.write('shape_id,shape_pt_sequence,shape_pt_lon,shape_pt_lat\n')
+		shape_ids = sorted( shape_ids, key=lambda s: int(s.split('_')[-1]) )
+		if len(shape_ids) == 0:
+			return 0
+		lengths = [ len(self.shapes[shape_id][0]) for shape_id in shape_ids ]
+		lons, lats = unproject(
+			np.concatenate( [ self.shapes[shape_id][0] for shape_id in shape_ids ] ),
+			np.concatenate( [ self.shapes[shape_id][1] for shape_id in shape_ids ] ),
+			epsg
+		)
+		offset = 0
+		for shape_id, length in zip(shape_ids,lengths):
+			target.write( ''.join( [
+				'%s,%d,%.6f,%.6f\n' % ( shape_id, i+1, lons[offset+i], lats[offset+i] )
+				for i in range(length)
+			] ) )
+			offset += length
+		return offset
+
+
+	def get_stats(self):
+		"""return a copy of the registry's metrics"""
+		stats = dict(self.stats)
+		stats['shapes'] = len(self.shapes)
+		return stats
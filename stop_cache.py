@@ -0,0 +1,64 @@
+# Cache of the ordered stops of directions, by the times at which they
+# are valid, so that trips on the same direction need not look up their
+# stops in the database again. Used by every storage backend.
+
+import threading, time
+from collections import OrderedDict
+
+
+class stop_cache(object):
+	"""The stops of recently used direction versions, least recently used
+		first. Each version holds the ordered stops of a direction and
+		the interval of report_times over which they are valid. A
+		version whose end is not yet known is only trusted for ttl
+		seconds, since newer route data may arrive at any time."""
+
+	def __init__(self,size=1000,ttl=600):
+		self.size = size
+		self.ttl = ttl
+		self.versions = OrderedDict()	# ( direction_id, valid_from ) -> version
+		self.starts = {}					# direction_id -> set of valid_from
+		self.lock = threading.Lock()
+		self.hits = 0
+		self.misses = 0
+
+
+	def get(self,direction_id,trip_time):
+		"""return the cached stops of the direction at this time, or None"""
+		with self.lock:
+			for valid_from in self.starts.get(direction_id,()):
+				key = ( direction_id, valid_from )
+				valid_until, fetched, stops = self.versions[key]
+				if trip_time < valid_from:
+					continue
+				if valid_until is None:
+					if time.time() - fetched > self.ttl:
+						continue
+				elif trip_time >= valid_until:
+					continue
+				# most recently used goes to the end
+				self.versions[key] = self.versions.pop(key)
+				self.hits += 1
+				return stops
+			self.misses += 1
+			return None
+
+
+	def put(self,direction_id,valid_from,valid_until,stops):
+		with self.lock:
+			key = ( direction_id, valid_from )
+			self.versions.pop(key,None)
+			self.versions[key] = ( valid_until, time.time(), stops )
+			self.starts.setdefault(direction_id,set()).add(valid_from)
+			while len(self.versions) > self.size:
+				( old_did, old_from ), version = self.versions.popitem(last=False)
+				self.starts[old_did].discard(old_from)
+
+
+	def get_stats(self):
+		with self.lock:
+			return {
+				'hits':self.hits,
+				'misses':self.misses,
+				'versions':len(self.versions)
+			}
@@ -1,46 +1,57 @@
 # main file, called to start the process of pulling vehicle locations
 
-import threading
-from nb_api import get_new_vehicles, fetch_route, all_routes
+import time
+from collections import deque
+from nb_api import get_new_vehicles
 import db
 from time import sleep
-import random
 import sys
 
 # takes arguments from the command line
-# should we get route information from the API? default False
-getRoutes = True if 'getRoutes' in sys.argv else False
+# (with getRoutes, route information is refreshed in the background)
 # should existing data be truncated? default False;
 truncateData = True if 'truncateData' in sys.argv else False
 
-
-def time_loop():
-	"""timer function whose purpose is to call itself every N seconds 
-		without stopping. Calls some other function after setting 
-		itself to go off again"""
-	threading.Timer( 10, time_loop ).start() # int is delay in seconds
-	# request new vehicles and store them
-	get_new_vehicles()
-
-if truncateData:
-	db.empty_tables()
-
-if getRoutes:
-	# get all the route data, afresh
-	# threading this makes it faster
-	#print 'requesting all route data'
-	routes = all_routes()
-	for route_id in routes:
-		t = threading.Thread(target=fetch_route,args=(route_id,))
-		t.start()
-		if threading.active_count() >= 20:
-			sleep(3)
-
-	sleep(10)
-
-# call the big function. This takes longer to run the first time, 
-get_new_vehicles()
-
-# so wait a bit longer than usual to call the timer function 10secs later
-threading.Timer( 10, time_loop ).start()
-# then it calls itself every N secs
+# timings of the most recent polls, newest last
+metrics = deque(maxlen=360)
+
+
+def time_loop(period=10,report=None):
+	"""call get_new_vehicles every N seconds without stopping. Polls are
+		scheduled from a fixed start time rather than from the end of the
+		last poll, so the schedule doesn't drift. A poll that runs long
+		never overlaps the next: any ticks it runs into are skipped.
+		The metrics of each tick are passed to report, if given."""
+	next_tick = time.time()
+	while True:
+		# how far behind schedule are we?
+		lag = time.time() - next_tick
+		# request new vehicles and store them
+		tick = get_new_vehicles()
+		tick['lag'] = lag
+		tick['skipped'] = 0
+		next_tick += period
+		now = time.time()
+		if now > next_tick:
+			# we're busy past the next tick(s), so skip them
+			tick['skipped'] = int( (now - next_tick) // period ) + 1
+			next_tick += tick['skipped'] * period
+		metrics.append(tick)
+		if report:
+			report(tick)
+		print '\tfetch %.2f s, parse %.2f s, update %.2f s, lag %.3f s, skipped %d' % (
+			tick.get('fetch',0), tick.get('parse',0), tick.get('update',0),
+			tick['lag'], tick['skipped']
+		)
+		sleep( max( 0, next_tick - time.time() ) )
+
+def main(report=None):
+	"""set up the tables as asked, then collect vehicles indefinitely"""
+	if truncateData:
+		db.empty_tables()
+
+	# then it calls get_new_vehicles every N secs
+	time_loop(10,report)
+
+if __name__ == '__main__':
+	main()
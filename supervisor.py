@@ -0,0 +1,191 @@
+# call this file to run a collector (store.py) for each shard given in
+# conf['shards'], each in its own process, e.g.
+# python supervisor.py [getRoutes] [doMatching] [record]
+# Each collector has its own agency or route group and tables, and is
+# restarted if it dies. The latest metrics from all of them
+# are printed together as a combined view of their health.
+
+import multiprocessing as mp
+import sys, time, copy, atexit, signal
+from Queue import Empty
+from os import path, kill
+from conf import conf
+
+# seconds between printing the combined health view
+report_period = 30
+# a collector that hasn't reported for this long is flagged as stalled
+stall_time = 120
+# seconds to wait before restarting a collector that died
+restart_delay = 10
+# seconds a stopping collector has to store its waiting trips
+stop_timeout = 60
+
+
+def merge(settings,overrides):
+	"""update a dictionary of settings in place with any overrides,
+		merging (rather than replacing) nested dictionaries"""
+	for key, value in overrides.items():
+		if isinstance(value,dict) and isinstance(settings.get(key),dict):
+			merge(settings[key],value)
+		else:
+			settings[key] = copy.deepcopy(value)
+
+
+def apply_shard(shard):
+	"""make conf that of a single shard. Unless the shard says otherwise,
+		it gets its own processing backlog and archive directory"""
+	overrides = dict( (k,v) for k,v in shard.items() if k != 'name' )
+	merge(conf,overrides)
+	if 'backlog' not in shard.get('processing',{}):
+		directory, filename = path.split(conf['processing']['backlog'])
+		conf['processing']['backlog'] = path.join(directory,shard['name']+'_'+filename)
+	if 'archive' not in shard:
+		conf['archive'] = path.join(conf['archive'],shard['name'])
+
+
+def run_shard(shard,reports):
+	"""target of each collector process. conf must be set before
+		anything reads it, so the collector is only imported here."""
+	apply_shard(shard)
+	# tables are only truncated once, by hand; never on a restart
+	sys.argv = [ arg for arg in sys.argv if arg != 'truncateData' ]
+	import store, nb_api
+	# child processes leave through os._exit, so the writer's atexit 
+	# flush never runs; waiting trips are stored here instead, whether
+	# the collector is stopped (SIGTERM) or fails
+	def terminate(signum,frame):
+		sys.exit(0)
+	signal.signal(signal.SIGTERM,terminate)
+	try:
+		store.main(
+			lambda tick: reports.put( (shard['name'], time.time(), tick) )
+		)
+	finally:
+		signal.signal(signal.SIGTERM,signal.SIG_IGN)
+		nb_api.writer.close()
+
+
+class supervisor(object):
+	"""Starts a collector process for each shard, restarts any that die
+		and keeps the latest metrics reported by each"""
+
+	def __init__(self,shards):
+		self.shards = dict( (shard['name'],shard) for shard in shards )
+		self.reports = mp.Queue()
+		self.processes = {}		# name -> collector process
+		self.started = {}			# name -> time the process was started
+		self.restarts = dict( (name,0) for name in self.shards )
+		self.latest = {}			# name -> ( time, metrics of last tick )
+		self.ticks = dict( (name,0) for name in self.shards )
+		atexit.register(self.stop)
+		for name in self.shards:
+			self.start(name)
+
+
+	def start(self,name):
+		"""start (or restart) the collector for a shard"""
+		process = mp.Process(
+			target=run_shard, name=name,
+			args=(self.shards[name],self.reports)
+		)
+		process.start()
+		self.processes[name] = process
+		self.started[name] = time.time()
+		print 'started collector',name,'as process',process.pid
+
+
+	def check(self):
+		"""restart any collectors that have died, after a short delay"""
+		for name, process in self.processes.items():
+			if process.is_alive():
+				continue
+			if time.time() - self.started[name] < restart_delay:
+				continue
+			print 'collector',name,'exited with',process.exitcode,'- restarting'
+			self.restarts[name] += 1
+			self.start(name)
+
+
+	def collect(self,timeout):
+		"""receive metrics from the collectors for up to timeout seconds"""
+		deadline = time.time() + timeout
+		while True:
+			remaining = deadline - time.time()
+			if remaining <= 0:
+				return
+			try:
+				name, report_time, tick = self.reports.get(True,remaining)
+			except Empty:
+				return
+			self.latest[name] = ( report_time, tick )
+			self.ticks[name] += 1
+
+
+	def health(self):
+		"""return a row of the latest state of each collector"""
+		rows = []
+		now = time.time()
+		for name in sorted(self.shards):
+			process = self.processes[name]
+			report_time, tick = self.latest.get( name, (None,{}) )
+			age = now - report_time if report_time else now - self.started[name]
+			if not process.is_alive():
+				status = 'dead'
+			elif age > stall_time:
+				status = 'stalled'
+			elif 'error' in tick:
+				status = 'error'
+			else:
+				status = 'ok'
+			rows.append({
+				'name':name,
+				'pid':process.pid,
+				'status':status,
+				'restarts':self.restarts[name],
+				'ticks':self.ticks[name],
+				'age':age,
+				'vehicles':tick.get('vehicles',0),
+				'fleet':tick.get('fleet',0),
+				'ending':tick.get('ending',0),
+				'waiting':tick.get('waiting',0),
+				'fetch':tick.get('fetch',0),
+				'lag':tick.get('lag',0)
+			})
+		return rows
+
+
+	def print_health(self):
+		print time.strftime("%b %d %Y %H:%M:%S"),'collectors:'
+		print '\t%-12s %6s %-8s %8s %6s %8s %8s %6s %6s %7s %7s %7s' % (
+			'shard','pid','status','restarts','ticks','last(s)',
+			'vehicles','fleet','ending','waiting','fetch','lag'
+		)
+		for row in self.health():
+			print '\t%(name)-12s %(pid)6d %(status)-8s %(restarts)8d %(ticks)6d %(age)8.0f %(vehicles)8d %(fleet)6d %(ending)6d %(waiting)7d %(fetch)7.2f %(lag)7.2f' % row
+
+
+	def run(self):
+		"""watch the collectors indefinitely"""
+		while True:
+			self.collect(report_period)
+			self.check()
+			self.print_health()
+
+
+	def stop(self):
+		"""ask every collector to stop, giving them time to store their
+			waiting trips before they are killed"""
+		for process in self.processes.values():
+			if process.is_alive():
+				process.terminate()
+		deadline = time.time() + stop_timeout
+		for name, process in self.processes.items():
+			process.join( max( 0, deadline - time.time() ) )
+			if process.is_alive():
+				print 'collector',name,'did not stop in time - killing it'
+				kill(process.pid,signal.SIGKILL)
+				process.join()
+
+
+if __name__ == '__main__':
+	supervisor(conf['shards']).run()
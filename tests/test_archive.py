@@ -0,0 +1,109 @@
+# Tests of the Parquet trip archive (archive.py), written to and read
+# back from a temporary directory. These are skipped without pyarrow.
+# Run from the repository root with
+# python -m unittest discover tests
+
+import sys, shutil, tempfile, unittest
+from os import path
+import numpy as np
+
+sys.path.insert( 0, path.dirname(path.dirname(path.abspath(__file__))) )
+try:
+	import conf
+except ImportError:
+	# the sample settings will do; nothing is read from the database
+	import sample_conf
+	sys.modules['conf'] = sample_conf
+import archive
+from trip import trip
+
+
+def trace(trip_id,block_id,direction_id,vehicle_id,points):
+	"""the attributes of a trip as given by db.get_trips"""
+	return {
+		'block_id':block_id,
+		'direction_id':direction_id,
+		'vehicle_id':vehicle_id,
+		'lons':np.linspace( -79.4, -79.3, points ),
+		'lats':np.linspace( 43.6, 43.7, points ),
+		'times':np.arange( points, dtype=float )*20 + 1500000000 + trip_id
+	}
+
+
+@unittest.skipIf( archive.pa is None, 'pyarrow is not installed' )
+class test_archive(unittest.TestCase):
+
+	def setUp(self):
+		self.directory = tempfile.mkdtemp()
+
+	def tearDown(self):
+		shutil.rmtree(self.directory)
+
+	def assertSameTrace(self,archived,original):
+		for key in ('block_id','direction_id','vehicle_id'):
+			self.assertEqual( archived[key], original[key] )
+		for key in ('lons','lats','times'):
+			self.assertTrue( np.array_equal( archived[key], original[key] ) )
+
+	def test_traces_round_trip(self):
+		trips = {
+			101:trace(101,7,'504_0_504','4001',3),
+			102:trace(102,7,'504_1_504','4001',5),
+			103:trace(103,8,'504_0_504','4002',1)
+		}
+		points = archive.write_traces( self.directory, 17500, '504', trips )
+		self.assertEqual( points, 9 )
+		reader = archive.archive_reader(self.directory)
+		self.assertEqual( reader.trip_ids(), [101,102,103] )
+		archived = reader.get_trips()
+		self.assertEqual( sorted(archived), [101,102,103] )
+		for trip_id, original in trips.items():
+			self.assertEqual( archived[trip_id]['route_id'], '504' )
+			self.assertSameTrace( archived[trip_id], original )
+
+	def test_only_partitions_and_trips_asked_for(self):
+		archive.write_traces( self.directory, 17500, '504', { 101:trace(101,7,'a','4001',3) } )
+		archive.write_traces( self.directory, 17500, '505', { 102:trace(102,8,'b','4002',4) } )
+		archive.write_traces( self.directory, 17501, '504', { 103:trace(103,9,'a','4003',2) } )
+		reader = archive.archive_reader(self.directory)
+		self.assertEqual( reader.trip_ids(service_ids=[17500]), [101,102] )
+		self.assertEqual( reader.trip_ids(route_ids=['504']), [101,103] )
+		self.assertEqual( sorted(reader.get_trips([102,103,999])), [102,103] )
+		self.assertEqual( sorted(reader.get_trips(service_ids=[17501])), [103] )
+
+	def test_trips_from_archive(self):
+		trips = { 101:trace(101,7,'a','4001',3), 102:trace(102,7,'b','4001',4) }
+		archive.write_traces( self.directory, 17500, '504', trips )
+		reader = archive.archive_reader(self.directory)
+		loaded = trip.fromArchive( reader, [102,999,101] )
+		self.assertEqual( [ t.trip_id for t in loaded ], [102,101] )
+		self.assertEqual( loaded[0].route_id, '504' )
+		self.assertTrue( np.array_equal( loaded[1].times, trips[101]['times'] ) )
+
+	def test_stop_times_round_trip(self):
+		stop_times = {
+			'trip_id':np.array( [101,101,102], dtype=np.int64 ),
+			'stop_id':[ '1001', '1002', '1001' ],
+			'stop_sequence':np.array( [1,2,1], dtype=np.int32 ),
+			'etime':np.array( [1500000000.5,1500000060.0,1500000100.0] )
+		}
+		self.assertEqual( archive.write_stop_times( self.directory, 17500, '504', stop_times ), 3 )
+		archived = archive.archive_reader(self.directory).get_stop_times()
+		self.assertEqual( archived['stop_id'], stop_times['stop_id'] )
+		for key in ('trip_id','stop_sequence','etime'):
+			self.assertTrue( np.array_equal( archived[key], stop_times[key] ) )
+
+	def test_empty_stop_times(self):
+		stop_times = { 'trip_id':[], 'stop_id':[], 'stop_sequence':[], 'etime':[] }
+		self.assertEqual( archive.write_stop_times( self.directory, 17500, '504', stop_times ), 0 )
+		table = archive.pq.read_table( archive.partition( self.directory, 'stop_times', 17500, '504' ) )
+		self.assertEqual(
+			[ str(field.type) for field in table.schema ],
+			[ 'int64', 'string', 'int32', 'double' ]
+		)
+		archived = archive.archive_reader(self.directory).get_stop_times()
+		self.assertEqual( len(archived['etime']), 0 )
+
+
+if __name__ == '__main__':
+	unittest.main()
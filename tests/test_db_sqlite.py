@@ -0,0 +1,140 @@
+# Tests of the SQLite storage backend (db_sqlite.py), used through db.py
+# as everything else uses it, on a temporary file. Run from the
+# repository root with
+# python -m unittest discover tests
+
+import sys, types, time, shutil, tempfile, unittest
+from os import path
+import numpy as np
+from shapely.geometry import LineString
+from shapely.wkb import dumps as dumpWKB
+
+sys.path.insert( 0, path.dirname(path.dirname(path.abspath(__file__))) )
+try:
+	import conf
+except ImportError:
+	# the sample settings will do; the backend and file are set below
+	import sample_conf
+	sys.modules['conf'] = sample_conf
+from conf import conf
+import db, db_sqlite
+from geom import project
+from stop_cache import stop_cache
+from trip import trip
+
+
+def record(trip_id,route_id,start_time,points=5):
+	"""a trip as given to copy_trips, near the origin of the projection"""
+	lons = np.linspace( -45.00, -44.99, points )
+	lats = np.linspace( -23.00, -22.99, points )
+	x, y = project( lons, lats, conf['localEPSG'] )
+	geom = dumpWKB( LineString( np.column_stack((x,y)) ), hex=True, srid=conf['localEPSG'] )
+	times = [ start_time + 20*i for i in range(points) ]
+	return ( trip_id, trip_id // 10, route_id, route_id+'_0', 'v'+str(trip_id), times, geom )
+
+
+class test_db_sqlite(unittest.TestCase):
+
+	def setUp(self):
+		self.directory = tempfile.mkdtemp()
+		self.settings = dict(conf['db'])
+		conf['db']['backend'] = 'sqlite'
+		conf['db']['file'] = path.join(self.directory,'test.sqlite')
+		# start each test on a new file, with nothing known or cached
+		db.backend = None
+		db_sqlite.connection = None
+		db_sqlite.known_route_records.clear()
+		db_sqlite.stops_cache = stop_cache()
+
+	def tearDown(self):
+		if db_sqlite.connection is not None:
+			db_sqlite.connection.close()
+			db_sqlite.connection = None
+		conf['db'].clear()
+		conf['db'].update(self.settings)
+		db.backend = None
+		shutil.rmtree(self.directory)
+
+	def test_backend_is_checked_on_load(self):
+		self.assertTrue( db.load() is db_sqlite )
+		db.backend = None
+		partial = types.ModuleType('db_partial')
+		partial.reconnect = lambda: None
+		sys.modules['db_partial'] = partial
+		db.backends['partial'] = 'db_partial'
+		conf['db']['backend'] = 'partial'
+		try:
+			self.assertRaises( NotImplementedError, db.load )
+			self.assertTrue( db.backend is None )
+		finally:
+			del db.backends['partial']
+			del sys.modules['db_partial']
+
+	def test_reserve_ids(self):
+		self.assertEqual( db.reserve_ids('trip_ids',3), [1,2,3] )
+		self.assertEqual( db.reserve_ids('trip_ids',2), [4,5] )
+		# each sequence is separate
+		self.assertEqual( db.reserve_ids('block_ids',2), [1,2] )
+
+	def test_copy_and_get_trips(self):
+		records = [ record(11,'504',1500000000), record(12,'505',1500003600,3) ]
+		db.copy_trips(records)
+		db.insert_trip( *record(13,'504',1500007200) )
+		trips = db.get_trips([11,12,99])
+		self.assertEqual( sorted(trips), [11,12] )
+		for trip_id, block_id, route_id, direction_id, vehicle_id, times, geom in records:
+			stored = trips[trip_id]
+			self.assertEqual( stored['block_id'], block_id )
+			self.assertEqual( stored['route_id'], route_id )
+			self.assertEqual( stored['direction_id'], direction_id )
+			self.assertEqual( stored['vehicle_id'], vehicle_id )
+			self.assertTrue( np.array_equal( stored['times'], times ) )
+			self.assertTrue( np.allclose( stored['lons'], np.linspace(-45.00,-44.99,len(times)) ) )
+			self.assertTrue( np.allclose( stored['lats'], np.linspace(-23.00,-22.99,len(times)) ) )
+		self.assertEqual( db.get_trip_ids(), [11,12,13] )
+		self.assertEqual( db.get_trip_ids(route_id='504'), [11,13] )
+		self.assertEqual( db.get_trip_ids(min_id=12,start_time=1500003600), [12,13] )
+		self.assertEqual( db.get_trip_ids(end_time=1500003600), [11] )
+		self.assertTrue( db.trip_exists(12) )
+		self.assertFalse( db.trip_exists(99) )
+
+	def test_route_config_and_stops(self):
+		stops = [
+			( 's1', 'First', '101', '-45.000', '-23.000' ),
+			( 's2', 'Second', '102', '-44.995', '-22.995' )
+		]
+		directions = [ ( '504', '504_0', 'East', 'East', '504A', True, ['s2','s1','s2'] ) ]
+		before = time.time() - 1
+		self.assertEqual( db.store_route_config(stops,directions), (2,1) )
+		# nothing has changed
+		self.assertEqual( db.store_route_config(stops,directions), (0,0) )
+		self.assertEqual( db.get_stops('504_0',before), [] )
+		found = db.get_stops('504_0',time.time()+1)
+		self.assertEqual( [ stop['id'] for stop in found ], ['s2','s1'] )
+		self.assertTrue( found[1]['geom'].distance( found[0]['geom'] ) > 500 )
+		db.get_stops('504_0',time.time()+2)
+		self.assertEqual( db.get_stop_cache_stats()['hits'], 1 )
+
+	def test_results_are_scrubbed_by_fromDBBatch(self):
+		db.copy_trips( [ record(11,'504',1500000000), record(12,'504',1500003600) ] )
+		db.store_trip_result( 11, service_id=17361, timepoints=[
+			{ 'stop_id':'s1', 'time':1500000010.0 },
+			{ 'stop_id':'s2', 'time':1500000050.0 }
+		] )
+		db.store_trip_result( 12, ignore=True, problem='too short' )
+		self.assertEqual( db.get_trip_ids(status='processed'), [11] )
+		self.assertEqual( db.get_trip_ids(status='problem'), [12] )
+		stop_times = db.get_stop_times([11,12])
+		self.assertEqual( stop_times['stop_id'], ['s1','s2'] )
+		self.assertEqual( list(stop_times['stop_sequence']), [1,2] )
+		trips = trip.fromDBBatch([12,99,11])
+		self.assertEqual( [ t.trip_id for t in trips ], [12,11] )
+		self.assertEqual( trips[1].vehicle_id, 'v11' )
+		self.assertEqual( len(trips[1].times), 5 )
+		# loaded as though never processed
+		self.assertEqual( db.get_trip_ids(status='unprocessed'), [11,12] )
+		self.assertEqual( len( db.get_stop_times([11,12])['etime'] ), 0 )
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,168 @@
+# Tests of the OSRM client (map_api.client) against a stub OSRM server
+# on localhost. Run from the repository root with
+# python -m unittest discover tests
+
+import sys, threading, time, socket, unittest
+from os import path
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+
+sys.path.insert( 0, path.dirname(path.dirname(path.abspath(__file__))) )
+try:
+	import conf
+except ImportError:
+	# the sample settings will do; only the client is tested
+	import sample_conf
+	sys.modules['conf'] = sample_conf
+import requests
+import map_api
+
+
+class stub_osrm(ThreadingMixIn,HTTPServer):
+	"""Answers every request after a delay, with the status codes given,
+		in turn, then 200. Records how many requests were handled at
+		once and the client ports they came from."""
+
+	daemon_threads = True
+
+	def __init__(self,delay=0,statuses=()):
+		HTTPServer.__init__( self, ('127.0.0.1',0), stub_handler )
+		self.delay = delay
+		self.statuses = list(statuses)
+		self.lock = threading.Lock()
+		self.handled = 0
+		self.active = 0
+		self.max_active = 0
+		self.ports = set()
+		self.thread = threading.Thread(target=self.serve_forever)
+		self.thread.daemon = True
+		self.thread.start()
+
+	def url(self):
+		return 'http://127.0.0.1:%d' % self.server_address[1]
+
+	def close(self):
+		self.shutdown()
+		self.server_close()
+
+
+class stub_handler(BaseHTTPRequestHandler):
+
+	# keep connections alive between requests
+	protocol_version = 'HTTP/1.1'
+
+	def do_GET(self):
+		server = self.server
+		with server.lock:
+			server.active += 1
+			server.max_active = max( server.max_active, server.active )
+			server.ports.add( self.client_address[1] )
+			status = server.statuses.pop(0) if len(server.statuses) > 0 else 200
+		time.sleep(server.delay)
+		body = '{"code":"Ok","matchings":[],"tracepoints":[]}'
+		self.send_response(status)
+		self.send_header('Content-Type','application/json')
+		self.send_header('Content-Length',str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+		with server.lock:
+			server.active -= 1
+			server.handled += 1
+
+	def log_message(self,format,*args):
+		pass
+
+
+def unused_port():
+	s = socket.socket()
+	s.bind( ('127.0.0.1',0) )
+	port = s.getsockname()[1]
+	s.close()
+	return port
+
+
+class test_client(unittest.TestCase):
+
+	def setUp(self):
+		self.servers = []
+
+	def tearDown(self):
+		for server in self.servers:
+			server.close()
+
+	def serve(self,delay=0,statuses=()):
+		server = stub_osrm(delay,statuses)
+		self.servers.append(server)
+		return server
+
+	def test_in_flight_limit(self):
+		server = self.serve(delay=0.2)
+		client = map_api.client( server.url(), timeout=5, max_requests=2 )
+		threads = [
+			threading.Thread( target=client.get, args=('/match/v1/transit/0,0',{}) )
+			for i in range(6)
+		]
+		for thread in threads:
+			thread.start()
+		for thread in threads:
+			thread.join()
+		stats = client.get_stats()
+		self.assertEqual( server.handled, 6 )
+		self.assertLessEqual( server.max_active, 2 )
+		self.assertEqual( stats['requests'], 6 )
+		self.assertGreaterEqual( stats['max_waiting'], 1 )
+		self.assertEqual( stats['waiting'], 0 )
+		self.assertEqual( stats['in_flight'], 0 )
+		self.assertEqual( stats['failures'], 0 )
+
+	def test_connections_are_reused(self):
+		server = self.serve()
+		client = map_api.client( server.url(), timeout=5, max_requests=1 )
+		for i in range(5):
+			client.get('/match/v1/transit/0,0',{})
+		self.assertEqual( len(server.ports), 1 )
+
+	def test_retries_server_errors(self):
+		server = self.serve( statuses=(503,500) )
+		client = map_api.client( server.url(), timeout=5, retries=2 )
+		response = client.get('/match/v1/transit/0,0',{})
+		stats = client.get_stats()
+		self.assertEqual( response.status_code, 200 )
+		self.assertEqual( server.handled, 3 )
+		self.assertEqual( stats['retries'], 2 )
+		self.assertEqual( stats['requests'], 1 )
+		self.assertEqual( stats['failures'], 0 )
+
+	def test_fails_after_retries(self):
+		server = self.serve( statuses=(502,502) )
+		client = map_api.client( server.url(), timeout=5, retries=1 )
+		self.assertRaises( requests.HTTPError, client.get, '/match/v1/transit/0,0', {} )
+		stats = client.get_stats()
+		self.assertEqual( server.handled, 2 )
+		self.assertEqual( stats['retries'], 1 )
+		self.assertEqual( stats['failures'], 1 )
+		self.assertEqual( stats['requests'], 0 )
+		self.assertEqual( stats['in_flight'], 0 )
+
+	def test_retries_connection_errors(self):
+		client = map_api.client( 'http://127.0.0.1:%d' % unused_port(), timeout=1, retries=1 )
+		self.assertRaises( requests.ConnectionError, client.get, '/match/v1/transit/0,0', {} )
+		stats = client.get_stats()
+		self.assertEqual( stats['retries'], 1 )
+		self.assertEqual( stats['failures'], 1 )
+		self.assertEqual( stats['in_flight'], 0 )
+
+	def test_latency(self):
+		server = self.serve(delay=0.05)
+		client = map_api.client( server.url(), timeout=5 )
+		for i in range(3):
+			client.get('/match/v1/transit/0,0',{})
+		stats = client.get_stats()
+		self.assertGreaterEqual( stats['latency_max'], 0.05 )
+		self.assertGreaterEqual( stats['latency_mean'], 0.05 )
+		self.assertLessEqual( stats['latency_mean'], stats['latency_max'] )
+		self.assertAlmostEqual( stats['latency_total'], 3*stats['latency_mean'] )
+
+
+if __name__ == '__main__':
+	unittest.main()
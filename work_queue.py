@@ -0,0 +1,348 @@
+# Processing of stored trips by a pool of worker processes. Trip IDs
+# waiting to be processed are journaled to disk so that none are lost
+# if the collector stops, and are picked up again when it restarts.
+
+import multiprocessing as mp
+import threading, time, atexit, traceback
+from collections import deque
+from os import path, getpid, rename
+from functools import partial
+from trip import trip
+import db, map_api
+
+# trips are loaded from the database, unless from an archive_reader 
+# (see archive.py) given to use_archive before the pool is started
+archive = None
+
+
+def use_archive(reader):
+	"""load the raw traces of trips to be processed from a Parquet 
+		archive rather than the database"""
+	global archive
+	archive = reader
+
+
+def load_trips(trip_ids):
+	"""Construct the trip objects to be processed. Any results of 
+		earlier processing are scrubbed from the database, since new 
+		ones are stored there, even for trips from an archive."""
+	if archive is None:
+		return trip.fromDBBatch(trip_ids)
+	trips = trip.fromArchive(archive,trip_ids)
+	if len(trips) > 0:
+		db.scrub_trips( [ this_trip.trip_id for this_trip in trips ] )
+	return trips
+
+
+def process_trips(trip_ids):
+	"""worker process called by the pool with a batch of trip_ids, which
+		are loaded together. Failures are caught here so that they can 
+		be reported without taking down the worker, and so that the 
+		batch always comes back to the queue. Returns, for each trip, the
+		trip_id, the seconds spent in each stage, any error traceback and
+		the state of this worker's caches."""
+	results = {}
+	cache = None
+	try:
+		start = time.time()
+		trips = load_trips(trip_ids)
+		# the load time is shared out between the trips
+		load = ( time.time() - start ) / max(1,len(trips))
+		for this_trip in trips:
+			timings = { 'load':load }
+			try:
+				this_trip.process()
+				timings.update(this_trip.timings)
+				error = None
+			except:
+				error = traceback.format_exc()
+			results[this_trip.trip_id] = ( timings, error )
+		for trip_id in trip_ids:
+			results.setdefault( trip_id, ( {}, 'no such trip' ) )
+		cache = {
+			'stop_cache':db.get_stop_cache_stats(),
+			'match_cache':map_api.get_cache_stats()
+		}
+	except:
+		# anything else fails the trips not yet accounted for
+		error = traceback.format_exc()
+		for trip_id in trip_ids:
+			results.setdefault( trip_id, ( {}, error ) )
+	return [
+		( trip_id, ) + results[trip_id] + ( ( getpid(), cache ), )
+		for trip_id in trip_ids
+	]
+
+
+class processing_queue(object):
+	"""Feeds trip IDs to a pool of processes in batches of up to
+		batch_size, keeping no more than max_queue of them handed to the
+		pool at once. The rest wait in the backlog, which is written to
+		a journal file as '+trip_id' when added and '-trip_id' when done;
+		the journal is rewritten with only what remains once compact_after
+		trips are done. If more than max_backlog trips are waiting, 
+		putting more blocks until the pool catches up. Trips that fail
+		are tried again after retry_delay seconds, up to retries times;
+		those still failing stay in the journal, to be tried again when
+		the collector restarts. A batch not back from the pool after 
+		batch_timeout seconds (e.g. because its worker died) counts as 
+		failed."""
+
+	def __init__(self,workers,max_queue,backlog_file,batch_size=20,retries=3,
+		retry_delay=60,max_backlog=10000,batch_timeout=600,compact_after=10000,tick=5):
+		self.max_queue = max_queue
+		self.batch_size = batch_size
+		self.backlog_file = backlog_file
+		self.retries = retries
+		self.retry_delay = retry_delay
+		self.max_backlog = max_backlog
+		self.batch_timeout = batch_timeout
+		self.compact_after = compact_after
+		self.tick = tick					# seconds between feeds with nothing arriving
+		self.backlog = deque()			# trip_ids not yet handed to the pool
+		self.retrying = deque()			# ( time due, trip_id ) of failed trips
+		self.attempts = {}					# trip_id -> times it has failed
+		self.batches = {}					# batch number -> ( AsyncResult, trip_ids, time handed over )
+		self.batch_count = 0
+		self.journaled = set()			# trip_ids added to the journal and not yet done
+		self.finished = 0					# trips journaled as done since it was last rewritten
+		self.lock = threading.Lock()
+		self.room = threading.Condition(self.lock)
+		self.stats = {
+			'queued':0,			# trips received
+			'processed':0,		# trips processed without error
+			'failed':0,			# trips whose processing raised an error
+			'retried':0,		# failed trips tried again
+			'abandoned':0,		# trips left in the journal after failing every retry
+			'lost_batches':0,	# batches that never came back from the pool
+			'blocked_puts':0,	# puts that had to wait for room in the backlog
+			'in_flight':0,		# trips handed to the pool, not yet done
+			'stage_seconds':{},	# total time spent in each stage
+			'stage_counts':{}		# number of trips timed in each stage
+		}
+		self.queued_at = {}				# trip_id -> time it was queued
+		self.caches = {}					# worker pid -> stats of its caches
+		# each worker gets its own database connections
+		self.pool = mp.Pool(workers,initializer=db.reconnect)
+		atexit.register(self.pool.terminate)
+		# pick up anything left over from a previous run
+		for trip_id in self.read_backlog():
+			self.backlog.append(trip_id)
+			self.journaled.add(trip_id)
+			self.queued_at[trip_id] = time.time()
+			self.stats['queued'] += 1
+		# start the journal afresh with only what remains
+		self.journal = None
+		self.compact_journal()
+		if len(self.backlog) > 0:
+			print 'resuming',len(self.backlog),'trips from the processing backlog'
+		self.feed()
+		# retries come due and lost batches are noticed even when no new
+		# trips are arriving
+		self.thread = threading.Thread(target=self.run)
+		self.thread.daemon = True
+		self.thread.start()
+
+
+	def read_backlog(self):
+		"""return the trip_ids in the journal that were never finished,
+			in the order they were added"""
+		if not path.exists(self.backlog_file):
+			return []
+		pending = []
+		done = set()
+		with open(self.backlog_file) as f:
+			for line in f:
+				line = line.strip()
+				if line.startswith('+'):
+					pending.append( int(line[1:]) )
+				elif line.startswith('-'):
+					done.add( int(line[1:]) )
+		return [ trip_id for trip_id in pending if trip_id not in done ]
+
+
+	def write_journal(self,entry):
+		# call while holding the lock
+		self.journal.write(entry+'\n')
+		self.journal.flush()
+
+
+	def compact_journal(self):
+		"""rewrite the journal with only the trips not yet done. It is
+			written aside and moved into place, so that a crash leaves 
+			either the old journal or the new one. Call while holding 
+			the lock."""
+		if self.journal is not None:
+			self.journal.close()
+		with open(self.backlog_file+'.tmp','w') as f:
+			# trip_ids are drawn in order, so this is about the order added
+			for trip_id in sorted(self.journaled):
+				f.write('+'+str(trip_id)+'\n')
+		rename(self.backlog_file+'.tmp',self.backlog_file)
+		self.journal = open(self.backlog_file,'a')
+		self.finished = 0
+
+
+	def finish(self,trip_id):
+		# call while holding the lock
+		self.write_journal( '-'+str(trip_id) )
+		self.journaled.discard(trip_id)
+		self.finished += 1
+		if self.finished >= self.compact_after:
+			self.compact_journal()
+
+
+	def waiting(self):
+		# call while holding the lock
+		return len(self.backlog) + len(self.retrying) + self.stats['in_flight']
+
+
+	def put(self,trip_ids):
+		"""add stored trips to be processed. Trips beyond max_queue wait
+			in the backlog; if more than max_backlog are already waiting,
+			this blocks until there is room. They are journaled first, 
+			so that none are lost if the collector stops meanwhile."""
+		with self.room:
+			for trip_id in trip_ids:
+				self.write_journal( '+'+str(trip_id) )
+				self.journaled.add(trip_id)
+			if self.waiting() >= self.max_backlog:
+				# backpressure: wait until the pool catches up
+				self.stats['blocked_puts'] += 1
+				while self.waiting() >= self.max_backlog:
+					self.room.wait()
+			for trip_id in trip_ids:
+				self.backlog.append(trip_id)
+				self.queued_at[trip_id] = time.time()
+				self.stats['queued'] += 1
+		self.feed()
+
+
+	def feed(self):
+		"""hand trips from the backlog to the pool while there is room"""
+		with self.lock:
+			self.check_batches()
+			# failed trips go back in the backlog once their delay is up
+			while len(self.retrying) > 0 and self.retrying[0][0] <= time.time():
+				self.backlog.append( self.retrying.popleft()[1] )
+				self.stats['retried'] += 1
+			while len(self.backlog) > 0 and self.stats['in_flight'] < self.max_queue:
+				batch = [ 
+					self.backlog.popleft() 
+					for i in range( min( self.batch_size, len(self.backlog) ) )
+				]
+				self.batch_count += 1
+				self.stats['in_flight'] += len(batch)
+				result = self.pool.apply_async( 
+					process_trips, (batch,), callback=partial(self.done,self.batch_count)
+				)
+				self.batches[self.batch_count] = ( result, batch, time.time() )
+
+
+	def check_batches(self):
+		"""The pool only calls back for batches that succeed, so look for
+			those that failed (e.g. with a result that couldn't be sent 
+			back) or never came back (e.g. their worker was killed), and 
+			fail their trips. Call while holding the lock."""
+		for number, ( result, batch, handed_at ) in self.batches.items():
+			if result.ready():
+				try:
+					result.get(0)
+					continue
+				except:
+					error = traceback.format_exc()
+			elif time.time() - handed_at > self.batch_timeout:
+				error = 'no result after %g seconds' % self.batch_timeout
+			else:
+				continue
+			# any late result is ignored by done()
+			del self.batches[number]
+			self.stats['lost_batches'] += 1
+			self.stats['in_flight'] -= len(batch)
+			for trip_id in batch:
+				self.fail(trip_id,error)
+			print 'lost a batch of',len(batch),'trips'
+			print error
+			self.room.notify_all()
+
+
+	def fail(self,trip_id,error):
+		"""retry a failed trip, unless it has been tried too often.
+			Call while holding the lock."""
+		self.stats['failed'] += 1
+		self.attempts[trip_id] = self.attempts.get(trip_id,0) + 1
+		if self.attempts[trip_id] <= self.retries:
+			self.retrying.append( (time.time()+self.retry_delay, trip_id) )
+			self.queued_at[trip_id] = time.time()
+		else:
+			# not journaled as done, so tried again on restart
+			del self.attempts[trip_id]
+			self.queued_at.pop(trip_id,None)
+			self.stats['abandoned'] += 1
+
+
+	def done(self,number,results):
+		"""called in the pool's result thread as each batch finishes"""
+		failures = []
+		with self.lock:
+			if self.batches.pop(number,None) is None:
+				# already given up on, and its trips failed
+				return
+			for trip_id, timings, error, (pid, cache_stats) in results:
+				if cache_stats is not None:
+					self.caches[pid] = cache_stats
+				self.stats['in_flight'] -= 1
+				timings['wait'] = time.time() - self.queued_at.pop(trip_id,time.time()) - sum(timings.values())
+				for stage, seconds in timings.items():
+					self.stats['stage_seconds'][stage] = self.stats['stage_seconds'].get(stage,0) + seconds
+					self.stats['stage_counts'][stage] = self.stats['stage_counts'].get(stage,0) + 1
+				if error and error != 'no such trip':
+					failures.append( (trip_id, error) )
+					self.fail(trip_id,error)
+				else:
+					# (a trip that doesn't exist can never be processed)
+					self.finish(trip_id)
+					self.attempts.pop(trip_id,None)
+					if error:
+						self.stats['failed'] += 1
+						failures.append( (trip_id, error) )
+					else:
+						self.stats['processed'] += 1
+			self.room.notify_all()
+		for trip_id, error in failures:
+			print 'failed to process trip',trip_id
+			print error
+		self.feed()
+
+
+	def run(self):
+		"""feed the pool every tick"""
+		while True:
+			time.sleep(self.tick)
+			try:
+				self.feed()
+			except:
+				traceback.print_exc()
+
+
+	def get_stats(self):
+		"""return a copy of the queue's metrics, including the mean
+			time spent in each stage"""
+		with self.lock:
+			stats = dict(self.stats)
+			stats['backlog'] = len(self.backlog)
+			stats['retrying'] = len(self.retrying)
+			stats['stage_means'] = dict(
+				( stage, seconds / self.stats['stage_counts'][stage] )
+				for stage, seconds in self.stats['stage_seconds'].items()
+			)
+			stats['stage_seconds'] = dict(self.stats['stage_seconds'])
+			stats['stage_counts'] = dict(self.stats['stage_counts'])
+			# summed over the workers
+			for name in ('stop_cache','match_cache'):
+				stats[name] = {}
+				for caches in self.caches.values():
+					for key, value in caches[name].items():
+						stats[name][key] = stats[name].get(key,0) + value
+		return stats
+
@@ -0,0 +1,132 @@
+# Buffered storage of trips as they end. Trips are handed over by the
+# polling thread and written in bulk with COPY on a thread of their own,
+# whenever enough have accumulated or the oldest has waited long enough.
+
+import threading, time, atexit, Queue, traceback
+import db
+from conf import conf
+
+
+class trip_writer(object):
+	"""Collects ending trips and flushes them to the trips table.
+		Putting a trip blocks only if the queue is full."""
+
+	def __init__(self,max_trips=500,max_wait=30,max_queue=5000,after_flush=None):
+		self.max_trips = max_trips		# flush when this many are waiting
+		self.max_wait = max_wait		# or when the oldest has waited this long (s)
+		self.after_flush = after_flush	# called with each list of stored trips
+		self.queue = Queue.Queue(max_queue)
+		self.stats_lock = threading.Lock()
+		self.stats = {
+			'queued':0,				# trips received
+			'written':0,			# trips stored
+			'failed':0,				# trips that could not be stored
+			'flushes':0,			# COPY operations
+			'blocked_puts':0,		# puts that had to wait for room in the queue
+			'max_depth':0,			# most trips ever waiting in the queue
+			'flush_seconds':0.0,	# total time spent flushing
+			'last_flush_seconds':0.0
+		}
+		self.closed = False
+		self.thread = threading.Thread(target=self.run)
+		self.thread.daemon = True
+		self.thread.start()
+		# make sure nothing is lost when the collector shuts down
+		atexit.register(self.close)
+
+
+	def put(self,trip):
+		"""queue a trip to be stored"""
+		try:
+			self.queue.put_nowait(trip)
+		except Queue.Full:
+			# backpressure: wait until the writer catches up
+			with self.stats_lock:
+				self.stats['blocked_puts'] += 1
+			self.queue.put(trip)
+		with self.stats_lock:
+			self.stats['queued'] += 1
+			self.stats['max_depth'] = max( self.stats['max_depth'], self.queue.qsize() )
+
+
+	def run(self):
+		"""wait for trips and flush them in batches, until closed"""
+		batch = []
+		deadline = None
+		while True:
+			timeout = self.max_wait if len(batch) == 0 else max( 0, deadline - time.time() )
+			try:
+				trip = self.queue.get(timeout=timeout)
+			except Queue.Empty:
+				trip = None
+			if trip is not None and trip is not self:
+				if len(batch) == 0:
+					deadline = time.time() + self.max_wait
+				batch.append(trip)
+			if len(batch) > 0 and (
+				len(batch) >= self.max_trips or time.time() >= deadline or trip is self
+			):
+				self.flush(batch)
+				batch = []
+			# the writer itself is queued as a signal to stop
+			if trip is self:
+				return
+
+
+	def flush(self,batch):
+		"""store a batch of trips with a single COPY, falling back
+			to storing them one at a time if that fails"""
+		start = time.time()
+		stored = batch
+		try:
+			db.copy_trips( [ self.record(trip) for trip in batch ] )
+		except:
+			traceback.print_exc()
+			stored = []
+			for trip in batch:
+				try:
+					trip.save()
+					stored.append(trip)
+				except:
+					traceback.print_exc()
+		elapsed = time.time() - start
+		with self.stats_lock:
+			self.stats['written'] += len(stored)
+			self.stats['failed'] += len(batch) - len(stored)
+			self.stats['flushes'] += 1
+			self.stats['flush_seconds'] += elapsed
+			self.stats['last_flush_seconds'] = elapsed
+		if self.after_flush and len(stored) > 0:
+			self.after_flush(stored)
+
+
+	def record(self,trip):
+		"""the values of a trip as stored in the trips table"""
+		return (
+			trip.trip_id,
+			trip.block_id,
+			trip.route_id,
+			trip.direction_id,
+			trip.vehicle_id,
+			list(trip.times),
+			trip.get_geom(srid=conf['localEPSG'])
+		)
+
+
+	def get_stats(self):
+		"""return a copy of the writer's metrics, with the current
+			number of trips waiting in the queue"""
+		with self.stats_lock:
+			stats = dict(self.stats)
+		stats['depth'] = self.queue.qsize()
+		return stats
+
+
+	def close(self):
+		"""flush any waiting trips and stop the writer"""
+		if self.closed:
+			return
+		self.closed = True
+		self.queue.put(self)
+		self.thread.join()
+